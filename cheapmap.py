@@ -16,6 +16,8 @@ import rdkit.Chem as rd
 DOT_FILE = 'mst.dot'
 GPICKLE_FILE = 'nx_mst.pickle'
 MST_PICKLE_FILE = 'mst.pickle'
+MCS_MATCH_FILE = 'mcs_matches.pickle'
+MCS_TIMEOUT = 60                        # seconds, as mcs.timeout in dGprep
 
 
 # NOTE: the more similar, the smaller the weight must be!
@@ -44,14 +46,33 @@ def maccs_score(mol1, mol2):
     return 1.0 / (DataStructs.FingerprintSimilarity(fp1, fp2) + 1e-15)
 
 
-def mcs_score(mol1, mol2):
-    """Compute the similarity via the MCS for mol1 and mol2."""
+def atom_signature(mol):
+    """
+    Describe the atom ordering of mol by its element sequence and bond list.
+    Used downstream to check that stored atom indices are still valid.
+    """
+
+    elements = tuple(atom.GetAtomicNum() for atom in mol.GetAtoms() )
+    bonds = tuple(sorted( (min(b.GetBeginAtomIdx(), b.GetEndAtomIdx() ),
+                           max(b.GetBeginAtomIdx(), b.GetEndAtomIdx() ) )
+                         for b in mol.GetBonds() ) )
+
+    return elements, bonds
+
+
+def mcs_match(mol1, mol2, timeout=MCS_TIMEOUT):
+    """
+    Compute the similarity via the MCS for mol1 and mol2 and also return the
+    atom match as pairs of 0-based atom indices.  The MCS search is stopped
+    after timeout seconds.
+    """
 
     import math
 
     from rdkit.Chem.rdFMCS import FindMCS, AtomCompare, BondCompare
 
-    _fmcs_params = dict(maximizeBonds=False, threshold=1.0, timeout=60,
+    _fmcs_params = dict(maximizeBonds=False, threshold=1.0,
+                        timeout=int(timeout),
                         verbose=False, matchValences=False,
                         ringMatchesRingOnly=True, completeRingsOnly=True,
                         atomCompare=AtomCompare.CompareAny,
@@ -62,6 +83,7 @@ def mcs_score(mol1, mol2):
 
     # FIXME: deal with multiple matches?
     match1 = mol1.GetSubstructMatch(pattern)
+    match2 = mol2.GetSubstructMatch(pattern)
 
     NA = mol1.GetNumAtoms()
     NB = mol2.GetNumAtoms()
@@ -88,7 +110,13 @@ def mcs_score(mol1, mol2):
     #score = (float(NMCS + NbMCS) /
     #         float( (NA + NB) * (NbA + NbA) ) )
 
-    return score
+    return score, tuple(zip(match1, match2) )
+
+
+def mcs_score(mol1, mol2, timeout=MCS_TIMEOUT):
+    """Compute the similarity via the MCS for mol1 and mol2."""
+
+    return mcs_match(mol1, mol2, timeout)[0]
 
 
 valid_methods = {'tanimoto' : tanimoto_score,
@@ -129,24 +157,61 @@ def draw_graph(mst, mst_a, mol_names, dir_names, method):
 
 _mol_params = dict(sanitize=False, removeHs=False)
 
-# FIXME: guard against low scores
-#        disallow change in total charge
-def calc_MST(filenames, method, do_draw=True, parallel=False):
 
-    from functools import partial
+def svg_name(filename):
+    """Name of the structure image for filename."""
 
-    import numpy as np
-    from scipy.sparse import csr_matrix
-    from scipy.sparse.csgraph import minimum_spanning_tree
+    dirname = os.path.dirname(filename)
+    basename = os.path.splitext(os.path.basename(filename))[0]
+
+    return os.path.join(dirname, basename + os.extsep + 'svg')
 
+
+def draw_mol(filename):
+    """
+    Render the structure in filename to SVG unless the image is already
+    newer than the structure file.  Returns True if an image was written.
+    """
+
+    import rdkit.Chem.Draw as draw
     import rdkit.Chem.AllChem as ac
 
-    score = valid_methods[method]
+    outname = svg_name(filename)
 
-    N = len(filenames)
-    M = N * (N - 1) / 2
-    npout = (M + (100 - M % 100) ) / 100
-    simmat = np.zeros(shape=(N,N), dtype=np.float32)
+    if (os.access(outname, os.R_OK) and
+        os.path.getmtime(outname) >= os.path.getmtime(filename) ):
+        return False
+
+    mol = rd.MolFromMol2File(filename, **_mol_params)
+    tmp = ac.Compute2DCoords(mol)
+
+    draw.MolToFile(mol, outname, wedgeBonds=False, size=(150,150),
+                   fitImage=True, kekulize=False)
+
+    return True
+
+
+def draw_mols(filenames, parallel=False):
+    """Render all structures needed by draw_graph, skipping current ones."""
+
+    print('Rendering structures...')
+
+    if parallel:
+        pool = mp.Pool(mp.cpu_count() )
+        drawn = pool.map(draw_mol, filenames)
+        pool.close()
+        pool.join()
+    else:
+        drawn = map(draw_mol, filenames)
+
+    print('%i of %i images updated' % (sum(drawn), len(filenames) ) )
+
+
+BLOCK_FILE = 'simmat_block_%i_of_%i.pickle'
+
+
+def read_mols(filenames):
+    """Read the first molecule from each mol2 file."""
 
     mols = []
     mol_names = []
@@ -159,18 +224,61 @@ def calc_MST(filenames, method, do_draw=True, parallel=False):
 
         dirname = os.path.dirname(filename)
         basename = os.path.splitext(os.path.basename(filename))[0]
-        outname = os.path.join(dirname, basename + os.extsep + 'svg')
 
         mols.append(mol)
         mol_names.append(basename)
         dir_names.append(dirname)
 
-        tmp = ac.Compute2DCoords(mol)
+    return mols, mol_names, dir_names
+
+
+def block_rows(N, block, nblocks):
+    """
+    Split the N(N-1)/2 pairs of the upper triangle into nblocks contiguous
+    blocks of (nearly) equal size and return the pairs of the 1-based block
+    as a list of (i, [j, ...]) rows.
+    """
+
+    M = N * (N - 1) / 2
+    start = (block - 1) * M / nblocks
+    end = block * M / nblocks
+
+    rows = []
+    k = 0
+
+    for i in range(N-1):
+        nrow = N - i - 1
+
+        if k + nrow > start and k < end:
+            lo = max(start - k, 0)
+            hi = min(end - k, nrow)
+            rows.append( (i, range(i + 1 + lo, i + 1 + hi) ) )
+
+        k += nrow
+
+        if k >= end:
+            break
 
-        if do_draw:
-            import rdkit.Chem.Draw as draw
-            draw.MolToFile(mol, outname, wedgeBonds=False, size=(150,150),
-                           fitImage=True, kekulize=False)
+    return rows
+
+
+def calc_scores(mols, mol_names, rows, method, parallel=False,
+                store_matches=False, timeout=MCS_TIMEOUT):
+    """
+    Compute the similarity scores for all pairs in rows.  Returns a list of
+    (i, j, score) and a dictionary of atom matches keyed by name pairs.
+    The MCS search of each pair is stopped after timeout seconds.
+    """
+
+    from functools import partial
+
+    if store_matches:
+        score = mcs_match
+    else:
+        score = valid_methods[method]
+
+    if score in (mcs_match, mcs_score):
+        score = partial(score, timeout=timeout)
 
     print('Computing similarity matrix using %s...' % method)
 
@@ -182,19 +290,46 @@ def calc_MST(filenames, method, do_draw=True, parallel=False):
 
     results = []
 
-    for i in range(N-1):
+    for i, cols in rows:
         print('%s...' % mol_names[i])
 
         partial_func = partial(score, mols[i])
-        results.append(map_func(partial_func, mols[i+1:N]) )
+        results.append(map_func(partial_func, [mols[j] for j in cols]) )
 
-    for i, row in enumerate(results):
-        simmat[i][i+1:N] = [s for s in row]
+    scores = []
+    matches = {}
+
+    for (i, cols), row in zip(rows, results):
+        for j, s in zip(cols, row):
+            if store_matches:
+                s, match = s
+                matches[mol_names[i], mol_names[j]] = match
+
+            scores.append( (i, j, s) )
 
     if parallel:
         pool.close()
         pool.join()
 
+    return scores, matches
+
+
+def write_matches(signatures, matches):
+    """Write atom signatures and MCS atom matches for dGprep."""
+
+    print('Writing MCS atom matches to %s...' % MCS_MATCH_FILE)
+
+    with open(MCS_MATCH_FILE, 'wb') as pfile:
+        pickle.dump(signatures, pfile, pickle.HIGHEST_PROTOCOL)
+        pickle.dump(matches, pfile, pickle.HIGHEST_PROTOCOL)
+
+
+def find_MST(simmat, mol_names, dir_names):
+    """Reduce the similarity matrix to the MST and write it to file."""
+
+    from scipy.sparse import csr_matrix
+    from scipy.sparse.csgraph import minimum_spanning_tree
+
     print('similarity score matrix:\n', simmat)
 
     # NOTE: this removes edges with the larger weight
@@ -220,9 +355,141 @@ def calc_MST(filenames, method, do_draw=True, parallel=False):
         pickle.dump(mol_names, pfile, pickle.HIGHEST_PROTOCOL)
         pickle.dump(dir_names, pfile, pickle.HIGHEST_PROTOCOL)
 
+    return mst, mst_a
+
+
+# FIXME: guard against low scores
+#        disallow change in total charge
+def calc_MST(filenames, method, parallel=False, store_matches=False,
+             timeout=MCS_TIMEOUT):
+
+    import numpy as np
+
+    # the atom matches are a by-product of the MCS score only
+    store_matches = store_matches and method == 'mcs'
+
+    N = len(filenames)
+    simmat = np.zeros(shape=(N,N), dtype=np.float32)
+
+    mols, mol_names, dir_names = read_mols(filenames)
+
+    rows = block_rows(N, 1, 1)
+    scores, matches = calc_scores(mols, mol_names, rows, method, parallel,
+                                  store_matches, timeout)
+
+    for i, j, s in scores:
+        simmat[i][j] = s
+
+    mst, mst_a = find_MST(simmat, mol_names, dir_names)
+
+    if store_matches:
+        signatures = dict( (name, atom_signature(mol) )
+                           for name, mol in zip(mol_names, mols) )
+        write_matches(signatures, matches)
+
     return mst, mst_a, mol_names, dir_names
 
 
+def calc_block(filenames, method, block, nblocks, parallel=False,
+               store_matches=False, timeout=MCS_TIMEOUT):
+    """
+    Compute one block of the similarity matrix and write it to a partial
+    file for merge_blocks().  Every block must see the same file list.
+    """
+
+    store_matches = store_matches and method == 'mcs'
+
+    if block < 1 or block > nblocks:
+        raise ValueError('block %i out of range 1-%i' % (block, nblocks) )
+
+    mols, mol_names, dir_names = read_mols(filenames)
+    rows = block_rows(len(mols), block, nblocks)
+
+    print('Block %i of %i: %i pairs' %
+          (block, nblocks, sum(len(cols) for i, cols in rows) ) )
+
+    scores, matches = calc_scores(mols, mol_names, rows, method, parallel,
+                                  store_matches, timeout)
+
+    if store_matches:
+        signatures = dict( (name, atom_signature(mol) )
+                           for name, mol in zip(mol_names, mols) )
+    else:
+        signatures = None
+
+    outname = BLOCK_FILE % (block, nblocks)
+
+    print('Writing partial similarity matrix to %s...' % outname)
+
+    with open(outname, 'wb') as pfile:
+        pickle.dump( (block, nblocks, method), pfile, pickle.HIGHEST_PROTOCOL)
+        pickle.dump(mol_names, pfile, pickle.HIGHEST_PROTOCOL)
+        pickle.dump(dir_names, pfile, pickle.HIGHEST_PROTOCOL)
+        pickle.dump(scores, pfile, pickle.HIGHEST_PROTOCOL)
+        pickle.dump(signatures, pfile, pickle.HIGHEST_PROTOCOL)
+        pickle.dump(matches, pfile, pickle.HIGHEST_PROTOCOL)
+
+
+def merge_blocks(block_files):
+    """
+    Assemble the similarity matrix from the partial files written by
+    calc_block() and compute the MST.
+    """
+
+    import numpy as np
+
+    simmat = None
+    seen = set()
+    all_signatures = {}
+    all_matches = {}
+
+    for filename in block_files:
+        with open(filename, 'rb') as pfile:
+            block, nblocks, method = pickle.load(pfile)
+            mol_names = pickle.load(pfile)
+            dir_names = pickle.load(pfile)
+            scores = pickle.load(pfile)
+            signatures = pickle.load(pfile)
+            matches = pickle.load(pfile)
+
+        if simmat is None:
+            ref = (nblocks, method, mol_names, dir_names)
+            N = len(mol_names)
+            simmat = np.zeros(shape=(N,N), dtype=np.float32)
+        elif (nblocks, method, mol_names, dir_names) != ref:
+            raise ValueError('%s does not match the other block files' %
+                             filename)
+
+        if block in seen:
+            raise ValueError('block %i given twice' % block)
+
+        seen.add(block)
+
+        for i, j, s in scores:
+            simmat[i][j] = s
+
+        if signatures:
+            all_signatures.update(signatures)
+            all_matches.update(matches)
+
+    if simmat is None:
+        raise ValueError('no block files given')
+
+    missing = sorted(set(range(1, ref[0] + 1) ) - seen)
+
+    if missing:
+        raise ValueError('missing blocks: %s' %
+                         ', '.join(str(b) for b in missing) )
+
+    mst, mst_a = find_MST(simmat, ref[2], ref[3])
+
+    if all_signatures:
+        write_matches(all_signatures, all_matches)
+
+    return mst, mst_a, ref[2], ref[3], ref[1]
+
+
+
 
 if __name__ == '__main__':
 
@@ -251,6 +518,22 @@ if __name__ == '__main__':
                         'pygraphviz)')
     parser.add_argument('-p', '--parallel', action='store_true',
                         help='enable the multiprocessing feature')
+    parser.add_argument('-s', '--store-matches', action='store_true',
+                        help='store the MCS atom match of every pair in %s '
+                        'for reuse by dGprep (mcs method only)' %
+                        MCS_MATCH_FILE)
+    parser.add_argument('-t', '--mcs-timeout', type=int, default=MCS_TIMEOUT,
+                        metavar='SECONDS',
+                        help='timeout of the MCS search of each pair, use '
+                        'the same value as mcs.timeout in dGprep (default: '
+                        '%(default)s)')
+    parser.add_argument('-b', '--block', default=None, nargs=1,
+                        metavar='i/n',
+                        help='compute only block i of n of the similarity '
+                        'matrix and write it to a partial file')
+    parser.add_argument('--merge', default=None, nargs='+', metavar='FILE',
+                        help='merge partial files from --block runs and '
+                        'compute the MST')
     parser.add_argument('--version', action='version', version='%(prog)s 0.2.0')
     parser.add_argument('--tracebacklimit', type=int, default=0, nargs=1,
                         metavar='N',
@@ -262,22 +545,13 @@ if __name__ == '__main__':
     sys.tracebacklimit = args.tracebacklimit
 
 
-    if args.graph:
-        import rdkit.Chem.Draw as draw
-        import rdkit.Chem.AllChem as ac
+    if args.parallel:
+        import multiprocessing as mp
+        print('Running on %i processors...' % mp.cpu_count() )
 
+    if args.graph:
         # FIXME: ugly hack
-        for filename in glob.glob('%s/*.mol2' % args.mol2_dir[0]):
-            mol = rd.MolFromMol2File(filename, **_mol_params)
-
-            dirname = os.path.dirname(filename)
-            basename = os.path.splitext(os.path.basename(filename))[0]
-            outname = os.path.join(dirname, basename + os.extsep + 'svg')
-
-            tmp = ac.Compute2DCoords(mol)
-
-            draw.MolToFile(mol, outname, wedgeBonds=False, size=(150,150),
-                           fitImage=True, kekulize=False)
+        draw_mols(glob.glob('%s/*.mol2' % args.mol2_dir[0]), args.parallel)
 
         with open(args.graph[0], 'rb') as pfile:
             mst = pickle.load(pfile)
@@ -286,21 +560,40 @@ if __name__ == '__main__':
 
         mst_a = mst.toarray()
         draw_graph(mst, mst_a, mol_names, dir_names, args.method[0])
+    elif args.merge:
+        mst, mst_a, mol_names, dir_names, method = merge_blocks(args.merge)
+
+        if args.draw:
+            draw_mols(glob.glob('%s/*.mol2' % args.mol2_dir[0]),
+                      args.parallel)
+            draw_graph(mst, mst_a, mol_names, dir_names, method)
     else:
         # FIXME: other file types
-        mol2_files = glob.glob('%s/*.mol2' % args.mol2_dir[0])
+        # NOTE: sorted so that all --block runs see the same order
+        mol2_files = sorted(glob.glob('%s/*.mol2' % args.mol2_dir[0]) )
 
         if not mol2_files:
             raise IOError('directory %s non-existent or empty' % args.mol2_dir[0])
     
         method = args.method[0]
 
-        if args.parallel:
-            import multiprocessing as mp
-            print('Running on %i processors...' % mp.cpu_count() )
+        if args.block:
+            try:
+                block, nblocks = [int(b) for b in args.block[0].split('/')]
+            except ValueError:
+                raise ValueError('--block must be of the form i/n')
+
+            calc_block(mol2_files, method, block, nblocks, args.parallel,
+                       args.store_matches, args.mcs_timeout)
+            sys.exit(0)
 
-        mst, mst_a, mol_names, dir_names = calc_MST(mol2_files, method, args.draw,
-                                                args.parallel)
+        mst, mst_a, mol_names, dir_names = calc_MST(mol2_files, method,
+                                                    args.parallel,
+                                                    args.store_matches,
+                                                    args.mcs_timeout)
 
+        # NOTE: images are only needed for the graph, so render them after
+        #       the similarity computation
         if args.draw:
+            draw_mols(mol2_files, args.parallel)
             draw_graph(mst, mst_a, mol_names, dir_names, method)
@@ -94,6 +94,8 @@ LIGAND_WORKDIR = '_ligands'
 PROTEIN_WORKDIR = '_proteins'
 COMPLEX_WORKDIR = '_complexes'
 MORPH_WORKDIR = '_perturbations'
+CONVERSION_CACHE_DIR = '_convcache'
+LEAP_LIBRARY_DIR = '_leaplib'
 
 PROTEIN_FLEX_FILE = 'protein.flex'
 LIGAND_FLEX_FILE = 'ligand.flex'
@@ -124,11 +126,13 @@ LEAP_IN = 'leap.in'
 LEAP_SOLVATED = 'solvated'
 LEAP_VACUUM = 'vacuum'
 LEAP_IONIZED = 'ionized'
+LEAP_ION_TEMPLATES = 'ion_templates'
 
 MAX_HYDROGEN_MASS = 2.0
 
 MCS_MAP_FILE = 'mcs_map.pkl'
 MCS_MOL_FILE = 'mcs.mol2'
+MORPH_STATE_FILE = 'morph_state.pkl'
 MORPH_NAME = 'MORPH'
 
 PDB_EXT = os.extsep + 'pdb'
@@ -32,25 +32,151 @@ import sys
 import os
 import re
 import shutil
+import tempfile
+import cPickle as pickle
 
 from FESetup import const, errors, logger, report
+from FESetup.prepare.amber import parm7
 from . import util
 
-import Sire.IO
-
 
 REST_PDB_NAME = 'ligand_removed.pdb'
 COMPAT_TABLE = {'Sire': 'pertfile', 'AMBER': 'sander/dummy',
                 'AMBER/softcore': 'sander/softcore'}
 WD_TABLE = {'pertfile': 'sire'}
 
+# Morph state after mapping, independent of the free energy type
+MAPPED_ATTRS = ('lig_morph', 'lig_initial', 'lig_final', 'atoms_initial',
+                'atoms_final', 'atom_map', 'reverse_atom_map', 'con_morph',
+                'connect_final', 'dummy_idx')
+
+# bump when the layout of the saved morph state changes
+STATE_VERSION = 2
+
+# PertTopology attributes which are handed in by the Morph, not saved
+TOPOL_SHARED = ('ff', 'con_morph', 'atoms_initial', 'atoms_final',
+                'lig_initial', 'lig_final', 'atom_map', 'reverse_atom_map',
+                'zz_atoms')
+
+
+# split reference systems shared by all morphs starting from them
+_environments = {}
+
+
+class _Environment(object):
+    """A reference system split into ligand and the rest of the system."""
+
+    __slots__ = ('stamp', 'lig', 'box_dims', 'rest_pdbs')
+
+    def __init__(self, stamp, lig, box_dims):
+        self.stamp = stamp
+        self.lig = lig
+        self.box_dims = box_dims
+        self.rest_pdbs = {}             # rest system stamp -> PDB file
+
+
+class _PackedTopology(object):
+    """A PertTopology without the state shared with the Morph."""
+
+    __slots__ = ('module', 'state', 'sire')
+
+    def __init__(self, module, state, sire):
+        self.module = module
+        self.state = state
+        self.sire = sire
+
+
+def _is_sire(value):
+    """Check if value is a Sire object, these cannot be pickled."""
+
+    return type(value).__module__.split('.')[0] == 'Sire'
+
+
+def _pack_topol(topol):
+    """
+    Strip a PertTopology, and nested ones, of the Sire state shared with the
+    Morph such that the rest can be pickled.  Only the names of any other
+    Sire attributes are kept, _unpack_topol() takes them from the Morph.
+    """
+
+    state = {}
+    sire = []
+
+    for attr, value in topol.__dict__.iteritems():
+        if attr in TOPOL_SHARED:
+            continue
+
+        if hasattr(value, 'create_coords') and hasattr(value, 'atom_map'):
+            value = _pack_topol(value)
+        elif _is_sire(value):
+            sire.append(attr)
+            continue
+
+        state[attr] = value
+
+    return _PackedTopology(topol.__class__.__module__, state, sire)
+
+
+def _unpack_topol(packed, morph):
+    """
+    Recreate a PertTopology packed by _pack_topol() with the state shared
+    with morph.
+
+    :raises: SetupError
+    """
+
+    module = __import__(packed.module, globals(), locals(), ['PertTopology'])
+    topol = module.PertTopology.__new__(module.PertTopology)
+
+    for attr, value in packed.state.iteritems():
+        if isinstance(value, _PackedTopology):
+            value = _unpack_topol(value, morph)
+
+        setattr(topol, attr, value)
+
+    for attr in TOPOL_SHARED + tuple(packed.sire):
+        if not hasattr(morph, attr):
+            raise errors.SetupError('morph state of %s cannot restore %s' %
+                                    (morph.name, attr) )
+
+        setattr(topol, attr, getattr(morph, attr) )
+
+    return topol
+
+
+def type_workdir(FE_type):
+    """
+    Name of the morph directory for a free energy type.  Different types
+    may share a directory, e.g. softcore and softcore2.
+
+    :param FE_type: free energy type as given to Morph
+    :type FE_type: string
+    :returns: directory name
+    :rtype: string
+    """
+
+    FE_type = COMPAT_TABLE.get(FE_type, FE_type)
+    base_type = FE_type.split('/')[0]
+
+    # FIXME: cleanup
+    if base_type == 'Sire':
+        base_type = 'pertfile'
+
+    try:
+        type_dir = WD_TABLE[base_type]
+    except KeyError:
+        type_dir = FE_type.replace('/', '-')
+
+    # FIXME: kludge
+    return re.sub('\d$', '', type_dir)
+
 
 class Morph(object):
     """The morphing class."""
 
     def __init__(self, initial, final, workdir1, workdir2, forcefield,
                  FE_type='pertfile', separate=True, mcs_timeout=60.0,
-                 mcs_sel='', gaff='gaff'):
+                 mcs_sel='', gaff='gaff', mcs_matches=None, splice=True):
         """
         :param initial: the initial state of the morph pair
         :type initial: either Ligand or Complex
@@ -66,6 +192,11 @@ class Morph(object):
         :type FE_type: str
         :param separate: separate vdw from Coulomb lambda
         :type separate: bool
+        :param mcs_matches: precomputed MCS matches from load_mcs_matches()
+        :type mcs_matches: tuple
+        :param splice: splice the morph into the existing solvated system
+           instead of building the whole system with leap
+        :type splice: bool
         :raises: SetupError
         """
 
@@ -87,6 +218,7 @@ class Morph(object):
             self.FE_sub_type = ''
 
         self.separate = separate
+        self.splice = splice
 
         self.topdir = os.getcwd()
 
@@ -97,16 +229,8 @@ class Morph(object):
 
         self.name = initial.mol_name + const.MORPH_SEP + final.mol_name
 
-        try:
-            type_dir = WD_TABLE[self.FE_type]
-        except KeyError:
-            type_dir = FE_type.replace('/', '-')
-
-        # FIXME: kludge
-        type_dir = re.sub('\d$', '', type_dir)
-
-        self.dst = os.path.join(self.topdir, const.MORPH_WORKDIR, type_dir,
-                                self.name)
+        self.dst = os.path.join(self.topdir, const.MORPH_WORKDIR,
+                                type_workdir(FE_type), self.name)
 
         try:
             if not os.access(self.dst, os.F_OK):
@@ -142,9 +266,11 @@ class Morph(object):
         self.dummy_idx = []
 
         self.files_created = []
+        self._mapped = None
 
         self.mcs_timeout = mcs_timeout
         self.mcs_sel = mcs_sel
+        self.mcs_matches = mcs_matches
 
 
     # context manager used to keep track of directory changes
@@ -167,17 +293,69 @@ class Morph(object):
 
 
     @report
-    def setup(self, cmd1, cmd2, basedir, isotope_map={}):
+    def setup(self, cmd1, cmd2, basedir, isotope_map={}, keep_state=False):
         """
         Compute the atom mapping based on MCSS calculations.  Find dummy
         atoms. Set up parameters and connectivities for create_coord().  Create
-        coordinates and topology for vacuum case.
+        coordinates and topology for vacuum case.  The mapping is skipped for
+        morphs created with derive().
 
         *Must* be first method called to properly setup Morph object.
 
+        :param keep_state: save the resulting state with save_state()
+        :type keep_state: bool
         :raises: SetupError
         """
 
+        if self.con_morph is None:
+            self._map(basedir, isotope_map)
+
+        logger.write('\nWriting perturbed topology for %s%s\n' %
+                     (self.FE_type, '/' + self.FE_sub_type if self.FE_sub_type
+                      else '') )
+
+        topol = self._import_topol()
+
+        topol = topol.PertTopology(self.FE_sub_type, self.separate,
+                                   self.ff, self.con_morph, self.atoms_initial,
+                                   self.atoms_final, self.lig_initial,
+                                   self.lig_final, self.atom_map,
+                                   self.reverse_atom_map, self.zz_atoms,
+                                   self.gaff)
+
+        topol.setup(os.getcwd(), self.lig_morph, cmd1, cmd2)
+        self.files_created.extend(topol.files_created)
+
+        self.topol = topol
+
+        if keep_state:
+            self.save_state()
+
+
+    def _import_topol(self):
+        """Import the topology module for the free energy type."""
+
+        try:
+            topol = __import__('topol.' + self.FE_type, globals(), locals(),
+                               ['*'], -1)
+        except ImportError as detail:
+            sys.exit('Error: Unknown free energy type: %s' %
+                     self.FE_type)
+        except AttributeError as detail:
+            sys.exit('Error: %s\nFailed to properly initialize %s' %
+                     (detail, topol) )
+
+        return topol
+
+
+    def _vacuum_files(self):
+        """
+        The vacuum topology and coordinate files of both ligands.
+
+        :returns: initial parmtop, initial inpcrd, final parmtop, final inpcrd
+        :rtype: tuple of strings
+        """
+
         initial_dir = os.path.join(self.topdir, const.LIGAND_WORKDIR,
                                    self.initial.mol_name)
         final_dir = os.path.join(self.topdir, const.LIGAND_WORKDIR,
@@ -185,38 +363,26 @@ class Morph(object):
 
         system = 'vacuum'
 
-        initial_top = os.path.join(initial_dir,
-                                   system + self.initial.TOP_EXT)
-        initial_crd = os.path.join(initial_dir,
-                                   system + self.initial.RST_EXT)
-
-        final_top = os.path.join(final_dir, system + self.final.TOP_EXT)
-        final_crd = os.path.join(final_dir, system + self.final.RST_EXT)
-
-        amber = Sire.IO.Amber()
-        try:
-            molecules_initial = amber.readCrdTop(initial_crd, initial_top)[0]
-        except UserWarning as error:
-            raise errors.SetupError('error opening %s/%s: %s' %
-                                    (initial_crd, initial_top, error) )
+        return (os.path.join(initial_dir, system + self.initial.TOP_EXT),
+                os.path.join(initial_dir, system + self.initial.RST_EXT),
+                os.path.join(final_dir, system + self.final.TOP_EXT),
+                os.path.join(final_dir, system + self.final.RST_EXT) )
 
-        nmol_i = molecules_initial.molNums()
-        nmol_i.sort()
 
-        # we make the assumption that the ligand is the first mol in the
-        # top/crd
-        lig_initial = molecules_initial.at(nmol_i[0]).molecule()
+    def _map(self, basedir, isotope_map):
+        """
+        Map the initial onto the final state and create the morph molecule
+        with its connectivity and dummy coordinates.  This is independent of
+        the free energy type.
 
-        try:
-            molecules_final = amber.readCrdTop(final_crd, final_top)[0]
-        except UserWarning as error:
-            raise errors.SetupError('error opening %s/%s: %s' %
-                                    (final_crd, final_top, error) )
+        :raises: SetupError
+        """
 
-        nmol_f = molecules_final.molNums()
-        nmol_f.sort()
+        initial_top, initial_crd, final_top, final_crd = self._vacuum_files()
 
-        lig_final = molecules_final.at(nmol_f[0]).molecule()
+        # ligands are shared between all morph pairs they are part of
+        lig_initial, mol2_initial = util.load_ligand(initial_top, initial_crd)
+        lig_final, mol2_final = util.load_ligand(final_top, final_crd)
 
         # user tagging mechanism as per feature request #1074
         if not isotope_map:
@@ -228,9 +394,14 @@ class Morph(object):
         if isotope_map:
             logger.write('User supplied tagging map: %s' % isotope_map)
 
+        precomputed = util.lookup_mcs_match(self.mcs_matches,
+                                            self.initial.mol_name,
+                                            self.final.mol_name)
+
         (lig_morph, self.atom_map, self.reverse_atom_map) = \
                     util.map_atoms(lig_initial, lig_final, self.mcs_timeout,
-                                   isotope_map, self.mcs_sel)
+                                   isotope_map, self.mcs_sel, precomputed,
+                                   (mol2_initial, mol2_final) )
 
         self.files_created.append(const.MCS_MAP_FILE)
 
@@ -256,40 +427,213 @@ class Morph(object):
                                   self.reverse_atom_map, connect_final,
                                   self.zz_atoms, self.dummy_idx)
 
-        logger.write('\nWriting perturbed topology for %s%s\n' %
-                     (self.FE_type, '/' + self.FE_sub_type if self.FE_sub_type
-                      else '') )
+        self.lig_morph = lig_morph
+        self.lig_initial = lig_initial
+        self.lig_final = lig_final
+
+        self.atoms_initial = atoms_initial
+        self.atoms_final = atoms_final
+
+        self.con_morph = con_morph
+        self.connect_final = connect_final
+
+        self._keep_mapped()
+
+
+    def _keep_mapped(self):
+        """
+        create_coords() replaces the molecules, keep the mapped state for
+        derive().
+        """
+
+        self._mapped = dict( (attr, getattr(self, attr) )
+                             for attr in MAPPED_ATTRS)
+        self._mapped['zz_atoms'] = list(self.zz_atoms)
+
+
+    def save_state(self):
+        """
+        Write the state needed by create_coords() to MORPH_STATE_FILE in the
+        morph directory.  Atom maps and connectivity are stored as atom
+        indexes together with the coordinates of the morph, the Sire
+        molecules are rebuilt from the ligand files by load_state().  Failure
+        to write the state is not fatal.
+
+        *Must* run after setup().
+
+        :raises: SetupError
+        """
+
+        if not self._mapped or not self.topol:
+            raise errors.SetupError('save_state(): %s has not been set up' %
+                                    self.name)
+
+        mapped = self._mapped
+        atom_map = mapped['atom_map']
+        lig_morph = mapped['lig_morph']
+
+        index_map = dict( (i.index.value(), f.index.value() )
+                          for i, f in atom_map.iteritems()
+                          if i.atom and f.atom)
+
+        filename = os.path.join(self.dst, const.MORPH_STATE_FILE)
+
+        state = {
+            'version': STATE_VERSION,
+            'name': self.name,
+            'FE_type': self.FE_type,
+            'FE_sub_type': self.FE_sub_type,
+            'natoms': (mapped['lig_initial'].nAtoms(),
+                       mapped['lig_final'].nAtoms() ),
+            'index_map': index_map,
+            'bonds': util.bond_list(mapped['con_morph'],
+                                    lig_morph.nAtoms() ),
+            'coords': util.get_coordinates(lig_morph),
+            'zz_atoms': [str(name) for name in mapped['zz_atoms'] ],
+            'topol': _pack_topol(self.topol),
+            'files_created': self.files_created
+            }
+
+        tmp = None
 
         try:
-            topol = __import__('topol.' + self.FE_type, globals(), locals(),
-                               ['*'], -1)
-        except ImportError as detail:
-            sys.exit('Error: Unknown free energy type: %s' %
-                     self.FE_type)
-        except AttributeError as detail:
-            sys.exit('Error: %s\nFailed to properly initialize %s' %
-                     (detail, topol) )
+            fd, tmp = tempfile.mkstemp(dir=self.dst)
+
+            with os.fdopen(fd, 'wb') as pkl:
+                pickle.dump(state, pkl, pickle.HIGHEST_PROTOCOL)
+
+            os.rename(tmp, filename)
+            tmp = None
+        except (IOError, OSError, pickle.PicklingError) as why:
+            logger.write('Warning: cannot write morph state %s: %s' %
+                         (filename, why) )
+            return
+        finally:
+            if tmp:
+                try:
+                    os.remove(tmp)
+                except OSError:
+                    pass
 
-        topol = topol.PertTopology(self.FE_sub_type, self.separate,
-                                   self.ff, con_morph, atoms_initial,
-                                   atoms_final, lig_initial, lig_final,
-                                   self.atom_map, self.reverse_atom_map,
-                                   self.zz_atoms, self.gaff)
+        logger.write('Morph state written to %s' % filename)
 
-        topol.setup(os.getcwd(), lig_morph, cmd1, cmd2)
-        self.files_created.extend(topol.files_created)
 
-        self.lig_morph = lig_morph
+    def load_state(self):
+        """
+        Restore a morph from MORPH_STATE_FILE written by save_state(),
+        possibly in another process, instead of running setup().  The stored
+        atom map is applied to the current ligand files which must still
+        yield the stored connectivity.
+
+        :raises: SetupError
+        """
+
+        filename = os.path.join(self.dst, const.MORPH_STATE_FILE)
+
+        try:
+            with open(filename, 'rb') as pkl:
+                state = pickle.load(pkl)
+        except (IOError, EOFError, pickle.UnpicklingError) as why:
+            raise errors.SetupError('cannot read morph state %s: %s' %
+                                    (filename, why) )
+
+        if state.get('version') != STATE_VERSION or \
+               (state['name'], state['FE_type'], state['FE_sub_type']) != \
+               (self.name, self.FE_type, self.FE_sub_type):
+            raise errors.SetupError('morph state %s was not written for %s' %
+                                    (filename, self.name) )
+
+        logger.write('Restoring morph state from %s' % filename)
+
+        initial_top, initial_crd, final_top, final_crd = self._vacuum_files()
+
+        lig_initial, mol2_initial = util.load_ligand(initial_top, initial_crd)
+        lig_final, mol2_final = util.load_ligand(final_top, final_crd)
+
+        if (lig_initial.nAtoms(), lig_final.nAtoms() ) != state['natoms']:
+            raise errors.SetupError('ligands of %s have changed since the '
+                                    'morph state was saved' % self.name)
+
+        lig_morph, atom_map, reverse_atom_map = \
+                util.map_atoms(lig_initial, lig_final, self.mcs_timeout, {},
+                               self.mcs_sel, None, (mol2_initial, mol2_final),
+                               state['index_map'])
+
+        dummy_idx = [inf.index for inf in atom_map if not inf.atom]
+
+        atoms_initial = lig_initial.atoms()
+        atoms_final = lig_final.atoms()
+
+        lig_morph, con_morph, connect_final = \
+                util.parm_conn(lig_morph, atoms_initial, lig_initial, lig_final,
+                               atom_map, reverse_atom_map)
+
+        if util.bond_list(con_morph, lig_morph.nAtoms() ) != state['bonds']:
+            raise errors.SetupError('connectivity of %s has changed since the '
+                                    'morph state was saved' % self.name)
+
+        # dummy coordinates as computed by setup()
+        self.lig_morph = util.set_coordinates(lig_morph, state['coords'])
         self.lig_initial = lig_initial
         self.lig_final = lig_final
 
         self.atoms_initial = atoms_initial
         self.atoms_final = atoms_final
 
+        self.atom_map = atom_map
+        self.reverse_atom_map = reverse_atom_map
+        self.zz_atoms = list(state['zz_atoms'])
+
         self.con_morph = con_morph
         self.connect_final = connect_final
+        self.dummy_idx = dummy_idx
 
-        self.topol = topol
+        self._keep_mapped()
+
+        self.topol = _unpack_topol(state['topol'], self)
+        self.files_created = list(state['files_created'])
+
+
+    def derive(self, FE_type):
+        """
+        Create a morph of another free energy type which shares the atom
+        mapping, connectivities and dummy coordinates with this morph.
+        setup() of the new morph skips the mapping.
+
+        *Must* run after setup().
+
+        :param FE_type: the free energy type
+        :type FE_type: str
+        :returns: the new morph
+        :rtype: Morph
+        :raises: SetupError
+        """
+
+        if not self._mapped:
+            raise errors.SetupError('derive(): %s has not been mapped' %
+                                    self.name)
+
+        morph = Morph(self.initial, self.final, self.initial_dir,
+                      self.final_dir, self.ff, FE_type, self.separate,
+                      self.mcs_timeout, self.mcs_sel, self.gaff,
+                      self.mcs_matches, self.splice)
+
+        for attr in MAPPED_ATTRS:
+            setattr(morph, attr, self._mapped[attr])
+
+        # dummy_coords() appends to zz_atoms
+        morph.zz_atoms = list(self._mapped['zz_atoms'])
+        morph._mapped = self._mapped
+
+        for mcs_file in (const.MCS_MAP_FILE, const.MCS_MOL_FILE):
+            src = os.path.join(self.dst, mcs_file)
+
+            if os.path.isfile(src):
+                shutil.copy(src, morph.dst)
+
+        morph.files_created.append(const.MCS_MAP_FILE)
+
+        return morph
 
 
     @report
@@ -343,20 +687,43 @@ class Morph(object):
         if not crd:
             raise errors.SetupError('no suitable rst7 file found')
 
-        #system.sander_rst = crd
-        system.get_box_dims(crd)
-
+        # all morphs from the same reference system share one split
         try:
-            mols = Sire.IO.Amber().readCrdTop(crd, top)[0]
-        except UserWarning as error:
+            stamp = util.file_stamp(top, crd)
+        except OSError as error:
             raise errors.SetupError('error opening %s/%s: %s' %
                                     (crd, top, error) )
 
-        lig, rest = util.split_system(mols)
+        key = stamp[0][0], stamp[1][0]
+        env = _environments.get(key)
+        parm = None
+
+        if env and env.stamp == stamp:
+            system.box_dims = list(env.box_dims)
+        else:
+            #system.sander_rst = crd
+            system.get_box_dims(crd)
+
+            # the ligand is the first molecule of the system: take its
+            # topology from the vacuum files and only its coordinates from
+            # the full system
+            initial_top, initial_crd = self._vacuum_files()[:2]
+            lig = util.load_ligand(initial_top, initial_crd)[0]
+
+            parm = parm7.Parm7(top, crd)
+            start, end = parm.mol_atoms(0)
+            lig = util.set_coordinates(lig, parm.coords[start:end].tolist() )
+
+            env = _Environment(stamp, lig, list(system.box_dims) )
+            _environments[key] = env
+
+        lig = env.lig
 
         boxdims = [float(system.box_dims[0]), float(system.box_dims[1]),
                    float(system.box_dims[2])]
 
+        rest_top, rest_crd = top, crd
+
         if sys_rev:
             boxdims_rev = [float(sys_rev.box_dims[0]),
                            float(sys_rev.box_dims[1]),
@@ -367,17 +734,9 @@ class Morph(object):
             V_rev = reduce(V_calc, boxdims_rev)
 
             if V_rev > V:
-                crd2 = os.path.join(sys_rev_path, system.amber_crd)
-                top2 = os.path.join(sys_rev_path, system.amber_top)
-
-                try:
-                    mols2 = Sire.IO.Amber().readCrdTop(crd2, top2)[0]
-                except UserWarning as error:
-                    raise errors.SetupError('error opening %s/%s: %s' %
-                                            (crd, top, error) )
-
-                rest = util.split_system(mols2)[1]
-                crd = crd2
+                rest_crd = os.path.join(sys_rev_path, system.amber_crd)
+                rest_top = os.path.join(sys_rev_path, system.amber_top)
+                crd = rest_crd
                 boxdims = boxdims_rev
 
         if lig.nAtoms() != (len(self.atom_map) - len(self.dummy_idx) ):
@@ -388,54 +747,20 @@ class Morph(object):
 
         atoms_initial = lig.atoms()
 
-        # not using
-        # Sire.IO.PDB().write(rest, REST_PDB_NAME)
-        # because out of order and creates CONECTs for atoms > 99999
-        # also: we can't use const.NOT_FIRST_PDB because leap has the strange
-        # habit of centering a file saved with "savepdb" such that the origin
-        # is in the center contrary to the prmtop which has it in one box
-        # corner unless "set default nocenter on" is used (and coordinates
-        # stay unmodified)
-        with open(REST_PDB_NAME, 'w') as pdb:
-            moln = rest.molNums()
-            moln.sort()
-
-            serial = 0
-            resSeq = 0
-
-            pdb.write('REMARK   Created with FESetup\n')
-
-            # pseudo-PDB for leap
-            for i in moln:
-                mol = rest.at(i).molecule()
-                ridx_old = -9999
-
-                for atom in mol.atoms():
-                    serial = (serial % 99999) + 1
-                    atom_name = str(atom.name().value() )
-                    resName =  atom.residue().name().value()
-                    ridx = atom.residue().index().value()
-                    coords = atom.property('coordinates')  # Math.Vector
-                    x = coords.x()
-                    y = coords.y()
-                    z = coords.z()
-                    elem = str(atom.property('element').symbol() )
-
-                    if len(atom_name) < 4:
-                        atom_name = ' %-3s' % atom_name
+        # the rest of the system is sliced straight from the parmtop/inpcrd
+        # arrays, see util.write_rest_pdb() for why we write our own PDB
+        rest_stamp = util.file_stamp(rest_top, rest_crd)
+        rest_pdb = env.rest_pdbs.get(rest_stamp)
 
-                    if ridx != ridx_old:
-                        resSeq = (resSeq % 9999) + 1
-                        ridx_old = ridx
-
-                    pdb.write('ATOM  %5i %4s %-3s  %4i    %8.3f%8.3f%8.3f'
-                              '                      %2s\n' %
-                              (serial, atom_name, resName, resSeq, x, y, z,
-                               elem) )
-
-                pdb.write('TER\n')
+        if rest_pdb and os.path.isfile(rest_pdb):
+            if os.path.abspath(REST_PDB_NAME) != rest_pdb:
+                shutil.copyfile(rest_pdb, REST_PDB_NAME)
+        else:
+            if parm is None or rest_stamp != stamp:
+                parm = parm7.Parm7(rest_top, rest_crd)
 
-            pdb.write('END\n')
+            util.write_rest_pdb(parm, REST_PDB_NAME)
+            env.rest_pdbs[rest_stamp] = os.path.abspath(REST_PDB_NAME)
 
 
         self.lig_morph = self.lig_morph.edit()
@@ -467,7 +792,13 @@ class Morph(object):
 
         boxdims.extend((90.0, 90.0, 90.0))
 
+        if self.splice:
+            rest = (os.path.abspath(rest_top), os.path.abspath(rest_crd) )
+        else:
+            rest = None
+
         self.topol.create_coords(curr_dir, workdir, self.lig_morph,
-                                 REST_PDB_NAME, system, cmd1, cmd2, boxdims)
+                                 REST_PDB_NAME, system, cmd1, cmd2, boxdims,
+                                 rest)
 
         os.chdir(curr_dir)
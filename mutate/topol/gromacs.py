@@ -267,13 +267,13 @@ class PertTopology(object):
 
 
     def create_coords(self, curr_dir, dir_name, lig_morph, pdb_file, system,
-                      cmd1, cmd2, boxdims):
+                      cmd1, cmd2, boxdims, rest=None):
         """
         Create only topology file but not GRO coordinates.
         """
 
         self.topol.create_coords(curr_dir, dir_name, lig_morph, pdb_file,
-                                 system, cmd1, cmd2, boxdims)
+                                 system, cmd1, cmd2, boxdims, rest)
 
         if self.FE_sub_type == 'dummy':
             # FIXME: ugly kludge, assuming the file is one level up
@@ -32,11 +32,11 @@ import Sire.Mol
 import Sire.MM
 import Sire.Units
 
-from parmed.amber.readparm import AmberParm
 from parmed.tools import change
 
 from FESetup import const, errors, logger
 from FESetup.mutate import util
+from FESetup.prepare.amber import topcache
 
 
 
@@ -193,7 +193,7 @@ class PertTopology(object):
                       self.lig_final, self.atom_map)
 
     def create_coords(self, curr_dir, dir_name, lig_morph, pdb_file, system,
-                      cmd1, cmd2, boxdims):
+                      cmd1, cmd2, boxdims, rest=None):
         """
         """
 
@@ -209,7 +209,7 @@ class PertTopology(object):
         com.frcmod = self.frcmod
         com.ligand_fmt = 'mol2'
         com.prepare_top(gaff=self.gaff)
-        com.create_top(boxtype='set', addcmd=cmd1 + cmd2)
+        util.create_complex_top(com, rest, cmd1 + cmd2)
 
         # FIXME: we do that already in setup but calling create_coords
         #        from morph.py has not picked up on this
@@ -241,7 +241,8 @@ def patch_element(parmtop, lig_morph, lig_initial, lig_final, atom_map):
     :type atom_map: dict of_AtomInfo to _AtomInfo 
      """
 
-    parm = AmberParm(parmtop)
+    parm = topcache.get_parm(parmtop)
+    topcache.forget(parmtop)
 
     for matom in lig_morph.atoms():
         idx = matom.index().value()
@@ -251,7 +251,7 @@ class PertTopology(object):
 
 
     def create_coords(self, curr_dir, dir_name, lig_morph, pdb_file, system,
-                      cmd1, cmd2, boxdims):
+                      cmd1, cmd2, boxdims, rest=None):
 
         patch_parms = []
 
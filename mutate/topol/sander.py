@@ -228,7 +228,7 @@ class PertTopology(object):
 
 
     def create_coords(self, curr_dir, dir_name, lig_morph, pdb_file, system,
-                      cmd1, cmd2, boxdims):
+                      cmd1, cmd2, boxdims, rest=None):
 
         if self.FE_sub_type[:8] == 'softcore':
             state0, state1 = \
@@ -268,7 +268,7 @@ class PertTopology(object):
         else:
             com0.prepare_top(gaff=self.gaff)
 
-        com0.create_top(boxtype='set', addcmd=cmd1 + cmd2)
+        util.create_complex_top(com0, rest, cmd1 + cmd2)
 
         mol2_1 = os.path.join(curr_dir, const.MORPH_NAME + '1' +
                               const.MOL2_EXT)
@@ -286,7 +286,7 @@ class PertTopology(object):
         else:
             com1.prepare_top(gaff=self.gaff)
 
-        com1.create_top(boxtype='set', addcmd=cmd1 + cmd2)
+        util.create_complex_top(com1, rest, cmd1 + cmd2)
 
         if self.FE_sub_type == 'softcore2' or self.FE_sub_type == 'dummy2':
             ow_add = '_int'
@@ -308,7 +308,7 @@ class PertTopology(object):
             com.frcmod = self.frcmod1
             com._parm_overwrite = 'state_int'
             com.prepare_top(add_frcmods=[self.frcmod0])
-            com.create_top(boxtype='set', addcmd=cmd1 + cmd2)
+            util.create_complex_top(com, rest, cmd1 + cmd2)
 
         if self.FE_sub_type == 'dummy' or self.FE_sub_type == 'dummy2':
             top0 = com0._parm_overwrite + com0.TOP_EXT
@@ -339,7 +339,7 @@ class PertTopology(object):
             else:
                 com.prepare_top(gaff=self.gaff)
 
-            com.create_top(boxtype='set')
+            util.create_complex_top(com, rest)
 
             top0 = com0._parm_overwrite + com0.TOP_EXT
             int_name = com._parm_overwrite + com.TOP_EXT
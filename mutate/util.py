@@ -42,21 +42,29 @@ from rdkit import rdBase
 
 import numpy as np
 
+import Sire.IO
 import Sire.Mol
 import Sire.MM
 import Sire.Units
 import Sire.Maths
 
 # parmed 2.4.0 from AMBER16
-from parmed.amber.mask import AmberMask
-from parmed.amber.readparm import AmberParm
 import parmed.tools.actions as Action
 
 from FESetup import const, errors, logger
+from FESetup.cheapmap import atom_signature
+from FESetup.prepare.amber import topcache
 
 from FESetup.munkres import Munkres, print_matrix
 
 
+# loaded ligands, parsed MOL2 strings and MCSS index maps shared between
+# morph pairs
+_ligands = {}
+_rdmols = {}
+_index_maps = {}
+
+
 class _AtomInfo(object):
     """Simple struct to store Atom info."""
 
@@ -229,6 +237,33 @@ else:
                    ringMatchesRingOnly = True, completeRingsOnly = True,
                    threshold = None)
 
+def _mol_from_mol2(mol2str):
+    """
+    Parse a MOL2 string with RDKit without sanitisation and hydrogen removal.
+    Parsed molecules are memoised, the caller gets a private copy.
+
+    :param mol2str: MOL2 string
+    :type mol2str: string
+    :returns: the molecule or None if parsing failed
+    :rtype: rdkit.Chem.Mol
+    """
+
+    if mol2str not in _rdmols:
+        # disable warning about no explicit hydrogens
+        rdBase.DisableLog('rdApp.warning')
+        _rdmols[mol2str] = rdkit.Chem.MolFromMol2Block(mol2str,
+                                                       sanitize = False,
+                                                       removeHs = False)
+        rdBase.EnableLog('rdApp.warning')
+
+    mol = _rdmols[mol2str]
+
+    if mol is None:
+        return None
+
+    return rdkit.Chem.Mol(mol)
+
+
 def mcss(mol2str_1, mol2str_2, maxtime=60, isotope_map=None, selec=''):
     """
     Maximum common substructure search via RDKit/fmcs.
@@ -248,13 +283,8 @@ def mcss(mol2str_1, mol2str_2, maxtime=60, isotope_map=None, selec=''):
     :rtype: dict
     """
 
-    # disable warning about no explicit hydrogens
-    rdBase.DisableLog('rdApp.warning')
-    mol1 = rdkit.Chem.MolFromMol2Block(mol2str_1, sanitize = False,
-                                       removeHs = False)
-    mol2 = rdkit.Chem.MolFromMol2Block(mol2str_2, sanitize = False,
-                                       removeHs = False)
-    rdBase.EnableLog('rdApp.warning')
+    mol1 = _mol_from_mol2(mol2str_1)
+    mol2 = _mol_from_mol2(mol2str_2)
 
     _params.update(timeout = int(maxtime) )
 
@@ -333,21 +363,6 @@ def mcss(mol2str_1, mol2str_2, maxtime=60, isotope_map=None, selec=''):
 
     p = rdkit.Chem.MolFromSmarts(smarts)
 
-    conv = ob.OBConversion()
-    conv.SetInAndOutFormats('mol2', 'mol2')
-
-    # NOTE: this relies on a modified Openbabel MOL2 writer
-    conv.AddOption('r', ob.OBConversion.OUTOPTIONS)  # do not append resnum
-
-    obmol1 = ob.OBMol()
-
-    errlev = ob.obErrorLog.GetOutputLevel()
-    ob.obErrorLog.SetOutputLevel(0)
-
-    conv.ReadString(obmol1, mol2str_1)
-
-    ob.obErrorLog.SetOutputLevel(errlev)
-
     # NOTE: experimental!
     if selec == 'spatially-closest':
         m1 = mol1.GetSubstructMatches(p, uniquify=False, maxMatches=100, useChirality=False)
@@ -466,6 +481,36 @@ def mcss(mol2str_1, mol2str_2, maxtime=60, isotope_map=None, selec=''):
         mapping = {k: v for k, v in mapping.items() if v not in delete_values}
 
 
+    _write_mcs_files(mol2str_1, mapping)
+
+    return mapping
+
+
+def _write_mcs_files(mol2str_1, mapping):
+    """
+    Write the MCS as MOL2 file and the index map as pickle file.
+
+    :param mol2str_1: first MOL2 string
+    :type mol2str_1: string
+    :param mapping: index map
+    :type mapping: dict
+    """
+
+    conv = ob.OBConversion()
+    conv.SetInAndOutFormats('mol2', 'mol2')
+
+    # NOTE: this relies on a modified Openbabel MOL2 writer
+    conv.AddOption('r', ob.OBConversion.OUTOPTIONS)  # do not append resnum
+
+    obmol1 = ob.OBMol()
+
+    errlev = ob.obErrorLog.GetOutputLevel()
+    ob.obErrorLog.SetOutputLevel(0)
+
+    conv.ReadString(obmol1, mol2str_1)
+
+    ob.obErrorLog.SetOutputLevel(errlev)
+
     delete_atoms = []
 
     for atom in ob.OBMolAtomIter(obmol1):
@@ -487,9 +532,237 @@ def mcss(mol2str_1, mol2str_2, maxtime=60, isotope_map=None, selec=''):
         pickle.dump(mapping.keys(), pkl, 0)
         pickle.dump(mapping.values(), pkl, 0)
 
+
+def load_mcs_matches(filename):
+    """
+    Read the per-pair MCS atom matches stored by cheapmap.
+
+    :param filename: name of the cheapmap match file
+    :type filename: string
+    :raises: SetupError
+    :returns: atom signatures by molecule name, atom matches by name pair
+    :rtype: dict, dict
+    """
+
+    try:
+        with open(filename, 'rb') as pkl:
+            signatures = pickle.load(pkl)
+            matches = pickle.load(pkl)
+    except (IOError, EOFError, pickle.UnpicklingError) as why:
+        raise errors.SetupError('cannot read MCS match file %s: %s' %
+                                (filename, why) )
+
+    return signatures, matches
+
+
+def lookup_mcs_match(mcs_matches, name1, name2):
+    """
+    Find the stored MCS atom match for a morph pair.  Pairs were computed
+    for one direction only, so the reverse direction is the inverted match.
+
+    :param mcs_matches: signatures and matches from load_mcs_matches()
+    :type mcs_matches: tuple
+    :param name1: name of the initial state molecule
+    :type name1: string
+    :param name2: name of the final state molecule
+    :type name2: string
+    :returns: signature of name1, signature of name2, index pairs or None
+    :rtype: tuple
+    """
+
+    if not mcs_matches:
+        return None
+
+    signatures, matches = mcs_matches
+
+    if name1 not in signatures or name2 not in signatures:
+        return None
+
+    if (name1, name2) in matches:
+        pairs = matches[name1, name2]
+    elif (name2, name1) in matches:
+        pairs = [(j, i) for i, j in matches[name2, name1] ]
+    else:
+        return None
+
+    return signatures[name1], signatures[name2], pairs
+
+
+def _precomputed_mcss(mol2str_1, mol2str_2, precomputed):
+    """
+    Use a precomputed MCS atom match if the atom ordering of both molecules
+    is the same as the one the match was computed for.
+
+    :param mol2str_1: first MOL2 string
+    :type mol2str_1: string
+    :param mol2str_2: second MOL2 string
+    :type mol2str_2: string
+    :param precomputed: signatures and index pairs from lookup_mcs_match()
+    :type precomputed: tuple
+    :returns: index map or None if the match cannot be used
+    :rtype: dict
+    """
+
+    sig1, sig2, pairs = precomputed
+
+    mol1 = _mol_from_mol2(mol2str_1)
+    mol2 = _mol_from_mol2(mol2str_2)
+
+    if atom_signature(mol1) != sig1 or atom_signature(mol2) != sig2:
+        logger.write('Warning: atom order differs from precomputed MCS '
+                     'match, rerunning MCSS')
+        return None
+
+    if not pairs:
+        return None
+
+    mapping = dict(pairs)
+
+    logger.write('Using precomputed MCS match (%i atoms)' % len(mapping) )
+
+    _write_mcs_files(mol2str_1, mapping)
+
     return mapping
 
 
+def file_stamp(*filenames):
+    """
+    Identify the current version of files by absolute path, size and
+    modification time.
+
+    :param filenames: the files
+    :type filenames: strings
+    :returns: one (path, size, mtime) tuple per file
+    :rtype: tuple
+    :raises: OSError
+    """
+
+    stamp = []
+
+    for filename in filenames:
+        stat = os.stat(filename)
+        stamp.append( (os.path.abspath(filename), stat.st_size,
+                       stat.st_mtime) )
+
+    return tuple(stamp)
+
+
+def load_ligand(parmtop, inpcrd):
+    """
+    Load the ligand, the first molecule, from an AMBER parmtop/inpcrd pair
+    and create the MOL2 string used for the MCSS.  Ligands are cached for the
+    lifetime of the process and reloaded only when the files change.
+
+    :param parmtop: parmtop file name
+    :type parmtop: string
+    :param inpcrd: inpcrd file name
+    :type inpcrd: string
+    :returns: ligand, MOL2 string with elements as atom types
+    :rtype: Sire.Mol.Molecule, string
+    :raises: SetupError
+    """
+
+    try:
+        stamp = file_stamp(parmtop, inpcrd)
+    except OSError as error:
+        raise errors.SetupError('error opening %s/%s: %s' %
+                                (inpcrd, parmtop, error) )
+
+    key = stamp[0][0], stamp[1][0]
+
+    if key in _ligands and _ligands[key][0] == stamp:
+        return _ligands[key][1:]
+
+    try:
+        mols = Sire.IO.Amber().readCrdTop(inpcrd, parmtop)[0]
+    except UserWarning as error:
+        raise errors.SetupError('error opening %s/%s: %s' %
+                                (inpcrd, parmtop, error) )
+
+    # we make the assumption that the ligand is the first mol in the top/crd
+    lig = split_system(mols)[0]
+
+    # make all atoms carbons to ensure consideration of hydrogens in MCSS
+    mol2str = write_mol2(lig, notypes = True)
+
+    _ligands[key] = (stamp, lig, mol2str)
+
+    return lig, mol2str
+
+
+def bond_list(connectivity, natoms):
+    """
+    Bonds of a connectivity as pairs of atom indexes.
+
+    :param connectivity: the connectivity
+    :type connectivity: Sire.Mol.Connectivity
+    :param natoms: number of atoms in the molecule
+    :type natoms: int
+    :returns: sorted list of bonded atom index pairs
+    :rtype: list of tuples of two ints
+    """
+
+    bonds = []
+
+    for i in range(natoms):
+        for idx in connectivity.connectionsTo(Sire.Mol.AtomIdx(i) ):
+            j = idx.value()
+
+            if i < j:
+                bonds.append( (i, j) )
+
+    bonds.sort()
+
+    return bonds
+
+
+def get_coordinates(mol):
+    """
+    Atom coordinates of a molecule in plain Python form.
+
+    :param mol: the molecule
+    :type mol: Sire.Mol.Molecule
+    :returns: coordinates in atom index order
+    :rtype: list of tuples of three floats
+    """
+
+    coords = []
+
+    for atom in mol.atoms():
+        vec = atom.property('coordinates')
+        coords.append( (vec.x(), vec.y(), vec.z() ) )
+
+    return coords
+
+
+def set_coordinates(mol, coords):
+    """
+    Set the atom coordinates of a molecule.
+
+    :param mol: the molecule
+    :type mol: Sire.Mol.Molecule
+    :param coords: coordinates in atom index order as from get_coordinates()
+    :type coords: list of tuples of three floats
+    :returns: the molecule with the new coordinates
+    :rtype: Sire.Mol.Molecule
+    :raises: SetupError
+    """
+
+    if mol.nAtoms() != len(coords):
+        raise errors.SetupError('number of coordinates (%i) does not match '
+                                'number of atoms (%i)' %
+                                (len(coords), mol.nAtoms() ) )
+
+    mol = mol.edit()
+
+    for i, xyz in enumerate(coords):
+        new = mol.atom(Sire.Mol.AtomIdx(i) )
+        new.setProperty('coordinates', Sire.Maths.Vector(*xyz) )
+        mol = new.molecule()
+
+    return mol.commit()
+
+
 def split_system(mols):
     """Create new Sire molecule with first residue (=ligand) deleted.
 
@@ -510,8 +783,79 @@ def split_system(mols):
     return lig, rest
 
 
+def write_rest_pdb(parm, filename):
+    """
+    Write all molecules but the first (=ligand) of a system as pseudo-PDB
+    file for leap.  Atoms are written in topology order with a TER record
+    after every molecule.
+
+    We don't use leap's savepdb because it centres the coordinates unless
+    "set default nocenter on" is used.  Sire.IO.PDB writes out of order and
+    creates CONECTs for atoms > 99999.
+
+    :param parm: the system with coordinates
+    :type parm: parm7.Parm7
+    :param filename: name of the PDB file
+    :type filename: string
+    """
+
+    start = parm.mol_start[1]
+    natoms = parm.natoms - start
+
+    serials = np.arange(natoms) % 99999 + 1
+
+    ridx = parm.res_index[start:]
+    new_res = np.ones(natoms, dtype=bool)
+    new_res[1:] = ridx[1:] != ridx[:-1]
+    res_seqs = (np.cumsum(new_res) - 1) % 9999 + 1
+
+    names = [' %-3s' % name if len(name) < 4 else name
+             for name in parm.names[start:] ]
+
+    atoms = ['ATOM  %5i %4s %-3s  %4i    %8.3f%8.3f%8.3f'
+             '                      %2s\n' % rec
+             for rec in zip(serials.tolist(), names,
+                            parm.res_names[ridx].tolist(), res_seqs.tolist(),
+                            parm.coords[start:, 0].tolist(),
+                            parm.coords[start:, 1].tolist(),
+                            parm.coords[start:, 2].tolist(),
+                            parm.elements[start:].tolist() ) ]
+
+    mol_start = parm.mol_start[1:] - start
+
+    with open(filename, 'w') as pdb:
+        pdb.write('REMARK   Created with FESetup\n')
+
+        for first, last in zip(mol_start[:-1], mol_start[1:]):
+            pdb.writelines(atoms[first:last])
+            pdb.write('TER\n')
+
+        pdb.write('END\n')
+
+
+def create_complex_top(com, rest=None, addcmd=''):
+    """
+    Create the topology of a solvated morph system.  The morph is spliced
+    into the existing solvated system if given, otherwise the whole system
+    is built with leap.
+
+    :param com: the system with the morph added through prepare_top()
+    :type com: Complex
+    :param rest: parmtop and inpcrd of the existing solvated system
+    :type rest: tuple of two strings or None
+    :param addcmd: additional leap commands for the full build
+    :type addcmd: string
+    """
+
+    if rest:
+        com.splice_top(*rest)
+    else:
+        com.create_top(boxtype='set', addcmd=addcmd)
+
+
 def map_atoms(lig_initial, lig_final, timeout, isotope_map = None,
-              mcs_sel = ''):
+              mcs_sel = '', precomputed = None, mol2strs = None,
+              index_map = None):
     """
     Compute the atom mapping between initial and final state using MCSS.
     Creates lig_morph, appends to atom_map and reverse_atom_map.
@@ -528,6 +872,16 @@ def map_atoms(lig_initial, lig_final, timeout, isotope_map = None,
     :type timeout: float
     :param isotope_map: explicit user atom mapping
     :type isotope_map: dict
+    :param mcs_sel: selection method for multiple MCS
+    :type mcs_sel: string
+    :param precomputed: MCS match from lookup_mcs_match(), only used when
+       neither isotope_map nor mcs_sel are given
+    :type precomputed: tuple
+    :param mol2strs: MOL2 strings of both states from load_ligand()
+    :type mol2strs: tuple of two strings
+    :param index_map: a previously computed atom index map e.g. from a saved
+       morph state, skips the MCSS
+    :type index_map: dict of int to int
     :raises: SetupError
     :returns: morph molecule, forward map, reverse map
     :rtype: Sire.Mol.CutGroup, OrderedDict of Sire.Mol.AtomName to
@@ -536,11 +890,16 @@ def map_atoms(lig_initial, lig_final, timeout, isotope_map = None,
 
     # make all atoms carbons to ensure consideration of hydrogens in MCSS
     # backend code (RDKit) is not able to deal with GAFF types anyway
-    mol1 = write_mol2(lig_initial, notypes = True)
-    mol2 = write_mol2(lig_final, notypes = True)
+    if mol2strs:
+        mol1, mol2 = mol2strs
+    else:
+        mol1 = write_mol2(lig_initial, notypes = True)
+        mol2 = write_mol2(lig_final, notypes = True)
 
     # JM 10/16
-    if (mcs_sel == 'shapealign' and len(isotope_map) > 0):
+    if index_map:
+        logger.write('Using stored atom map (%i atoms)' % len(index_map) )
+    elif (mcs_sel == 'shapealign' and len(isotope_map) > 0):
         logger.write("user provided mappings override shape align mode")
     elif mcs_sel == 'shapealign':
         logger.write("Will map atoms using shape align mode")
@@ -626,11 +985,30 @@ def map_atoms(lig_initial, lig_final, timeout, isotope_map = None,
     #print (isotope_map)
     #import pdb ; pdb.set_trace()
     #sys.exit(-1)
-    index_map = mcss(mol1, mol2, timeout, isotope_map, mcs_sel)
+
+    # user maps are specific to the direction of the morph
+    if not index_map and not isotope_map and \
+           (mol2, mol1, mcs_sel) in _index_maps:
+        index_map = dict( (j, i) for i, j in
+                          _index_maps[mol2, mol1, mcs_sel].iteritems() )
+
+        logger.write('Using inverted atom map of reverse morph (%i atoms)' %
+                     len(index_map) )
+
+        _write_mcs_files(mol1, index_map)
+
+    if not index_map and precomputed and not isotope_map and not mcs_sel:
+        index_map = _precomputed_mcss(mol1, mol2, precomputed)
+
+    if not index_map:
+        index_map = mcss(mol1, mol2, timeout, isotope_map, mcs_sel)
 
     if not index_map:
         raise errors.SetupError('MCSS error')
 
+    if not isotope_map:
+        _index_maps[mol1, mol2, mcs_sel] = dict(index_map)
+
 
     # NOTE: lig_morph = Sire.Mol.Molecule(lig_initial) would create a new
     #       molecule including all properties, but in adding new atoms below
@@ -1209,8 +1587,8 @@ def patch_parmtop(parm0_fn, parm1_fn, mask0, mask1, copy_dih=True):
     """
 
     if parm1_fn != '':
-        parm0 = AmberParm(parm0_fn)
-        parm1 = AmberParm(parm1_fn)
+        parm0 = topcache.get_parm(parm0_fn)
+        parm1 = topcache.get_parm(parm1_fn)
 
         if not const.DUMMY_TYPE in parm0.parm_data['AMBER_ATOM_TYPE'] and \
                not const.DUMMY_TYPE in parm1.parm_data['AMBER_ATOM_TYPE']:
@@ -1223,12 +1601,12 @@ def patch_parmtop(parm0_fn, parm1_fn, mask0, mask1, copy_dih=True):
                      (parm0_fn, parm1_fn, mask0) )
 
         mask_str = mask0
-        idx_list = [i for i in AmberMask(parm0, mask_str).Selected()]
+        idx_list = topcache.mask_indexes(parm0_fn, mask_str).tolist()
         idx_list2 = idx_list
 
         pmemd = False
     else:
-        parm0 = AmberParm(parm0_fn)
+        parm0 = topcache.get_parm(parm0_fn)
         parm1 = parm0
 
         logger.write('Patching parmtop %s with masks %s, %s\n' %
@@ -1236,11 +1614,18 @@ def patch_parmtop(parm0_fn, parm1_fn, mask0, mask1, copy_dih=True):
 
         mask_str0 = mask0
         mask_str1 = mask1
-        idx_list =  [i for i in AmberMask(parm0, mask_str0).Selected()]
-        idx_list2 = [i for i in AmberMask(parm0, mask_str1).Selected()]
+        idx_list =  topcache.mask_indexes(parm0_fn, mask_str0).tolist()
+        idx_list2 = topcache.mask_indexes(parm0_fn, mask_str1).tolist()
 
         pmemd = True
 
+    # the cached topologies are modified from here on
+    topcache.forget(parm0_fn)
+    topcache.forget(parm1_fn or parm0_fn)
+
+    idx_set = set(idx_list)
+    idx_set2 = set(idx_list2)
+
     atn0 = parm0.parm_data['ATOMIC_NUMBER']
     atn1 = parm1.parm_data['ATOMIC_NUMBER']
 
@@ -1266,14 +1651,14 @@ def patch_parmtop(parm0_fn, parm1_fn, mask0, mask1, copy_dih=True):
         idx1 = b0.atom1.idx
         idx2 = b0.atom2.idx
 
-        if idx1 not in idx_list or idx2 not in idx_list:
+        if idx1 not in idx_set or idx2 not in idx_set:
             continue
 
         for b1 in itertools.chain(parm1.bonds_inc_h, parm1.bonds_without_h):
             i1 = b1.atom1.idx
             i2 = b1.atom2.idx
 
-            if i1 not in idx_list2 or i2 not in idx_list2:
+            if i1 not in idx_set2 or i2 not in idx_set2:
                 continue
 
             if (idx1+offset, idx2+offset) == (i1, i2) or \
@@ -1304,7 +1689,7 @@ def patch_parmtop(parm0_fn, parm1_fn, mask0, mask1, copy_dih=True):
         idx2 = a0.atom2.idx
         idx3 = a0.atom3.idx
 
-        if idx1 not in idx_list or idx2 not in idx_list or idx3 not in idx_list:
+        if idx1 not in idx_set or idx2 not in idx_set or idx3 not in idx_set:
             continue
 
         for a1 in itertools.chain(parm1.angles_inc_h, parm1.angles_without_h):
@@ -1312,7 +1697,7 @@ def patch_parmtop(parm0_fn, parm1_fn, mask0, mask1, copy_dih=True):
             i2 = a1.atom2.idx
             i3 = a1.atom3.idx
 
-            if i1 not in idx_list2 or i2 not in idx_list2 or i3 not in idx_list2:
+            if i1 not in idx_set2 or i2 not in idx_set2 or i3 not in idx_set2:
                 continue
 
             if (idx1+offset, idx2+offset, idx3+offset) == (i1, i2, i3) or \
@@ -1349,8 +1734,8 @@ def patch_parmtop(parm0_fn, parm1_fn, mask0, mask1, copy_dih=True):
     dihedrals1 = itertools.chain(parm1.dihedrals_inc_h,
                                  parm1.dihedrals_without_h)
 
-    propers0, impropers0 = _get_dihedrals(dihedrals0, idx_list)
-    propers1, impropers1 = _get_dihedrals(dihedrals1, idx_list2)
+    propers0, impropers0 = _get_dihedrals(dihedrals0, idx_set)
+    propers1, impropers1 = _get_dihedrals(dihedrals1, idx_set2)
 
     propers_coll0 = defaultdict(list)
     propers_coll1 = defaultdict(list)
@@ -27,11 +27,12 @@ __revision__ = "$Id$"
 
 
 import os, math
+from collections import OrderedDict
 
-import Sire.IO
-import Sire.MM
+import numpy as np
 
-from FESetup import const, errors, logger
+import parm7
+from FESetup import const, logger
 
 
 
@@ -141,221 +142,130 @@ class CharmmTop(object):
         :raises: SetupError
         """
 
-        amber = Sire.IO.Amber()
+        parm = parm7.Parm7(parmtop, inpcrd)
 
-        try:
-            # (Sire.Mol.Molecules,  Sire.Vol.PeriodicBox or Sire.Vol.Cartesian)
-            mols, perbox = amber.readCrdTop(inpcrd, parmtop)
-        except UserWarning as error:
-            raise errors.SetupError('error opening %s/%s' % (parmtop, inpcrd) )
-
-        try:
-            dims = perbox.dimensions() # Sire.Maths.Vector
+        box = parm.box_dims
 
-            x = dims.x()
-            y = dims.y()
-            z = dims.z()
-        except:                         # FIXME: which exception?
+        if box:
+            x, y, z = box
+        else:
             x, y, z = 0.0, 0.0, 0.0
 
         self.box_dims = x, y, z
 
-        mol_numbers = mols.molNums()
-        mol_numbers.sort()
-
-        self.tot_natoms = sum(mols.at(num).molecule().nAtoms()
-                              for num in mol_numbers)
-
-        segcnt = -1
-        atomno = 0
-        offset = 0
-
-        for num in mol_numbers:
-            mol = mols.at(num).molecule()
-            natoms = mol.nAtoms()
-            segcnt += 1
-            is_atom = False
-
-            try:
-                params = mol.property('amberparameters')
-            except UserWarning:
-                # FIXME: adjust segcnt?
-                is_atom = True
-
-            for atom in mol.atoms():
-                atomno += 1
-                residue = atom.residue()
-                resno = residue.number().value()
-                res = str(residue.name().value() )
-                atom_type = str(atom.name().value() )
-                amber_type = str(atom.property('ambertype') )
-                resid = str(resno)  # FIXME
-                charge = atom.property('charge').value()
-                mass = atom.property('mass').value()
-                lj = atom.property('LJ')
-                coords = atom.property('coordinates')
-
-                # FIXME: water name, large segments, segid overflow
-                if residue.name().value() == 'WAT':
-                    segid = 'WATER'
-                    res = 'TIP3'
-                else:
-                    if not is_atom:
-                        # FIXME: max is 475253
-                        segid = '{:A>4s}'.format(_makeseg(segcnt))
-                    else:
-                        if charge != 0.0:
-                            segid = 'ION'
-                        else:
-                            segid = 'ATOM'
-
-                amber_type = _check_type(amber_type, self.atomtypes, atomno-1)
-
-                self.atoms.append( (atomno, resno, segid, resid, res, atom_type,
-                                    amber_type, charge, mass, coords) )
-                self.atom_params[amber_type] = (mass, lj)
-
-            # IMPORTANT: do not forget to increase offset because all
-            #            indices below are relative within each molecule!
-            if is_atom:
-                offset += 1
-                continue
-
-            for bond in params.getAllBonds():  # Sire.Mol.BondID
-                at0 = bond.atom0()  # Sire.Mol.AtomIdx!
-                at1 = bond.atom1()
-                k, r = params.getParams(bond)
-
-                idx0 = at0.value()
-                idx1 = at1.value()
-
-                t0 = str(mol.select(at0).property('ambertype'))
-                t1 = str(mol.select(at1).property('ambertype'))
- 
-                name0 = _check_type(t0, self.atomtypes, idx0)
-                name1 = _check_type(t1, self.atomtypes, idx1)
-
-                self.bonds.append( (at0.value() + 1 + offset,
-                                    at1.value() + 1 + offset) )
-                self.bond_params[name0, name1] = (k, r)
-
-            self.bonds.sort()
-
-            for angle in params.getAllAngles():  # Sire.Mol.AngleID
-                at0 = angle.atom0()  # Sire.Mol.AtomIdx!
-                at1 = angle.atom1()
-                at2 = angle.atom2()
-                k, theta = params.getParams(angle)
+        self.tot_natoms = parm.natoms
 
-                idx0 = at0.value()
-                idx1 = at1.value()
-                idx2 = at2.value()
+        moltypes = parm.molecule_types()
 
-                t0 = str(mol.select(at0).property('ambertype'))
-                t1 = str(mol.select(at1).property('ambertype'))
-                t2 = str(mol.select(at2).property('ambertype'))
+        templates = [mt.template for mt in moltypes]
 
-                name0 = _check_type(t0, self.atomtypes, idx0)
-                name1 = _check_type(t1, self.atomtypes, idx1)
-                name2 = _check_type(t2, self.atomtypes, idx2)
+        # NOTE: only dummy types depend on the atom index
+        checked = dict( (t, _check_type(t) ) for t in set(parm.types) )
+        amber_types = [_check_type(t, self.atomtypes, i) if t == 'du'
+                       else checked[t] for i, t in enumerate(parm.types)]
 
-                self.angles.append( (at0.value() + 1 + offset,
-                                     at1.value() + 1 + offset,
-                                     at2.value() + 1 + offset) )
-                self.angle_params[name0, name1, name2] = (k, theta * const.RAD2DEG)
+        # NOTE: types for the bonded parameters are looked up with the index
+        #       relative to the molecule
+        names = {}
 
-            self.angles.sort()
+        for imol in templates:
+            start, end = parm.mol_atoms(imol)
 
-            for dihedral in params.getAllDihedrals(): # Sire.Mol.DihedralID
-                at0 = dihedral.atom0()  # Sire.Mol.AtomIdx!
-                at1 = dihedral.atom1()
-                at2 = dihedral.atom2()
-                at3 = dihedral.atom3()
+            for i in range(start, end):
+                names[i] = _check_type(parm.types[i], self.atomtypes,
+                                       i - start)
 
-                idx0 = at0.value()
-                idx1 = at1.value()
-                idx2 = at2.value()
-                idx3 = at3.value()
+        # single atoms (ions) have no bonded terms
+        is_atom = np.array([not len(parm.mol_terms(mt.template, parm.bonds) )
+                            for mt in moltypes])[parm.mol_type]
 
-                t0 = str(mol.select(at0).property('ambertype'))
-                t1 = str(mol.select(at1).property('ambertype'))
-                t2 = str(mol.select(at2).property('ambertype'))
-                t3 = str(mol.select(at3).property('ambertype'))
+        resnames = parm.res_names[parm.res_index]
 
-                name0 = _check_type(t0, self.atomtypes, idx0)
-                name1 = _check_type(t1, self.atomtypes, idx1)
-                name2 = _check_type(t2, self.atomtypes, idx2)
-                name3 = _check_type(t3, self.atomtypes, idx3)
+        # FIXME: water name, large segments, segid overflow
+        # FIXME: max is 475253
+        segids = np.array(['{:A>4s}'.format(_makeseg(imol))
+                           for imol in range(parm.nmols)],
+                          dtype=object)[parm.mol_index]
+        atom_is_atom = is_atom[parm.mol_index]
+        segids[atom_is_atom] = 'ATOM'
+        segids[atom_is_atom & (parm.charges != 0.0)] = 'ION'
 
-                p = params.getParams(dihedral)
-                terms = []
+        is_wat = resnames == 'WAT'
+        segids[is_wat] = 'WATER'
+        resnames[is_wat] = 'TIP3'
 
-                n = 3
-                for i in range(0, len(p), n):       # k, np, phase
-                    terms.append(p[i:i+n])
+        resnums = (parm.res_index + 1).tolist()
 
-                self.dihedrals.append( (at0.value() + 1 + offset,
-                                        at1.value() + 1 + offset,
-                                        at2.value() + 1 + offset,
-                                        at3.value() + 1 + offset) )
+        self.atoms = zip(range(1, parm.natoms + 1), resnums, segids.tolist(),
+                         [str(r) for r in resnums],  # FIXME
+                         resnames.tolist(), parm.names.tolist(), amber_types,
+                         parm.charges.tolist(), parm.masses.tolist(),
+                         parm.coords.tolist() )
 
-                self.dihedral_params[name0, name1, name2, name3] = terms
+        for i in np.unique(amber_types, return_index=True)[1]:
+            self.atom_params[amber_types[i]] = (parm.masses[i],
+                                                (parm.sigma[i],
+                                                 parm.epsilon[i]) )
 
-            self.dihedrals.sort()
+        # groups: base pointer charge type (1=neutral,2=charged),
+        #         entire group fixed?
+        gp_base = parm.res_start[:-1]
+        has_group = ~is_atom[parm.mol_index[gp_base] ]
+        charge = np.add.reduceat(parm.charges, gp_base)
 
-            for improper in params.getAllImpropers():
-                at0 = improper.atom0()
-                at1 = improper.atom1()
-                at2 = improper.atom2()
-                at3 = improper.atom3()
+        gp_type = np.where(charge > 0.01, 2, 1)  # FIXME
 
-                idx0 = at0.value()
-                idx1 = at1.value()
-                idx2 = at2.value()
-                idx3 = at3.value()
+        self.groups = zip(gp_base[has_group].tolist(),
+                          gp_type[has_group].tolist(),
+                          [0] * int(has_group.sum() ) )
 
-                t0 = str(mol.select(at0).property('ambertype'))
-                t1 = str(mol.select(at1).property('ambertype'))
-                t2 = str(mol.select(at2).property('ambertype'))
-                t3 = str(mol.select(at3).property('ambertype'))
+        # all indices below are 1-based and global, parameters are taken
+        # from the first molecule of each type only
+        self.bonds = sorted(map(tuple, (parm.bonds + 1).tolist() ) )
 
-                name0 = _check_type(t0, self.atomtypes, idx0)
-                name1 = _check_type(t1, self.atomtypes, idx1)
-                name2 = _check_type(t2, self.atomtypes, idx2)
-                name3 = _check_type(t3, self.atomtypes, idx3)
+        for imol in templates:
+            for b in parm.mol_terms(imol, parm.bonds):
+                at0, at1 = parm.bonds[b]
+                self.bond_params[names[at0], names[at1]] = (parm.bond_k[b],
+                                                            parm.bond_r[b])
 
-                term = params.getParams(improper)
+        self.angles = sorted(map(tuple, (parm.angles + 1).tolist() ) )
 
-                self.impropers.append( (at0.value() + 1 + offset,
-                                   at1.value() + 1 + offset,
-                                   at2.value() + 1 + offset,
-                                   at3.value() + 1 + offset) )
+        for imol in templates:
+            for a in parm.mol_terms(imol, parm.angles):
+                at0, at1, at2 = parm.angles[a]
+                self.angle_params[names[at0], names[at1], names[at2]] = \
+                    (parm.angle_k[a], parm.angle_theta[a] * const.RAD2DEG)
 
-                self.improper_params[name0, name1, name2, name3] = term
+        improper = parm.dihedral_improper
+        dihedrals = parm.dihedrals + 1
 
-            self.impropers.sort()
+        self.dihedrals = sorted(set(map(tuple,
+                                        dihedrals[~improper].tolist() ) ) )
+        self.impropers = sorted(set(map(tuple,
+                                        dihedrals[improper].tolist() ) ) )
 
-            # groups: base pointer charge type (1=neutral,2=charged),
-            #         entire group fixed?
-            for residue in mol.residues():
-                charge = 0.0
-                first = True
+        for imol in templates:
+            terms = OrderedDict()
 
-                for atom in residue.atoms():
-                    if first:
-                        gp_base = atom.index().value() + offset
-                        first = False
+            for d in parm.mol_terms(imol, parm.dihedrals):
+                key = tuple(parm.dihedrals[d])
+                term = (parm.dihedral_k[d], parm.dihedral_n[d],
+                        parm.dihedral_phase[d])
 
-                    charge += atom.property('charge').value()
-
-                if charge > 0.01: # FIXME
-                    gp_type = 2
+                if improper[d]:
+                    if key not in terms:
+                        terms[key] = (True, [term])
                 else:
-                    gp_type = 1
+                    terms.setdefault(key, (False, []) )[1].append(term)
 
-                self.groups.append( (gp_base, gp_type, 0) )
+            for atoms, (is_improper, dterms) in terms.iteritems():
+                tnames = tuple(names[i] for i in atoms)
 
-            offset += natoms
+                if is_improper:
+                    self.improper_params[tnames] = dterms[0]
+                else:
+                    self.dihedral_params[tnames] = dterms
 
 
     def writeCrd(self, filename):
@@ -536,8 +446,8 @@ NONBONDED  NBXMOD 5  ATOM CDIEL VATOM VSWITCH -
   CTONNB 8.0 CTOFNB 10.0  CUTNB 12.0  EPS 1.0  E14FAC 0.83333333  WMIN 1.4
 ''')
             for atom, param in self.atom_params.iteritems():
-                epsilon = -param[1].epsilon().value()
-                sigma = param[1].sigma().value() * const.RSTAR_CONV
+                epsilon = -param[1][1]
+                sigma = param[1][0] * const.RSTAR_CONV
 
                 # FIXME: support other scalings too? but only one scale factor
                 #        electrostatic factor for electrostatics!
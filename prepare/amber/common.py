@@ -37,16 +37,25 @@ __revision__ = "$Id$"
 
 
 import os, sys, re, shutil
+import numpy as np
 import openbabel as ob
 import pybel
 
+from parmed.amber.readparm import AmberParm
+
 import utils                            # relative import
+import parm7
 from FESetup import const, errors, logger, report
 from leap import Leap
 
-import Sire.IO
 
 
+WATER_RESIDUES = ('WAT', 'HOH')
+ION_SOLUTE_DIST = 5.0                   # minimum ion-solute distance in A
+ION_ION_DIST = 3.0                      # minimum distance between new ions
+ION_CHUNK = 256                         # water oxygens per distance block
+ION_SEED = 1                            # reproducible ion placement
+
 
 def ssbonds(ss_file, offset=0):
     """
@@ -201,7 +210,7 @@ class Common(object):
         :type boxtype: string
         :param boxlength: box length in Angstrom
         :type boxlength: float
-        :param neutralize: 1=minimum number of ions, 2=use conc
+        :param neutralize: 1=minimum number of ions, 2=use conc only
         :type neutralize: int
         :param align: align axes?
         :type align: bool
@@ -216,14 +225,19 @@ class Common(object):
 
         leapin = self.leap.generate_init()
 
+        # leap libraries contain the SS-bonds already
+        from_library = any(mol[1] == 'off' for mol in self.leap.mols)
+
         if os.access(const.SSBOND_FILE, os.R_OK):
-            pairs = ssbonds(const.SSBOND_FILE, self.__class__.SSBONDS_OFFSET)
-            cmd = []
+            if not from_library:
+                pairs = ssbonds(const.SSBOND_FILE,
+                                self.__class__.SSBONDS_OFFSET)
+                cmd = []
 
-            for a, b in pairs:
-                cmd.append('bond s.%i.SG s.%i.SG\n' % (a, b) )
+                for a, b in pairs:
+                    cmd.append('bond s.%i.SG s.%i.SG\n' % (a, b) )
 
-            leapin += ''.join(cmd)
+                leapin += ''.join(cmd)
 
             self.ssbond_file = const.SSBOND_FILE
 
@@ -272,38 +286,14 @@ class Common(object):
                 leapin += 'addIons s Na+ %i\n' % nions
             elif self.charge > 0.0:
                 leapin += 'addIons s Cl- %i\n' % nions
-        elif neutralize == 2:           # neutralise to set concentration
-            self.get_box_info()
-
-            self.amber_top = const.LEAP_IONIZED + self.TOP_EXT
-            self.amber_crd = const.LEAP_IONIZED + self.RST_EXT
-            self.amber_pdb = const.LEAP_IONIZED + const.PDB_EXT
-
-            nions = abs(round(self.charge) )
-
-            # FIXME: check if this is correct
-            volume = self.volume * self.density / dens
-
-            # 1 mol/l = 6.022140857*10^23 particles/litre (NIST)
-            # 1 A^3   = 10^-27 l
-            npart = round(0.0006022141 * conc * volume)
-
-            if self.charge < 0.0:
-                npos = npart + nions
-                nneg = npart
-            elif self.charge > 0.0:
-                npos = npart
-                nneg = npart + nions
-            else:
-                npos = nneg = npart
-
-            logger.write('box info: V = %f A^3, rho = %f g/cc\n'
-                         'charge = %f; computed #pos = %i, #neg = %i\n' %
-                         (self.volume , self.density, self.charge, npos,
-                          nneg) )
-
-            leapin += 'addIonsRand s Na+ %i Cl- %i 2.0\n' % (npos, nneg)
 
+        # ions for the set concentration are placed natively in add_ions()
+        # from the solvated system, leap only provides their parameters
+        if boxtype and (neutralize == 2 or conc > 0.0):
+            leapin += ('%s = combine {Na+ Cl-}\nsaveAmberParm %s "%s" "%s"\n' %
+                       (const.LEAP_ION_TEMPLATES, const.LEAP_ION_TEMPLATES,
+                        const.LEAP_ION_TEMPLATES + self.TOP_EXT,
+                        const.LEAP_ION_TEMPLATES + self.RST_EXT) )
 
         leapin += ('saveAmberParm s "%s" "%s"\nsavepdb s "%s"\n' %
                    (self.amber_top, self.amber_crd, self.amber_pdb) )
@@ -322,9 +312,14 @@ class Common(object):
         return leapin
 
 
-    def setup_MDEngine(self, mdprog = 'sander', mdpref = '', mdpost = ''):
+    def setup_MDEngine(self, mdprog = 'sander', mdpref = '', mdpost = '',
+                       single_run = False):
         """
         Instantiate MD engine.
+
+        :param single_run: run all protocol steps in one MD engine process
+                           if supported by the engine
+        :type single_run: bool
         """
 
         self.get_box_dims(self.sander_crd)
@@ -334,6 +329,13 @@ class Common(object):
                                       self.amber_pdb, self.box_dims,
                                       self.solvent, mdprog, mdpref, mdpost)
 
+        if single_run:
+            if hasattr(self.mdengine, 'single_run'):
+                self.mdengine.single_run = True
+            else:
+                logger.write('Warning: MD engine does not support single '
+                             'runs, running steps individually')
+
 
     @report
     def minimize(self, namelist = '%ALL', nsteps = 100, ncyc = 10,
@@ -401,7 +403,9 @@ class Common(object):
                          nrestr, wrap)
 
         # FIXME: do we also want to density?
-        self.box_dims = self.mdengine.get_box_dims()
+        if not self.mdengine.pending():
+            self.box_dims = self.mdengine.get_box_dims()
+
         self.amber_crd = self.mdengine.sander_crd  # FIXME: only for AMBER
 
 
@@ -412,6 +416,9 @@ class Common(object):
         FIXME: must be called explicitly!
         """
 
+        if self.mdengine.run_pending():
+            self.box_dims = self.mdengine.get_box_dims()
+
         self.mdengine.to_rst7()
         self.amber_crd = self.mdengine.sander_crd
 
@@ -515,15 +522,20 @@ class Common(object):
     # called in morph.py (1x), common.py/setup_MDEngine (1x)
     def get_box_dims(self, filename=None):
         """
-        Get box dimensions from sander .rst file.
+        Get box dimensions from sander ASCII or NetCDF restart file.
 
-        :param filename: name of .rst file
+        :param filename: name of restart file
         :type filename: string
         """
 
         if not filename:
             filename = self.sander_rst
 
+        if parm7.is_netcdf(filename):
+            box = parm7.read_ncrst(filename)[2]
+            self.box_dims = [] if box is None else list(box)
+            return
+
         with open(filename, 'r') as rst:
             for line in rst:
                 self.box_dims = line
@@ -531,35 +543,185 @@ class Common(object):
         self.box_dims = self.box_dims.split()
 
 
-    # called in common.py/_amber_top_common (1x)
-    def get_box_info(self):
+    # called in common.py/add_ions (1x)
+    def get_box_info(self, parm=None):
         """
-        Use Sire to get information about the system: volume, density,
-        box dimensions.
+        Get information about the system: volume, density, box dimensions.
 
-        NOTE: Sire prmtop reader is slow!
+        :param parm: the system, read from amber_top/amber_crd if not given
+        :type parm: parm7.Parm7
         """
 
-        # Sire.Mol.Molecules, Sire.Vol.PeriodicBox or Sire.Vol.Cartesian
-        molecules, space = \
-                   Sire.IO.Amber().readCrdTop(self.amber_crd, self.amber_top)
+        if not parm:
+            parm = parm7.Parm7(self.amber_top, self.amber_crd)
+
+        box = parm.box_dims
 
-        if space.isPeriodic():
-            self.volume = space.volume().value()  # in A^3
+        if box:
+            self.box_dims = box         # in Angstrom
 
-            # NOTE: currently rectangular box only
-            x = space.dimensions().x()
-            y = space.dimensions().y()
-            z = space.dimensions().z()
-            self.box_dims = (x, y, z)   # in Angstrom
- 
-            total_mass = 0.0            # in amu
-            
-            for num in molecules.molNums():
-                mol = molecules.at(num).molecule()
+            # in A^3, also for non-orthogonal cells
+            self.volume = abs(np.linalg.det(parm7.cell_matrix(parm.box) ) )
 
-                for atom in mol.atoms():
-                    total_mass += atom.property('mass').value()
+            total_mass = parm.masses.sum()  # in amu
 
             # in g/cc
             self.density = total_mass * const.AMU2GRAMS / self.volume
+
+
+    # called in ligand.py, protein.py and complex.py/create_top (1x each)
+    def add_ions(self, conc, dens=1.0):
+        """
+        Add Na+ and Cl- ions to the solvated system for a set concentration
+        by replacing randomly chosen bulk water molecules.  An ion is put on
+        the oxygen of a water at least ION_SOLUTE_DIST away from the solute
+        and existing ions and at least ION_ION_DIST from the other new ions.
+        The ion parameters are taken from the templates written in the leap
+        solvation session, see _amber_top_common().  Replaces leap's
+        addIonsRand.
+
+        :param conc: ion concentration in mol/litres
+        :type conc: float
+        :param dens: expected target density
+        :type dens: float
+        :raises: SetupError
+        """
+
+        sol_top = self.amber_top
+        sol_crd = self.amber_crd
+
+        tmpl_top = const.LEAP_ION_TEMPLATES + self.TOP_EXT
+        tmpl_crd = const.LEAP_ION_TEMPLATES + self.RST_EXT
+
+        parm = parm7.Parm7(sol_top, sol_crd)
+
+        if not parm.box_dims:
+            raise errors.SetupError('cannot add ions to non-periodic system '
+                                    '%s' % sol_top)
+
+        self.get_box_info(parm)
+
+        # charge of the whole system which may contain neutralising ions
+        # already
+        charge = round(parm.charges.sum() )
+        nions = int(abs(charge) )
+
+        # FIXME: check if this is correct
+        volume = self.volume * self.density / dens
+
+        # 1 mol/l = 6.022140857*10^23 particles/litre (NIST)
+        # 1 A^3   = 10^-27 l
+        npart = int(round(0.0006022141 * conc * volume) )
+
+        if charge < 0.0:
+            npos = npart + nions
+            nneg = npart
+        elif charge > 0.0:
+            npos = npart
+            nneg = npart + nions
+        else:
+            npos = nneg = npart
+
+        logger.write('box info: V = %f A^3, rho = %f g/cc\n'
+                     'charge = %f; computed #pos = %i, #neg = %i\n' %
+                     (self.volume , self.density, charge, npos, nneg) )
+
+        # bulk water are the water residues following the last solute residue
+        is_water = np.in1d(parm.res_names, WATER_RESIDUES)
+        solute_res = np.nonzero(~is_water)[0]
+
+        if not len(solute_res) or solute_res[-1] + 1 == parm.nres:
+            raise errors.SetupError('no solute or no bulk water in %s' %
+                                    sol_top)
+
+        first = solute_res[-1] + 1
+        first_atom = parm.res_start[first]
+
+        crds = parm.coords
+        solute = crds[:first_atom]
+        box = parm.box
+
+        bulk = np.arange(first_atom, parm.natoms)
+        oxygens = bulk[parm.atomic_numbers[bulk] == 8]
+
+        # shortest (minimum image) distance of every water oxygen to the
+        # solute and existing ions
+        shortest_dist2 = np.empty(len(oxygens) )
+
+        for i in range(0, len(oxygens), ION_CHUNK):
+            diff = crds[oxygens[i:i+ION_CHUNK]][:, np.newaxis, :] - solute
+
+            shortest_dist2[i:i+ION_CHUNK] = \
+                np.min(parm7.min_image_dist2(diff, box), axis=1)
+
+        candidates = oxygens[shortest_dist2 >= ION_SOLUTE_DIST**2]
+        rng = np.random.RandomState(ION_SEED)
+        placed = []
+
+        for ox in rng.permutation(candidates):
+            if len(placed) == npos + nneg:
+                break
+
+            if placed:
+                diff = crds[placed] - crds[ox]
+
+                if np.min(parm7.min_image_dist2(diff, box) ) < ION_ION_DIST**2:
+                    continue
+
+            placed.append(ox)
+
+        if len(placed) < npos + nneg:
+            raise errors.SetupError('only %i of %i ions can be placed in %s, '
+                                    'the box is too small' %
+                                    (len(placed), npos + nneg, sol_top) )
+
+        self.amber_top = const.LEAP_IONIZED + self.TOP_EXT
+        self.amber_crd = const.LEAP_IONIZED + self.RST_EXT
+        self.amber_pdb = const.LEAP_IONIZED + const.PDB_EXT
+
+        logger.write('Replacing %i water molecules in %s with ions' %
+                     (len(placed), sol_top) )
+
+        # like addIonsRand the ions go between the solute and the bulk water
+        # so that molecule order agrees with e.g. the GROMACS [ molecules ]:
+        # the Na+/Cl- pairs from the templates are put between two copies of
+        # the solvated system, then the bulk water of the first copy, the
+        # surplus ions and the solute and replaced waters of the second copy
+        # are stripped (ParmEd cannot combine already stripped AmberParms)
+        npairs = max(npos, nneg)
+        na = placed[:npos]
+        cl = placed[npos:]
+        offset = parm.nres + 2 * npairs
+
+        strip = list(range(first + 1, parm.nres + 1) )
+        strip.extend(parm.nres + 2 * k + 1 for k in range(npos, npairs) )
+        strip.extend(parm.nres + 2 * k + 2 for k in range(nneg, npairs) )
+        strip.extend(range(offset + 1, offset + first + 1) )
+        strip.extend( (parm.res_index[placed] + offset + 1).tolist() )
+
+        if npairs:
+            com = (AmberParm(sol_top, sol_crd) +
+                   AmberParm(tmpl_top, tmpl_crd) * npairs +
+                   AmberParm(sol_top, sol_crd) )
+            com.strip(':' + ','.join(str(r) for r in strip) )
+        else:
+            com = AmberParm(sol_top, sol_crd)
+
+        ion_atoms = []
+
+        for k in range(npairs):
+            ion_atoms.extend(na[k:k+1] + cl[k:k+1])
+
+        keep = ~np.in1d(parm.res_index, parm.res_index[placed])
+        keep[:first_atom] = False
+
+        coords = np.concatenate( (solute, crds[ion_atoms], crds[keep]) )
+
+        com.coordinates = coords
+        com.box = list(parm.box)
+
+        com.save(self.amber_top, format='amber', overwrite=True)
+        parm7.write_rst7(self.amber_crd, coords, box=parm.box)
+        com.save(self.amber_pdb, format='pdb', overwrite=True)
+
+        self.sander_crd = self.amber_crd
@@ -29,9 +29,15 @@ __revision__ = "$Id$"
 
 
 
+import numpy as np
+
+from parmed.amber.readparm import AmberParm
+
 import FESetup
 from FESetup import const, errors, logger
 import utils
+import parm7
+import leaplib
 
 from ligand import Ligand
 from protein import Protein
@@ -39,6 +45,10 @@ from common import *
 
 
 
+FLEX_CHUNK = 4096                       # protein atoms per distance block
+SPLICE_LIGAND = 'splice_ligand'         # ligand only topology for splice_top
+
+
 class Complex(Common):
     """The complex setup class."""
 
@@ -153,7 +163,20 @@ class Complex(Common):
         """
 
         if not self.leap_added:
-            self.leap.add_mol(self.protein_file, 'pdb')
+            if os.access(const.SSBOND_FILE, os.R_OK):
+                ss_file = const.SSBOND_FILE
+            else:
+                ss_file = ''
+
+            # the receptor is templated by leap only once
+            library = leaplib.get_library(self.leap, self.protein_file,
+                                          ss_file)
+
+            if library:
+                self.leap.add_mol(library, 'off')
+            else:
+                self.leap.add_mol(self.protein_file, 'pdb')
+
             self.leap_added = True
 
         # FIXME: there can be problems with the ordering of commands, e.g.
@@ -164,8 +187,63 @@ class Complex(Common):
                                         remove_first=remove_first,
                                         conc=conc, dens=dens)
 
+        ionize = boxtype and (neutralize == 2 or conc > 0.0)
+
         utils.run_leap(self.amber_top, self.amber_crd, 'tleap', leapin)
 
+        if ionize:
+            self.add_ions(conc, dens)
+
+
+    @report
+    def splice_top(self, rest_top, rest_crd):
+        """
+        Generate the AMBER topology of a solvated complex from an existing
+        solvated system by replacing its first residue (=ligand) with the
+        ligand added in prepare_top().  Only the ligand is parametrised by
+        leap, the rest of the system is combined with ParmEd and taken over
+        unchanged together with its coordinates.  Replaces
+        create_top(boxtype='set') and uses box_dims in the same way.
+
+        :param rest_top: parmtop of the existing solvated system
+        :type rest_top: string
+        :param rest_crd: coordinates of the existing solvated system
+        :type rest_crd: string
+        :raises: SetupError
+        """
+
+        if self._parm_overwrite:
+            base = self._parm_overwrite
+        else:
+            base = const.LEAP_SOLVATED
+
+        lig_top = SPLICE_LIGAND + '_' + base + self.TOP_EXT
+        lig_crd = SPLICE_LIGAND + '_' + base + self.RST_EXT
+
+        leapin = self.leap.generate_init()
+        leapin += 'saveAmberParm s "%s" "%s"\nquit\n' % (lig_top, lig_crd)
+
+        utils.run_leap(lig_top, lig_crd, 'tleap', leapin)
+
+        self.amber_top = base + self.TOP_EXT
+        self.amber_crd = base + self.RST_EXT
+        self.amber_pdb = base + const.PDB_EXT
+
+        logger.write('Splicing %s into %s/%s' % (lig_top, rest_top, rest_crd) )
+
+        lig = AmberParm(lig_top, lig_crd)
+        rest = AmberParm(rest_top, rest_crd)
+        rest.strip(':1')
+
+        com = lig + rest
+        com.box = [float(b) for b in self.box_dims[:3]] + [90.0, 90.0, 90.0]
+
+        com.save(self.amber_top, format='amber', overwrite=True)
+        parm7.write_rst7(self.amber_crd, com.coordinates, box=com.box)
+        com.save(self.amber_pdb, format='pdb', overwrite=True)
+
+        self.sander_crd = self.amber_crd
+
 
     @report
     def prot_flex(self, cut_sidechain = 15.0, cut_backbone = 15.0):
@@ -185,76 +263,52 @@ class Complex(Common):
             raise errors.SetupError('Cutoffs must be positive')
 
 
-        import Sire.IO
-
-        amber = Sire.IO.Amber()
-        molecules, space = amber.readCrdTop(self.sander_crd, self.amber_top)
+        parm = parm7.Parm7(self.amber_top, self.sander_crd)
 
-        moleculeNumbers = molecules.molNums()
-        moleculeNumbers.sort()
-        moleculeList = []
+        # ligand is the first molecule, heavy atoms only
+        heavy = parm.masses >= const.MAX_HYDROGEN_MASS
+        lig_end = parm.mol_start[1]
 
-        for moleculeNumber in moleculeNumbers:
-            molecule = molecules.molecule(moleculeNumber).molecule()
-            moleculeList.append(molecule)
+        lig_crds = parm.coords[:lig_end][heavy[:lig_end] ]
 
-        ligand = moleculeList[0]
-        not_ligand = moleculeList[1:]
+        resnames = parm.res_names[parm.res_index]
+        is_prot = np.in1d(resnames, list(const.AMBER_PROTEIN_RESIDUES) )
+        is_prot[:lig_end] = False
 
-        sc_bb_residues = []
+        sel = np.nonzero(is_prot & heavy)[0]
 
         logger.write('Computing flexible protein residues from %s' %
                      self.sander_crd)
 
-        for cut in cut_sidechain, cut_backbone:
-            cut_residues = []
-            cut2 = cut**2
-
-            for molecule in not_ligand:
-
-                #for residue in molecule.residues():
-                nmolresidues = molecule.nResidues()
-                for z in range(0,nmolresidues):
-                    residue = molecule.residues()[z]
-                    # FIXME: a better way to skip unwanted residues would be to
-                    # examine amber.zmatrices directly
-                    # .value() returns a QtString!
-                    if (str(residue.name().value()) not in
-                        const.AMBER_PROTEIN_RESIDUES):
-                        continue
-
-                    shortest_dist2 = float('inf')
+        box = parm.box_dims
 
-                    #for resat in residue.atoms():
-                    nresatoms = residue.nAtoms()
-                    for x in range(0,nresatoms):
-                        resat = residue.atoms()[x]
+        if box:
+            box = np.array(box)
 
-                        if (resat.property('mass').value() <
-                            const.MAX_HYDROGEN_MASS):
-                            continue
+        # shortest (minimum image) distance of every selected protein atom to
+        # any ligand atom
+        shortest_dist2 = np.full(len(sel), float('inf') )
 
-                        rescoords = resat.property('coordinates')
+        nsel = len(sel) if len(lig_crds) else 0
 
-                        #for ligat in ligand.atoms():
-                        nligatoms = ligand.nAtoms()
-                        for y in range(0,nligatoms):
-                            ligat = ligand.atoms()[y]
+        for i in range(0, nsel, FLEX_CHUNK):
+            chunk = sel[i:i+FLEX_CHUNK]
+            diff = parm.coords[chunk][:, np.newaxis, :] - lig_crds
 
-                            if (ligat.property('mass').value() <
-                                const.MAX_HYDROGEN_MASS):
-                                continue
+            if box is not None:
+                diff -= box * np.round(diff / box)
 
-                            ligcoords = ligat.property('coordinates')
-                            dist2 = space.calcDist2(rescoords, ligcoords)
+            shortest_dist2[i:i+FLEX_CHUNK] = \
+                np.min(np.sum(diff * diff, axis=2), axis=1)
 
-                            if dist2 < shortest_dist2:
-                                shortest_dist2 = dist2
+        # residue numbers are 1-based
+        resnums = parm.res_index[sel] + 1
 
-                    if shortest_dist2 < cut2:
-                        cut_residues.append(residue)
+        sc_bb_residues = []
 
-            sc_bb_residues.append(cut_residues)
+        for cut in cut_sidechain, cut_backbone:
+            near = shortest_dist2 < cut**2
+            sc_bb_residues.append(np.unique(resnums[near]).tolist() )
 
         lines = ['''# Flexible residues were only selected from the following list of residue names
 # %s
@@ -269,12 +323,7 @@ class Complex(Common):
 
         for i in 0, 1:
             lines.append("%s\n" % htext[i])
-            nums = []
-
-            for residue in sc_bb_residues[i]:
-                nums.append(residue.number().value() )
-
-            nums.sort()
+            nums = sc_bb_residues[i]
 
             line = ''
             for num in nums:
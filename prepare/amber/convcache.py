@@ -0,0 +1,205 @@
+#  Copyright (C) 2017  Hannes H Loeffler
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#  For full details of the license please see the COPYING file
+#  that should have come with this distribution.
+
+r'''
+On-disk cache of AMBER parmtop/inpcrd conversions to native MD engine
+formats.
+
+A conversion is identified by the content of the parmtop and inpcrd files,
+the converter class, the writer options and the source code of the
+converter, the parmtop parser and this module.  The cache stores the written
+files together with the converter state the MD engine needs later on, such
+that an unchanged system is converted only once, even across runs.  The
+cache is disabled as long as cache_dir is not set.
+'''
+
+__revision__ = "$Id$"
+
+
+
+import os
+import sys
+import inspect
+import hashlib
+import tempfile
+import cPickle as pickle
+
+import parm7                            # relative import
+from FESetup import logger
+
+
+
+BLOCK_SIZE = 1 << 20
+
+# absolute path of the cache directory, None disables the cache
+cache_dir = None
+
+# source digests by module name
+_sources = {}
+
+
+def _source_digest(module):
+    """
+    Compute the digest of the source code of a module such that any edit of
+    the module invalidates the cache entries depending on it.
+    """
+
+    name = module.__name__
+
+    if name not in _sources:
+        filename = inspect.getsourcefile(module) or module.__file__
+
+        with open(filename, 'rb') as inp:
+            _sources[name] = hashlib.sha1(inp.read() ).hexdigest()
+
+    return _sources[name]
+
+
+def _digest(converter, filenames, options):
+    """
+    Compute the cache key from file contents, converter, sources and options.
+    """
+
+    modules = (sys.modules[__name__], parm7, sys.modules[converter.__module__])
+
+    sha = hashlib.sha1()
+    sha.update('%s.%s %r\n' % (converter.__module__, converter.__name__,
+                               options) )
+
+    for module in modules:
+        sha.update('%s\n' % _source_digest(module) )
+
+    for filename in filenames:
+        with open(filename, 'rb') as inp:
+            for block in iter(lambda: inp.read(BLOCK_SIZE), ''):
+                sha.update(block)
+
+        sha.update('\0')
+
+    return sha.hexdigest()
+
+
+def _load(path):
+    """
+    Load a cache entry, None if not available.  Unreadable entries, e.g.
+    truncated writes or pickles of moved classes, are removed.
+    """
+
+    try:
+        pkl = open(path, 'rb')
+    except IOError:
+        return None
+
+    try:
+        with pkl:
+            return pickle.load(pkl)
+    except (EOFError, AttributeError, ImportError, IndexError, TypeError,
+            ValueError, pickle.UnpicklingError) as why:
+        logger.write('Warning: removing unreadable conversion cache %s: %s' %
+                     (path, why) )
+
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+        return None
+
+
+def _store(path, entry):
+    """Atomically write a cache entry, failures are not fatal."""
+
+    try:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+        fd, tmp = tempfile.mkstemp(dir=cache_dir)
+
+        with os.fdopen(fd, 'wb') as pkl:
+            pickle.dump(entry, pkl, pickle.HIGHEST_PROTOCOL)
+
+        os.rename(tmp, path)
+    except (OSError, IOError, pickle.PicklingError) as why:
+        logger.write('Warning: cannot write conversion cache %s: %s' %
+                     (path, why) )
+
+
+def convert(converter, parmtop, inpcrd, outputs, writer, options=(),
+            attrs=None):
+    """
+    Convert an AMBER parmtop/inpcrd pair with converter.readParm() and
+    writer() or retrieve the result from the cache.
+
+    :param converter: converter class with a readParm(parmtop, inpcrd) method
+    :type converter: class
+    :param parmtop: parmtop file name
+    :type parmtop: string
+    :param inpcrd: inpcrd file name
+    :type inpcrd: string
+    :param outputs: names of the files written by writer
+    :type outputs: sequence of strings
+    :param writer: callable writing outputs given the converter object
+    :type writer: callable
+    :param options: writer options affecting the output, part of the key
+    :type options: tuple
+    :param attrs: converter attributes to be cached, None for all
+    :type attrs: sequence of strings
+    :returns: the converter object
+    """
+
+    if cache_dir:
+        key = _digest(converter, (parmtop, inpcrd), options)
+        path = os.path.join(cache_dir, key + os.extsep + 'pickle')
+        entry = _load(path)
+
+        if entry:
+            logger.write('Using cached conversion %s' % key)
+
+            obj = converter()
+            obj.__dict__.update(entry['state'])
+
+            if hasattr(obj, 'parmtop'):
+                obj.parmtop = parmtop
+                obj.inpcrd = inpcrd
+
+            for filename, content in zip(outputs, entry['files']):
+                with open(filename, 'wb') as out:
+                    out.write(content)
+
+            return obj
+
+    obj = converter()
+    obj.readParm(parmtop, inpcrd)
+    writer(obj)
+
+    if cache_dir:
+        if attrs is None:
+            state = obj.__dict__
+        else:
+            state = dict( (attr, getattr(obj, attr) ) for attr in attrs)
+
+        files = []
+
+        for filename in outputs:
+            with open(filename, 'rb') as inp:
+                files.append(inp.read() )
+
+        _store(path, {'state': state, 'files': files})
+
+    return obj
@@ -28,15 +28,12 @@ __revision__ = "$Id$"
 import os, sys, math
 from operator import itemgetter
 
-import Sire.IO
-import Sire.MM
-import Sire.Maths
+import numpy as np
 
-from FESetup import const, errors, logger
+import parm7
+from FESetup import const, logger
 
 
-BOX_BUFFER = 3.0
-
 
 
 class DLPolyField(object):
@@ -55,16 +52,13 @@ class DLPolyField(object):
         
         self.coords = []
 
-        self.mol_numbers = None
-        self.mols = None
+        self.parm = None
 
         self.box_dims = None
 
         self.parmtop = ""
         self.inpcrd = ""
 
-        self.perbox = None
-
         
     def readParm(self, parmtop, inpcrd):
         """
@@ -78,212 +72,116 @@ class DLPolyField(object):
         :raises: SetupError
         """
 
-        amber = Sire.IO.Amber()
-
-        try:
-            # (Sire.Mol.Molecules,  Sire.Vol.PeriodicBox or Sire.Vol.Cartesian)
-            mols, self.perbox = amber.readCrdTop(inpcrd, parmtop)
-        except UserWarning as error:
-            raise errors.SetupError('error opening %s/%s' % (parmtop, inpcrd) )
+        parm = parm7.Parm7(parmtop, inpcrd)
 
         self.parmtop = parmtop
         self.inpcrd = inpcrd
+        self.box_dims = parm.box_dims
 
-        mol_numbers = mols.molNums()
-        mol_numbers.sort()
-
-        offset = 1
-        atomtypes = {}
-        rigids = []
-        
-        for num in mol_numbers:
-            mol = mols.at(num).molecule()
-            natoms = mol.nAtoms()
-
-            res = mol.residues()[0]
-
-            # FIXME: always named WAT?
-            if str(res.name().value() ) == 'WAT':
-                rigids.append([atom.index().value() + offset
-                               for atom in res.atoms() ] )
-
-            for atom in mol.atoms():
-                ambertype = str(atom.property('ambertype') )
-
-                sfx = ''
-
-                for ch in ambertype:
-                    if ch.istitle():
-                        sfx += 'U'
-                    else:
-                        sfx += 'l'
-
-                charge = atom.property('charge').value()
-                mass = atom.property('mass').value()
-                coords = atom.property('coordinates')
-
-                lj = atom.property('LJ')
-                sigma = lj.sigma().value() * const.RSTAR_CONV
-                epsilon = lj.epsilon().value()
-
-                resname = str(atom.residue().name().value() )
-                resnum = atom.residue().number().value()
+        resnames = parm.res_names[parm.res_index]
+        resnums = parm.res_index + 1
+        elements = parm.elements
 
-                element = atom.property('element').symbol()
+        # FIXME: really TIP4?, residue always named WAT?
+        elements[(parm.types == 'EP') & (resnames == 'WAT')] = 'EP'
 
-                # FIXME: really TIP4?, residue always named WAT?
-                if ambertype == 'EP' and resname == 'WAT':
-                    element = 'EP'       # for CONFIG comment
-
-                atype = ambertype + '_' + sfx
-                self.coords.append( (atype, resnum, resname, element,
-                                     coords[0], coords[1], coords[2]) )
-
-                self.atoms.append( (atype, mass, charge, resnum, resname) )
-
-                atomtypes[atype] = (sigma, epsilon)
-
-
-            try:
-                params = mol.property('amberparameters') # Sire.Mol.AmberParameters
-            except UserWarning:
-                offset += natoms
-                continue
-
-            try:
-                mol.property('bond')
-            except UserWarning:
-                offset += natoms
-                continue
-
-            for bond in params.getAllBonds():  # Sire.Mol.BondID
-                at0 = bond.atom0()  # Sire.Mol.AtomIdx!
-                at1 = bond.atom1()
-                k, r = params.getParams(bond)
-
-                at0sel = mol.select(at0)
-                resn = str(at0sel.residue().name().value() )
-                elem0 = at0sel.property('element').symbol()
-                elem1 = mol.select(at1).property('element').symbol()
-
-                idx0 = at0.value() + offset
-                idx1 = at1.value() + offset
-
-                self.bonds.append( (idx0, idx1, 2.0 * k, r) )
-
-                # FIXME: make all-H vs water-only-H an option?; EP in TIP4?;
-                #        consider rigid-body for TIP3P et al.
-                if elem0 == 'H' or elem1 == 'H':
-                    if resn == 'WAT':
-                        rflag = 1
-                    else:
-                        rflag = 0
+        atomtypes = {}
+        suffixed = {}
 
-                    dist = Sire.Maths.Vector.distance(
-                        mol.atom(at0).property("coordinates"),
-                        mol.atom(at1).property("coordinates") )
+        for i in np.unique(parm.types, return_index=True)[1]:
+            ambertype = parm.types[i]
+            sfx = ''
 
-                    self.constraints.append( (idx0, idx1, dist, rflag) )
+            for ch in ambertype:
+                if ch.istitle():
+                    sfx += 'U'
+                else:
+                    sfx += 'l'
 
-            self.bonds.sort()
+            atype = ambertype + '_' + sfx
+            suffixed[ambertype] = atype
 
+            atomtypes[atype] = (parm.sigma[i] * const.RSTAR_CONV,
+                                parm.epsilon[i])
 
-            try:
-                mol.property('angle')
-            except UserWarning:
-                offset += natoms
-                continue
+        atypes = [suffixed[t] for t in parm.types]
 
-            for angle in params.getAllAngles():  # Sire.Mol.AngleID
-                at0 = angle.atom0()  # Sire.Mol.AtomIdx!
-                at1 = angle.atom1()
-                at2 = angle.atom2()
-                k, theta = params.getParams(angle)
+        coords = parm.coords
 
-                self.angles.append( (at0.value() + offset, at1.value() + offset,
-                                     at2.value() + offset, 2.0 * k,
-                                     theta * const.RAD2DEG) )
+        self.coords = zip(atypes, resnums.tolist(), resnames.tolist(),
+                          elements.tolist(), coords[:,0].tolist(),
+                          coords[:,1].tolist(), coords[:,2].tolist() )
 
-            self.angles.sort()
+        self.atoms = zip(atypes, parm.masses.tolist(), parm.charges.tolist(),
+                         resnums.tolist(), resnames.tolist() )
 
+        # FIXME: always named WAT?
+        rigids = []
 
-            try:
-                mol.property('dihedral')
-            except UserWarning:
-                offset += natoms
+        for mt in parm.molecule_types():
+            if mt.res_names[0] != 'WAT':
                 continue
 
-            intrascale = mol.property('intrascale')
-
-            pairs = set()
-
-            for dihedral in params.getAllDihedrals():  # Sire.Mol.DihedralID
-                at0 = dihedral.atom0()  # Sire.Mol.AtomIdx!
-                at1 = dihedral.atom1()
-                at2 = dihedral.atom2()
-                at3 = dihedral.atom3()
-
-                idx0 = at0.value() + offset
-                idx3 = at3.value() + offset
-
-                sf = intrascale.get(at0, at3)
+            # first residue of the template, shifted to every molecule
+            start = parm.mol_start[mt.template]
+            rigid = np.arange(start, parm.res_start[parm.res_index[start] + 1])
+            shift = parm.mol_start[mt.mols] - start
 
-                # work-around for pairs double-counting bug in
-                # Sire.IO.Amber().readCrdTop()
-                if (idx0, idx3) in pairs or (idx3, idx0) in pairs:
-                    scnb, scee = 0.0, 0.0
-                else:
-                    scee = sf.lj()
-                    scnb = sf.coulomb()
-                    pairs.add( (idx0, idx3) )
-                    pairs.add( (idx3, idx0) )
-
-                p = params.getParams(dihedral)
+            rigids.extend( (rigid + shift[:, np.newaxis] + 1).tolist() )
 
-                for i in range(0, len(p), 3):
-                    pk = p[i]
-                    pn = p[i+1]
-                    phase = p[i+2]
+        rigids.sort()
 
-                    self.propers.append( (idx0, at1.value() + offset,
-                                          at2.value() + offset, idx3,
-                                          pk, phase * const.RAD2DEG, pn,
-                                          scnb, scee) )
+        # all indices are 1-based and global
+        bonds = parm.bonds + 1
 
-                    scnb, scee = 0.0, 0.0  # count multi-terms only once
+        self.bonds = sorted(zip(bonds[:,0].tolist(), bonds[:,1].tolist(),
+                                (2.0 * parm.bond_k).tolist(),
+                                parm.bond_r.tolist() ) )
 
-            self.propers.sort(key = itemgetter(0, 1, 2, 3) )
+        # FIXME: make all-H vs water-only-H an option?; EP in TIP4?;
+        #        consider rigid-body for TIP3P et al.
+        is_h = elements == 'H'
+        hbond = is_h[parm.bonds[:,0]] | is_h[parm.bonds[:,1]]
+        hidx = parm.bonds[hbond]
 
-            try:
-                mol.property('improper')
-            except UserWarning:
-                offset += natoms
-                continue
+        dist = np.sqrt(np.sum( (coords[hidx[:,0]] - coords[hidx[:,1]])**2,
+                              axis=1) )
+        rflag = (resnames[hidx[:,0]] == 'WAT').astype(int)
 
-            for dihedral in params.getAllImpropers():
-                at0 = dihedral.atom0()
-                at1 = dihedral.atom1()
-                at2 = dihedral.atom2()
-                at3 = dihedral.atom3()
+        self.constraints = zip( (hidx[:,0] + 1).tolist(),
+                                (hidx[:,1] + 1).tolist(),
+                               dist.tolist(), rflag.tolist() )
 
-                pk, pn, phase = params.getParams(dihedral)
+        angles = parm.angles + 1
 
-                self.impropers.append( (at0.value() + offset,
-                                        at1.value() + offset,
-                                        at2.value() + offset,
-                                        at3.value() + offset,
-                                        pk, phase * const.RAD2DEG, pn,
-                                        0.0, 0.0) )
+        self.angles = sorted(zip(angles[:,0].tolist(), angles[:,1].tolist(),
+                                 angles[:,2].tolist(),
+                                 (2.0 * parm.angle_k).tolist(),
+                                 (parm.angle_theta *
+                                  const.RAD2DEG).tolist() ) )
 
-            self.impropers.sort()
+        # 1-4 scaling is counted once per pair, multi-terms get zero
+        scale_elec = np.zeros(len(parm.dihedrals) )
+        scale_vdw = np.zeros(len(parm.dihedrals) )
+        p14 = parm.pairs14()
+        scale_elec[p14] = 1.0 / parm.dihedral_scee[p14]
+        scale_vdw[p14] = 1.0 / parm.dihedral_scnb[p14]
 
+        dihedrals = zip(*( (parm.dihedrals + 1).T.tolist() +
+                           [parm.dihedral_k.tolist(),
+                            (parm.dihedral_phase * const.RAD2DEG).tolist(),
+                            parm.dihedral_n.tolist(),
+                            scale_elec.tolist(), scale_vdw.tolist()] ) )
 
-            offset += natoms
+        improper = parm.dihedral_improper.tolist()
 
+        self.propers = sorted( (d for d, imp in zip(dihedrals, improper)
+                                if not imp), key = itemgetter(0, 1, 2, 3) )
+        self.impropers = sorted(d[:7] + (0.0, 0.0)
+                                for d, imp in zip(dihedrals, improper) if imp)
 
         self.rigids = rigids
-        self.mol_numbers = mol_numbers
-        self.mols = mols
+        self.parm = parm
 
         div = math.pow(2.0, -1.0 / 6.0)
 
@@ -351,19 +249,15 @@ class DLPolyField(object):
 
         atnum = 0
 
-        try:
-            dims = self.perbox.dimensions() # Sire.Maths.Vector
-
-            x = dims.x()
-            y = dims.y()
-            z = dims.z()
+        if self.box_dims:
+            x, y, z = self.box_dims
 
             # FIXME: check for triclinic
             if x == y == z:
                 imcon = 1
             else:
                 imcon = 2
-        except:
+        else:
             imcon = 0
 
 
@@ -501,79 +395,22 @@ class DLPolyField(object):
             top.write('close\n')
 
 
-    def unwrap(self, coords, boxx, boxy, boxz):
+    def unwrap(self, coords, box):
         """
         Unwrap coordinates because DL_POLY uses atom-based wrapping.
 
-        The current code assumes largest molecule is not larger than the
-        box minus an arbitrary buffer.  Possible alternative: check all
-        bonds an move atom if bond length is larger than half the box
-        length.
-
-        :param coords: flat list of coordinates
-        :type coords: list
-        :param boxx: box dimension in x direction
-        :type boxx: float
-        :param boxy: box dimension in y direction
-        :type boxy: float
-        :param boxz: box dimension in z direction
-        :type boxz: float
-        """
-
-        offset = 0
-
-        # FIXME: arbitrary buffer, unwrapping may fail?
-        maxx = (boxx - BOX_BUFFER)**2
-        maxy = (boxy - BOX_BUFFER)**2
-        maxz = (boxz - BOX_BUFFER)**2
+        Molecules are made whole by following the minimum image from atom
+        to atom, see parm7.unwrap().
 
-        for num in self.mol_numbers:
-            mol = self.mols.at(num).molecule()
-            natoms = mol.nAtoms()
-
-            first = True
-
-            for residue in mol.residues():
-                for atom in residue.atoms():
-                    idx = 3 * (atom.index().value() + offset)
-
-                    if first:
-                        x0 = coords[idx]
-                        y0 = coords[idx+1]
-                        z0 = coords[idx+2]
-
-                        if x0 > boxx:
-                            coords[idx] -= math.copysign(boxx, x1)
-
-                        if y0 > boxy:
-                            coords[idx+1] -= math.copysign(boxy, y1)
-
-                        if z0 > boxz:
-                            coords[idx+2] -= math.copysign(boxz, z1)
-
-                        first = False
-                        continue
-
-                    x1 = coords[idx]
-                    y1 = coords[idx+1]
-                    z1 = coords[idx+2]
-
-                    xd = (x0 - x1)**2
-                    yd = (y0 - y1)**2
-                    zd = (z0 - z1)**2
-
-                    # FIXME: orthorombic only
-                    if xd > maxx:
-                        coords[idx] -= math.copysign(boxx, x1)
-
-                    if yd > maxy:
-                        coords[idx+1] -= math.copysign(boxy, y1)
-
-                    if zd > maxz:
-                        coords[idx+2] -= math.copysign(boxz, z1)
-
-            offset += natoms
+        :param coords: coordinates
+        :type coords: (N,3) array-like
+        :param box: box lengths or cell vectors
+        :type box: sequence
+        :returns: unwrapped coordinates
+        :rtype: (N,3) numpy.ndarray
+        """
 
+        return parm7.unwrap(coords, self.parm.mol_start, box)
 
 if __name__ == '__main__':
     import sys
@@ -26,18 +26,17 @@ __revision__ = "$Id$"
 
 
 
-import os, math
+import os
 from collections import OrderedDict
 
-import Sire.IO
-import Sire.MM
+import numpy as np
 
+import parm7
 from FESetup import const, errors, logger
 
 
 
 ATOM_PREFIX = 'x'
-BOX_BUFFER = 3.0
 
 water_atom_names = {
     'O': 'OW',
@@ -211,8 +210,7 @@ class GromacsTop(object):
 
         self.molidx = {}
 
-        self.mol_numbers = None
-        self.mols = None
+        self.parm = None
 
 
     def readParm(self, parmtop, inpcrd):
@@ -227,264 +225,163 @@ class GromacsTop(object):
         :raises: SetupError
         """
 
-        amber = Sire.IO.Amber()
-
-        try:
-            # (Sire.Mol.Molecules,  Sire.Vol.PeriodicBox or Sire.Vol.Cartesian)
-            mols, perbox = amber.readCrdTop(inpcrd, parmtop)
-        except UserWarning as error:
-            raise errors.SetupError('error opening %s/%s' % (parmtop, inpcrd) )
+        parm = parm7.Parm7(parmtop, inpcrd)
 
         self.parmtop = parmtop
         self.inpcrd = inpcrd
 
-        resnames = OrderedDict()
-        i = 0
-
-        mol_numbers = mols.molNums()
-        mol_numbers.sort()
-
-        # first pass to get total number of atoms
-        self.tot_natoms = sum(mols.at(num).molecule().nAtoms()
-                              for num in mol_numbers)
-
-        mcnt = 0
-
-        # second pass to get atomtypes: grompp allows only one such section
-        for num in mol_numbers:
-            mol = mols.at(num).molecule()
-            natoms = mol.nAtoms()
-            key = tuple([str(res.name().value()) for res in mol.residues()])
-
-            # store unique molecules because only topological data is needed
-            try:
-                resnames[key][1] += 1
-            except KeyError:
-                resnames[key] = [num, 1, [], natoms]
-
-            idx = []
-
-            if key[0] != 'WAT':
-                if len(key) == 1:
-                    mol_name = '%s' % key[0]
-                else:
-                    # FIXME: analyse names e.g. if protein, etc.
-                    mcnt += 1
-                    mol_name = 'MOL%i' % mcnt
-
-                self.moltypes.append( (mol_name, 1) )
-
-            for atom in mol.atoms():
-                ambertype = str(atom.property('ambertype') )
-
-                # silly Gromacs doesn't get along with type starting with digit
-                if ambertype[0].isdigit():
-                    ambertype = ATOM_PREFIX + ambertype
+        self.tot_natoms = parm.natoms
 
-                mass = atom.property('mass').value()
-                lj = atom.property('LJ')
-                coords = atom.property('coordinates')
+        # silly Gromacs doesn't get along with type starting with digit
+        types = np.array([ATOM_PREFIX + t if t[0].isdigit() else t
+                          for t in parm.types], dtype=object)
 
-                atom_name = str( atom.name().value() )
-                resname = str(atom.residue().name().value() )
-                resnum = atom.residue().number().value() % 99999
+        names = parm.names.copy()
+        resnames = parm.res_names[parm.res_index]
+        is_wat = resnames == 'WAT'
+        names[is_wat] = [water_atom_names[n] for n in names[is_wat] ]
 
-                if resname == 'WAT':
-                    atom_name = water_atom_names[atom_name]
+        resnums = (parm.res_index + 1) % 99999
+        coords = parm.coords * const.A2NM
 
-                self.coords.append( (resnum, resname, atom_name,
-                                     coords[0] * const.A2NM,
-                                     coords[1] * const.A2NM,
-                                     coords[2] * const.A2NM) )
+        self.coords = zip(resnums.tolist(), resnames.tolist(), names.tolist(),
+                          coords[:,0].tolist(), coords[:,1].tolist(),
+                          coords[:,2].tolist() )
 
-                try:
-                    nprot = atom.property('element').nProtons()
-                except UserWarning:
-                    nprot = 0
+        # grompp allows only one atomtypes section
+        # FIXME: check if duplicates are really the same?
+        uniq = np.unique(types, return_index=True)[1]
 
-                # FIXME: check if duplicates are really the same?
-                self.top.atomtypes[ambertype] = ( (mass,
-                                          lj.sigma().value() * const.A2NM,
-                                          lj.epsilon().value() * const.CAL2J) )
+        for i in uniq:
+            self.top.atomtypes[types[i]] = (parm.masses[i],
+                                            parm.sigma[i] * const.A2NM,
+                                            parm.epsilon[i] * const.CAL2J)
 
-                idx.append(i)
-                i += 1
-
-            resnames[key][2].extend(idx)
+        box = parm.box_dims
 
         # FIXME: only orthorombic box
-        try:
-            dims = perbox.dimensions() # Sire.Maths.Vector
-
-            x = dims.x()
-            y = dims.y()
-            z = dims.z()
-        except:                         # FIXME: which exception?
+        if box:
+            x, y, z = box
+        else:
             x, y, z = 0.0, 0.0, 0.0
 
         self.box_dims = x * const.A2NM, y * const.A2NM, z * const.A2NM
 
-
+        # store unique molecules because only topological data is needed
+        moltypes = parm.molecule_types()
+        type_names = []
         mols_tmp = []
         mcnt = 0
 
-        # FIXME: we need to preserve molecule order, e.g. ions may be
-        #        alternating
-        for seq, num in resnames.iteritems():
-            slen = len(seq)
+        for itype, mt in enumerate(moltypes):
+            seq = mt.res_names
 
-            if seq[0] == 'WAT' and slen == 1:
+            if seq[0] == 'WAT' and len(seq) == 1:
                 mol_name = 'WAT'
-                water_mol_number, self.nwat, d, d = num
+                water_mol_number = mt.template
+                self.nwat = len(mt.mols)
             else:
-                if slen == 1:
+                # NOTE: different topologies may share a residue name
+                if len(seq) == 1 and seq[0] not in self.molidx:
                     mol_name = '%s' % seq[0]
                 else:
                     # FIXME: analyse names e.g. if protein, etc.
                     mcnt += 1
                     mol_name = 'MOL%i' % mcnt
 
-                mols_tmp.append( (num[0], mol_name, num[1]) )
+                mols_tmp.append( (mt.template, mol_name, len(mt.mols) ) )
 
-            self.molidx[mol_name] = (num[2], num[3])
+            type_names.append(mol_name)
+            self.molidx[mol_name] = (parm.type_atoms(itype), mt.natoms)
 
-        # third pass only over unique molecules (molecule types)
-        for num, mol_name, mol_cnt in mols_tmp:
-            mol = mols.at(num).molecule()
-            is_atom = False
+        # FIXME: we need to preserve molecule order, e.g. ions may be
+        #        alternating
+        for itype in parm.mol_type:
+            if type_names[itype] != 'WAT':
+                self.moltypes.append( (type_names[itype], 1) )
 
-            try:
-                params = mol.property('amberparameters') # Sire.Mol.AmberParameters
-            except UserWarning:
-                is_atom = True
 
+        # only over unique molecules (molecule types)
+        for imol, mol_name, mol_cnt in mols_tmp:
+            start, end = parm.mol_atoms(imol)
             moltype = self.top.pushMolType(mol_name)
 
-            for atom in mol.atoms():
-                ambertype = str(atom.property('ambertype') )
-
-                # FIXME: combine with loop above
-                if ambertype[0].isdigit():
-                    ambertype = ATOM_PREFIX + ambertype
+            for i in range(start, end):
+                moltype.atoms.append( (types[i], resnames[i],
+                                       str(parm.names[i]), parm.charges[i],
+                                       parm.masses[i]) )
 
-                charge = atom.property('charge').value()
-                mass = atom.property('mass').value()
+            bidx = parm.mol_terms(imol, parm.bonds)
 
-                atom_name = str(atom.name().value() )
-                resname = str(atom.residue().name().value() )
-
-                moltype.atoms.append( (ambertype, resname, atom_name, charge,
-                                       mass) )
-
-            if is_atom:
-                continue
-
-            try:
-                mol.property('bond')
-            except UserWarning:
+            if not len(bidx):
                 continue
 
-            for bond in params.getAllBonds():  # Sire.Mol.BondID
-                at0 = bond.atom0()  # Sire.Mol.AtomIdx!
-                at1 = bond.atom1()
+            off = 1 - start
 
-                k, r = params.getParams(bond)
-
-                # x100 because kJ/nm
-                moltype.bonds.append( (at0.value() + 1, at1.value() + 1,
-                                       r * const.A2NM, 200.0 * k * const.CAL2J) )
+            # x100 because kJ/nm
+            for b in bidx:
+                at0, at1 = parm.bonds[b]
+                moltype.bonds.append( (at0 + off, at1 + off,
+                                       parm.bond_r[b] * const.A2NM,
+                                       200.0 * parm.bond_k[b] * const.CAL2J) )
 
             moltype.bonds.sort()
 
 
-            try:
-                mol.property('angle')
-            except UserWarning:
-                continue
-
-            for angle in params.getAllAngles():  # Sire.Mol.AngleID
-                at0 = angle.atom0()  # Sire.Mol.AtomIdx!
-                at1 = angle.atom1()
-                at2 = angle.atom2()
-
-                k, theta = params.getParams(angle)
-                moltype.angles.append( (at0.value() + 1, at1.value() + 1,
-                                        at2.value() + 1, theta * const.RAD2DEG,
-                                        2.0 * k * const.CAL2J) )
+            for a in parm.mol_terms(imol, parm.angles):
+                at0, at1, at2 = parm.angles[a]
+                moltype.angles.append( (at0 + off, at1 + off, at2 + off,
+                                        parm.angle_theta[a] * const.RAD2DEG,
+                                        2.0 * parm.angle_k[a] * const.CAL2J) )
 
             moltype.angles.sort()
 
 
-            try:
-                mol.property('dihedral')
-            except UserWarning:
-                continue
-
-            intrascale = mol.property('intrascale')
-
-            for dihedral in params.getAllDihedrals():  # Sire.Mol.DihedralID
-                at0 = dihedral.atom0()  # Sire.Mol.AtomIdx!
-                at1 = dihedral.atom1()
-                at2 = dihedral.atom2()
-                at3 = dihedral.atom3()
+            didx = parm.mol_terms(imol, parm.dihedrals)
+            propers = OrderedDict()
 
-                at0idx = at0.value() + 1
-                at3idx = at3.value() + 1
+            for d in didx:
+                at0, at1, at2, at3 = parm.dihedrals[d] + off
 
-                p = params.getParams(dihedral)
-                x = []
+                if parm.dihedral_improper[d]:
+                    moltype.impropers.append( (at0, at1, at2, at3,
+                                       parm.dihedral_phase[d] * const.RAD2DEG,
+                                       parm.dihedral_k[d] * const.CAL2J,
+                                       parm.dihedral_n[d]) )
+                    continue
 
-                n = 3
-                for i in range(0, len(p), n):       # k, np, phase
-                    x.append(p[i:i+n])
+                # k, np, phase
+                propers.setdefault( (at0, at1, at2, at3), []).append(
+                    (parm.dihedral_k[d], parm.dihedral_n[d],
+                     parm.dihedral_phase[d]) )
 
-                moltype.propers.append( (at0idx, at1.value() + 1,
-                                         at2.value() + 1, at3idx, x) )
+            for atoms, x in propers.iteritems():
+                moltype.propers.append(atoms + (x,) )
 
-                sf = intrascale.get(at0, at3)
+            for d in parm.pairs14(didx):
+                at0 = parm.dihedrals[d][0] + off
+                at3 = parm.dihedrals[d][3] + off
 
-                if not (sf.lj() == sf.coulomb() == 0.0):
-                    if not (at3idx, at0idx) in moltype.pairs:
-                        moltype.pairs.add( (at0idx, at3idx) )
+                if not (at3, at0) in moltype.pairs:
+                    moltype.pairs.add( (at0, at3) )
 
             moltype.propers.sort()
-
-
-            try:
-                mol.property('improper')
-            except UserWarning:
-                continue
-
-            for dihedral in params.getAllImpropers():
-                at0 = dihedral.atom0()
-                at1 = dihedral.atom1()
-                at2 = dihedral.atom2()
-                at3 = dihedral.atom3()
-
-                pk, pn, phase = params.getParams(dihedral)
-
-                moltype.impropers.append( (at0.value() + 1, at1.value() + 1,
-                                           at2.value() + 1, at3.value() + 1,
-                                           phase * const.RAD2DEG,
-                                           pk * const.CAL2J, pn) )
-
             moltype.impropers.sort()
 
 
         if self.nwat:
-            wmol = mols.at(water_mol_number).molecule()
-            parms = wmol.property('amberparameters')
+            start, end = parm.mol_atoms(water_mol_number)
+            bidx = parm.mol_terms(water_mol_number, parm.bonds)
 
             # FIXME: rather weak tests
-            if wmol.nAtoms() == 4:
+            if end - start == 4:
                 self.top.specials = TIP4PEW_header
-            elif parms.getParams(parms.getAllBonds()[0])[0] == 553:
+            elif parm.bond_k[bidx[0] ] == 553:
                 self.top.specials = TIP3P_header
             else:
                 self.top.specials = SPCE_header
 
-        self.mol_numbers = mol_numbers
-        self.mols = mols
+        self.parm = parm
 
 
     def addAtomTypes(self, atomtypes):
@@ -641,92 +538,22 @@ class GromacsTop(object):
             top.write('\n\n')
 
 
-    def unwrap(self, coords, boxx, boxy, boxz):
+    def unwrap(self, coords, box):
         """
         Unwrap coordinates because Gromacs uses atom-based wrapping.
 
-        The current code assumes largest molecule is not larger than the
-        box minus an arbitrary buffer.  Possible alternative: check all
-        bonds an move atom if bond length is larger than half the box
-        length.
-
-        :param coords: flat list of coordinates
-        :type coords: list
-        :param boxx: box dimension in x direction
-        :type boxx: float
-        :param boxy: box dimension in y direction
-        :type boxy: float
-        :param boxz: box dimension in z direction
-        :type boxz: float
-        """
-
-        offset = 0
-
-        # FIXME: arbitrary buffer, unwrapping may fail?
-        maxx = (boxx - BOX_BUFFER)**2
-        maxy = (boxy - BOX_BUFFER)**2
-        maxz = (boxz - BOX_BUFFER)**2
-
-        boxx2 = boxx / 2.0
-        boxy2 = boxy / 2.0
-        boxz2 = boxz / 2.0
+        Molecules are made whole by following the minimum image from atom
+        to atom, see parm7.unwrap().
 
-        for num in self.mol_numbers:
-            mol = self.mols.at(num).molecule()
-            natoms = mol.nAtoms()
-
-            first = True
-
-            for residue in mol.residues():
-                for atom in residue.atoms():
-                    idx = 3 * (atom.index().value() + offset)
-
-                    if first:
-                        x0 = coords[idx]
-                        y0 = coords[idx+1]
-                        z0 = coords[idx+2]
-
-                        if x0 > boxx:
-                            coords[idx] -= math.copysign(boxx, x1)
-
-                        if y0 > boxy:
-                            coords[idx+1] -= math.copysign(boxy, y1)
-
-                        if z0 > boxz:
-                            coords[idx+2] -= math.copysign(boxz, z1)
-
-                        first = False
-                        continue
-
-                    x1 = coords[idx]
-                    y1 = coords[idx+1]
-                    z1 = coords[idx+2]
-
-                    xd = (x0 - x1)**2
-                    yd = (y0 - y1)**2
-                    zd = (z0 - z1)**2
-
-                    # FIXME: orthorombic only
-                    if xd > maxx:
-                        if x1 > boxx2:
-                            coords[idx] -= boxx
-                        else:
-                            coords[idx] += boxx
-
-                    if yd > maxy:
-                        if y1 > boxy2:
-                            coords[idx+1] -= boxy
-                        else:
-                            coords[idx+1] += boxy
-
-                    if zd > maxz:
-                        if z1 > boxz2:
-                            coords[idx+2] -= boxz
-                        else:
-                            coords[idx+2] += boxz
-
-            offset += natoms
+        :param coords: coordinates
+        :type coords: (N,3) array-like
+        :param box: box lengths or cell vectors
+        :type box: sequence
+        :returns: unwrapped coordinates
+        :rtype: (N,3) numpy.ndarray
+        """
 
+        return parm7.unwrap(coords, self.parm.mol_start, box)
 
     def __len__(self):
         return len(self.top)
@@ -26,6 +26,10 @@ __revision__ = "$Id$"
 
 
 
+# name of the unit stored in OFF libraries, see leaplib
+LIBRARY_UNIT = 'receptor'
+
+
 class Leap(object):
     """
     Hold data/commands for leap input.
@@ -51,7 +55,8 @@ class Leap(object):
         
         :param mol_file: filename of the input structure
         :type mol_file: string
-        :param ftype: file type of the input structure, either PDB or mol2
+        :param ftype: file type of the input structure, either PDB, mol2 or
+           off for a library from leaplib
         :type ftype: str
         :param mods: file name of frcmods
         :type mods: list
@@ -66,7 +71,9 @@ class Leap(object):
         self.force_fields.add(ff)
 
 
-    def generate_init(self):
+    def generate_ff(self):
+        """Leap commands to load the force fields."""
+
         leap_cmds = []
 
         for ff in self.force_fields:
@@ -77,6 +84,12 @@ class Leap(object):
         for up in self.user_params:
             leap_cmds(up)
 
+        return '\n'.join(leap_cmds)
+
+
+    def generate_init(self):
+        leap_cmds = [self.generate_ff()]
+
         load_cmd = {'pdb': 'loadPDB', 'mol2': 'loadmol2'}
 
         mnames = []
@@ -94,7 +107,13 @@ class Leap(object):
 
             mname = 'cmp' + str(mol_cnt)
             mnames.append(mname)
-            leap_cmds.append('%s = %s "%s"' % (mname, load_cmd[ftype], mol_file))
+
+            if ftype == 'off':
+                leap_cmds.append('loadOff "%s"\n%s = copy %s' %
+                                 (mol_file, mname, LIBRARY_UNIT) )
+            else:
+                leap_cmds.append('%s = %s "%s"' % (mname, load_cmd[ftype],
+                                                   mol_file) )
 
             if pert:
                 set_pert = ''
@@ -0,0 +1,131 @@
+#  Copyright (C) 2017  Hannes H Loeffler
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#  For full details of the license please see the COPYING file
+#  that should have come with this distribution.
+
+r'''
+On-disk store of leap OFF libraries for the receptor part of complexes.
+
+Leap has to template every residue of a PDB file, add missing atoms and
+apply the disulfide bonds each time a complex is built.  The receptor unit is
+therefore built once and saved as an OFF library which later complex builds
+load with loadOff.  A library is identified by the force field commands, the
+content of the PDB file and the disulfide bonds.  The store is disabled as
+long as library_dir is not set.
+'''
+
+__revision__ = "$Id$"
+
+
+
+import os
+import hashlib
+import tempfile
+
+from FESetup import errors, logger
+from leap import LIBRARY_UNIT
+from common import ssbonds
+import utils
+
+
+
+# absolute path of the library directory, None disables the store
+library_dir = None
+
+
+def _digest(ff_cmds, pdb_file, pairs):
+    """
+    Compute the library key from force field, PDB content and SS-bonds.
+    """
+
+    sha = hashlib.sha1()
+    sha.update('%s\n%r\n' % (ff_cmds, pairs) )
+
+    with open(pdb_file, 'rb') as pdb:
+        sha.update(pdb.read() )
+
+    return sha.hexdigest()
+
+
+def get_library(leap, pdb_file, ss_file=''):
+    """
+    Get the OFF library for the receptor in a PDB file, building it with
+    leap if it does not exist yet.  The disulfide bonds are part of the
+    library unit.
+
+    :param leap: the leap setup of the complex, for the force fields
+    :type leap: Leap
+    :param pdb_file: receptor PDB file name
+    :type pdb_file: string
+    :param ss_file: file with SS-bond information, see common.ssbonds()
+    :type ss_file: string
+    :returns: library file name or None if the store is disabled
+    :rtype: string
+    :raises: SetupError
+    """
+
+    if not library_dir:
+        return None
+
+    if ss_file:
+        pairs = ssbonds(ss_file)
+    else:
+        pairs = []
+
+    ff_cmds = leap.generate_ff()
+
+    try:
+        key = _digest(ff_cmds, pdb_file, pairs)
+    except IOError as why:
+        raise errors.SetupError('cannot read %s: %s' % (pdb_file, why) )
+
+    library = os.path.join(library_dir, key + os.extsep + 'off')
+
+    if os.path.isfile(library):
+        logger.write('Using leap library %s for %s' % (library, pdb_file) )
+        return library
+
+    try:
+        if not os.path.isdir(library_dir):
+            os.makedirs(library_dir)
+
+        fd, tmp = tempfile.mkstemp(dir=library_dir)
+        os.close(fd)
+        os.remove(tmp)              # saveOff adds to existing libraries
+    except OSError as why:
+        raise errors.SetupError('cannot create leap library in %s: %s' %
+                                (library_dir, why) )
+
+    leapin = [ff_cmds,
+              '%s = loadPDB "%s"' % (LIBRARY_UNIT, os.path.abspath(pdb_file) )]
+
+    for a, b in pairs:
+        leapin.append('bond %s.%i.SG %s.%i.SG' %
+                      (LIBRARY_UNIT, a, LIBRARY_UNIT, b) )
+
+    leapin.append('saveOff %s "%s"\nquit\n' % (LIBRARY_UNIT, tmp) )
+
+    utils.run_leap('', '', 'tleap', '\n'.join(leapin) )
+
+    if not os.path.isfile(tmp) or os.path.getsize(tmp) == 0:
+        raise errors.SetupError('Leap did not create the library for %s' %
+                                pdb_file)
+
+    os.rename(tmp, library)
+    logger.write('Created leap library %s for %s' % (library, pdb_file) )
+
+    return library
@@ -680,8 +680,13 @@ class Ligand(Common):
         # Strangely, sleap does not create sander compatible top files with
         # TIP4P but tleap does.  Sleap also crashes when @<TRIPOS>SUBSTRUCTURE
         # is missing.  Sleap has apparently been abandonded.
+        ionize = boxtype and (neutralize == 2 or conc > 0.0)
+
         utils.run_leap(self.amber_top, self.amber_crd, 'tleap', leapin)
 
+        if ionize:
+            self.add_ions(conc, dens)
+
         # create DL_FIELD UDFF/PDB for vacuum case
         if not boxtype:
             amber = Sire.IO.Amber()
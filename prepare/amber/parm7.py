@@ -0,0 +1,811 @@
+#  Copyright (C) 2016  Hannes H Loeffler
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#  For full details of the license please see the COPYING file
+#  that should have come with this distribution.
+
+r'''
+Native reader for AMBER parm7 topology files and ASCII or NetCDF restart
+files, and writer for ASCII restarts.  All data is stored in NumPy column
+arrays such that the topology converters can work on whole systems without
+walking atoms one at a time.
+
+Atom indices are always 0-based.  Units are those of AMBER: charges in e,
+lengths in Angstrom, energies in kcal/mol, angles in radians.
+'''
+
+__revision__ = "$Id$"
+
+
+
+import re
+import itertools
+
+import numpy as np
+from scipy.io import netcdf_file
+
+from parmed import periodic_table
+
+from FESetup import errors
+
+
+
+AMBER_CHARGE_CONV = 18.2223
+
+# POINTERS section, 0-based
+NATOM = 0
+NTYPES = 1
+NRES = 11
+IFBOX = 27
+
+DEFAULT_SCEE = 1.2
+DEFAULT_SCNB = 2.0
+
+NETCDF_MAGIC = b'CDF'
+
+_FORMAT_RE = re.compile(r'%FORMAT\((\d*)([aAiIeEfF])(\d+)')
+
+
+
+def _parse_section(lines, fmt, filename, flag):
+    """
+    Convert the data lines of a %FLAG section to a NumPy array.
+
+    :param lines: data lines of the section
+    :type lines: list
+    :param fmt: Fortran format type and width
+    :type fmt: tuple
+    :param filename: name of the parm7 file, for error messages
+    :type filename: string
+    :param flag: name of the section, for error messages
+    :type flag: string
+    :raises: SetupError
+    :returns: section data
+    :rtype: numpy.ndarray
+    """
+
+    typ, width = fmt
+
+    # NOTE: fixed width because integers may fill the whole field; lines
+    #       with trailing blanks stripped are padded back
+    padded = []
+
+    for line in lines:
+        rem = len(line) % width
+
+        if rem:
+            line += ' ' * (width - rem)
+
+        padded.append(line)
+
+    data = ''.join(padded)
+
+    if not isinstance(data, bytes):
+        data = data.encode('ascii')
+
+    raw = np.frombuffer(data, dtype='S%i' % width)
+
+    if typ == 'a':
+        return np.array([s.strip().decode('ascii') for s in raw], dtype=object)
+
+    try:
+        if typ == 'i':
+            return raw.astype(np.int64)
+        else:
+            return raw.astype(np.float64)
+    except ValueError as why:
+        raise errors.SetupError('%s: malformed %%FLAG %s section: %s' %
+                                (filename, flag, why) )
+
+
+def read_sections(filename):
+    """
+    Read all %FLAG sections of a parm7 file.
+
+    :param filename: name of the parm7 file
+    :type filename: string
+    :raises: SetupError
+    :returns: section data keyed by flag name
+    :rtype: dict
+    """
+
+    try:
+        with open(filename, 'r') as parm:
+            text = parm.read()
+    except IOError as why:
+        raise errors.SetupError('cannot read %s: %s' % (filename, why) )
+
+    sections = {}
+
+    for chunk in text.split('%FLAG')[1:]:
+        lines = chunk.splitlines()
+        flag = lines[0].strip()
+
+        fmt = None
+        data = []
+
+        for line in lines[1:]:
+            if line.startswith('%FORMAT'):
+                m = _FORMAT_RE.match(line)
+
+                if not m:
+                    raise errors.SetupError('%s: unknown format %s' %
+                                            (filename, line.strip() ) )
+
+                fmt = (m.group(2).lower(), int(m.group(3) ) )
+            elif line.startswith('%COMMENT'):
+                continue
+            else:
+                data.append(line.rstrip('\r') )
+
+        if not fmt:
+            raise errors.SetupError('%s: missing %%FORMAT for %%FLAG %s' %
+                                    (filename, flag) )
+
+        if fmt[0] == 'f':
+            fmt = ('e', fmt[1])
+
+        sections[flag] = _parse_section(data, fmt, filename, flag)
+
+    if 'POINTERS' not in sections:
+        raise errors.SetupError('%s is not a parm7 file' % filename)
+
+    return sections
+
+
+def read_rst7(filename, natoms=None):
+    """
+    Read an AMBER ASCII restart or inpcrd file.
+
+    :param filename: name of the rst7 file
+    :type filename: string
+    :param natoms: expected number of atoms
+    :type natoms: int
+    :raises: SetupError
+    :returns: coordinates (N,3), velocities (N,3) or None, box (6) or None
+    :rtype: tuple
+    """
+
+    try:
+        with open(filename, 'r') as rst:
+            rst.readline()
+            line = rst.readline()
+            rest = rst.read().splitlines()
+    except IOError as why:
+        raise errors.SetupError('cannot read %s: %s' % (filename, why) )
+
+    try:
+        nat = int(line.split()[0])
+    except (IndexError, ValueError):
+        raise errors.SetupError('%s: malformed atom count line' % filename)
+
+    if natoms is not None and nat != natoms:
+        raise errors.SetupError('%s has %i atoms but topology has %i' %
+                                (filename, nat, natoms) )
+
+    data = _parse_section(rest, ('e', 12), filename, 'coordinates')
+    ncrd = 3 * nat
+    nval = len(data)
+
+    if nval not in (ncrd, ncrd + 6, 2 * ncrd, 2 * ncrd + 6):
+        raise errors.SetupError('%s: unexpected number of values %i for %i '
+                                'atoms' % (filename, nval, nat) )
+
+    coords = data[:ncrd].reshape(nat, 3)
+    vels = None
+    box = None
+
+    if nval in (2 * ncrd, 2 * ncrd + 6):
+        vels = data[ncrd:2*ncrd].reshape(nat, 3)
+
+    if nval in (ncrd + 6, 2 * ncrd + 6) and nval != 2 * ncrd:
+        box = data[-6:].copy()
+
+    return coords, vels, box
+
+
+def _format_6f12(values):
+    """
+    Format values in the rst7 6F12.7 layout.
+    """
+
+    values = np.asarray(values, dtype=np.float64).ravel()
+    nfull = len(values) // 6 * 6
+
+    text = ('%12.7f' * 6 + '\n') * (nfull // 6) % tuple(values[:nfull])
+
+    if nfull < len(values):
+        text += ('%12.7f' * (len(values) - nfull) + '\n') % \
+                tuple(values[nfull:])
+
+    return text
+
+
+def write_rst7(filename, coords, vels=None, box=None,
+               title='converted with FESetup', time=0.0):
+    """
+    Write an AMBER ASCII restart file in bulk.
+
+    :param filename: name of the rst7 file
+    :type filename: string
+    :param coords: coordinates
+    :type coords: (N,3) array-like
+    :param vels: velocities
+    :type vels: (N,3) array-like or None
+    :param box: box lengths, lengths and angles or cell matrix
+    :type box: sequence or None
+    :param title: title line
+    :type title: string
+    :param time: simulation time in ps
+    :type time: float
+    """
+
+    coords = np.asarray(coords, dtype=np.float64).reshape(-1, 3)
+
+    with open(filename, 'w') as rst:
+        rst.write(title[:80] + '\n')
+        rst.write('%5i%15.7f\n' % (len(coords), time) )
+        rst.write(_format_6f12(coords) )
+
+        if vels is not None:
+            rst.write(_format_6f12(vels) )
+
+        if box is not None:
+            rst.write(_format_6f12(box_parameters(box) ) )
+
+
+def is_netcdf(filename):
+    """
+    Check if a file is in NetCDF format.
+
+    :param filename: name of the file
+    :type filename: string
+    :rtype: bool
+    """
+
+    try:
+        with open(filename, 'rb') as ncf:
+            return ncf.read(len(NETCDF_MAGIC) ) == NETCDF_MAGIC
+    except IOError as why:
+        raise errors.SetupError('cannot read %s: %s' % (filename, why) )
+
+
+def read_ncrst(filename, natoms=None):
+    """
+    Read an AMBER NetCDF restart file.  Velocities are returned in the same
+    internal AMBER units as in ASCII restarts.
+
+    :param filename: name of the NetCDF restart file
+    :type filename: string
+    :param natoms: expected number of atoms
+    :type natoms: int
+    :raises: SetupError
+    :returns: coordinates (N,3), velocities (N,3) or None, box (6) or None
+    :rtype: tuple
+    """
+
+    try:
+        ncf = netcdf_file(filename, 'r', mmap=False)
+    except (IOError, TypeError, ValueError) as why:
+        raise errors.SetupError('cannot read %s: %s' % (filename, why) )
+
+    try:
+        if getattr(ncf, 'Conventions', b'') not in (b'AMBERRESTART',
+                                                    'AMBERRESTART'):
+            raise errors.SetupError('%s is not an AMBER NetCDF restart file'
+                                    % filename)
+
+        ncvars = ncf.variables
+
+        if 'coordinates' not in ncvars:
+            raise errors.SetupError('%s has no coordinates' % filename)
+
+        coords = np.array(ncvars['coordinates'][:], dtype=np.float64)
+        nat = coords.shape[0]
+
+        if natoms is not None and nat != natoms:
+            raise errors.SetupError('%s has %i atoms but topology has %i' %
+                                    (filename, nat, natoms) )
+
+        vels = None
+        box = None
+
+        if 'velocities' in ncvars:
+            vels = np.array(ncvars['velocities'][:], dtype=np.float64)
+
+        if 'cell_lengths' in ncvars and 'cell_angles' in ncvars:
+            box = np.append(ncvars['cell_lengths'][:],
+                            ncvars['cell_angles'][:]).astype(np.float64)
+    finally:
+        ncf.close()
+
+    return coords, vels, box
+
+
+def read_restart(filename, natoms=None):
+    """
+    Read an AMBER restart file in either ASCII or NetCDF format.
+
+    :param filename: name of the restart file
+    :type filename: string
+    :param natoms: expected number of atoms
+    :type natoms: int
+    :raises: SetupError
+    :returns: coordinates (N,3), velocities (N,3) or None, box (6) or None
+    :rtype: tuple
+    """
+
+    if is_netcdf(filename):
+        return read_ncrst(filename, natoms)
+
+    return read_rst7(filename, natoms)
+
+
+def _row_codes(table):
+    """
+    Integer code for every row of a 2D integer table such that equal rows
+    have equal codes.
+    """
+
+    table = np.ascontiguousarray(table)
+    rows = table.view(np.dtype( (np.void, table.dtype.itemsize *
+                                 table.shape[1]) ) ).ravel()
+
+    return np.unique(rows, return_inverse=True)[1]
+
+
+def _terms_by_mol(mol_index, mol_start, atoms):
+    """
+    Sort a table of bonded terms by molecule and make the atom indices
+    relative to the molecule.
+
+    :returns: relative atom indices, start offset of each molecule
+    :rtype: numpy.ndarray, numpy.ndarray
+    """
+
+    mol = mol_index[atoms[:, 0]]
+    order = np.argsort(mol, kind='mergesort')
+    mol = mol[order]
+
+    rel = atoms[order] - mol_start[mol][:, np.newaxis]
+    start = np.searchsorted(mol, np.arange(len(mol_start) ) )
+
+    return rel, start
+
+
+class MoleculeType(object):
+    """A unique molecule topology and all the molecules sharing it."""
+
+    __slots__ = ['template', 'mols', 'natoms', 'res_names']
+
+    def __init__(self, template, natoms, res_names):
+        self.template = template        # index of first molecule
+        self.mols = [template]
+        self.natoms = natoms
+        self.res_names = res_names
+
+
+class Parm7(object):
+    """
+    Column store of an AMBER parm7 topology and, optionally, an rst7 file.
+    """
+
+    def __init__(self, parmtop, inpcrd=None):
+        """
+        :param parmtop: parm7 file name
+        :type parmtop: string
+        :param inpcrd: rst7 file name
+        :type inpcrd: string
+        :raises: SetupError
+        """
+
+        self.parmtop = parmtop
+        self.inpcrd = inpcrd
+
+        sec = read_sections(parmtop)
+        pointers = sec['POINTERS']
+
+        self.natoms = int(pointers[NATOM])
+        self.ntypes = int(pointers[NTYPES])
+        self.nres = int(pointers[NRES])
+        self.ifbox = int(pointers[IFBOX])
+
+        N = self.natoms
+
+        self.names = sec['ATOM_NAME']
+        self.types = sec['AMBER_ATOM_TYPE']
+        self.charges = sec['CHARGE'] / AMBER_CHARGE_CONV
+        self.masses = sec['MASS']
+        self.type_index = sec['ATOM_TYPE_INDEX'] - 1
+
+        if 'ATOMIC_NUMBER' in sec:
+            self.atomic_numbers = sec['ATOMIC_NUMBER']
+        else:
+            self.atomic_numbers = np.array(
+                [periodic_table.AtomicNum[periodic_table.element_by_mass(m)]
+                 for m in self.masses], dtype=np.int64)
+
+        # residues
+        self.res_names = sec['RESIDUE_LABEL']
+        self.res_start = np.append(sec['RESIDUE_POINTER'] - 1, N)
+        self.res_index = np.repeat(np.arange(self.nres),
+                                   np.diff(self.res_start) )
+
+        # Lennard-Jones from the A/B coefficient tables
+        ntypes = self.ntypes
+        nbidx = sec['NONBONDED_PARM_INDEX'].reshape(ntypes, ntypes)
+        diag = nbidx[np.arange(ntypes), np.arange(ntypes)] - 1
+
+        acoef = np.where(diag >= 0, sec['LENNARD_JONES_ACOEF'][diag], 0.0)
+        bcoef = np.where(diag >= 0, sec['LENNARD_JONES_BCOEF'][diag], 0.0)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            sigma = np.where(bcoef > 0.0,
+                             np.power(acoef / bcoef, 1.0 / 6.0), 0.0)
+            epsilon = np.where(acoef > 0.0, bcoef**2 / (4.0 * acoef), 0.0)
+
+        self.sigma = sigma[self.type_index]
+        self.epsilon = epsilon[self.type_index]
+
+        # bonded terms
+        bonds = np.concatenate( (sec['BONDS_INC_HYDROGEN'],
+                                 sec['BONDS_WITHOUT_HYDROGEN']) ).reshape(-1, 3)
+        self.bonds = bonds[:, :2] // 3
+        self.bond_k = sec['BOND_FORCE_CONSTANT'][bonds[:, 2] - 1]
+        self.bond_r = sec['BOND_EQUIL_VALUE'][bonds[:, 2] - 1]
+
+        angles = np.concatenate( (sec['ANGLES_INC_HYDROGEN'],
+                                  sec['ANGLES_WITHOUT_HYDROGEN']) ).reshape(-1, 4)
+        self.angles = angles[:, :3] // 3
+        self.angle_k = sec['ANGLE_FORCE_CONSTANT'][angles[:, 3] - 1]
+        self.angle_theta = sec['ANGLE_EQUIL_VALUE'][angles[:, 3] - 1]
+
+        dihedrals = np.concatenate( (sec['DIHEDRALS_INC_HYDROGEN'],
+                                     sec['DIHEDRALS_WITHOUT_HYDROGEN']) ) \
+                                     .reshape(-1, 5)
+        dtype = dihedrals[:, 4] - 1
+
+        # NOTE: negative third index: no 1-4 for this term,
+        #       negative fourth index: improper
+        self.dihedral_no14 = dihedrals[:, 2] < 0
+        self.dihedral_improper = dihedrals[:, 3] < 0
+        self.dihedrals = np.abs(dihedrals[:, :4]) // 3
+        self.dihedral_k = sec['DIHEDRAL_FORCE_CONSTANT'][dtype]
+        self.dihedral_n = sec['DIHEDRAL_PERIODICITY'][dtype]
+        self.dihedral_phase = sec['DIHEDRAL_PHASE'][dtype]
+
+        ntyp = len(sec['DIHEDRAL_FORCE_CONSTANT'])
+
+        if 'SCEE_SCALE_FACTOR' in sec:
+            scee = sec['SCEE_SCALE_FACTOR']
+        else:
+            scee = np.full(ntyp, DEFAULT_SCEE)
+
+        if 'SCNB_SCALE_FACTOR' in sec:
+            scnb = sec['SCNB_SCALE_FACTOR']
+        else:
+            scnb = np.full(ntyp, DEFAULT_SCNB)
+
+        self.dihedral_scee = scee[dtype]
+        self.dihedral_scnb = scnb[dtype]
+
+        # molecules
+        if 'ATOMS_PER_MOLECULE' in sec:
+            self.mol_start = np.append(0, np.cumsum(sec['ATOMS_PER_MOLECULE']))
+        else:
+            self.mol_start = self._mol_start_from_bonds()
+
+        self.nmols = len(self.mol_start) - 1
+        self.mol_index = np.repeat(np.arange(self.nmols),
+                                   np.diff(self.mol_start) )
+
+        self.mol_type = None
+        self._moltypes = None
+
+        self.coords = None
+        self.velocities = None
+        self.box = None
+
+        if inpcrd:
+            self.coords, self.velocities, self.box = read_restart(inpcrd, N)
+
+
+    def _mol_start_from_bonds(self):
+        """
+        Find molecule boundaries assuming molecules are stored contiguously:
+        a molecule ends where no bond reaches beyond the current atom.
+        """
+
+        N = self.natoms
+        reach = np.arange(N)
+
+        if len(self.bonds):
+            lo = self.bonds.min(axis=1)
+            hi = self.bonds.max(axis=1)
+            np.maximum.at(reach, lo, hi)
+
+        reach = np.maximum.accumulate(reach)
+        ends = np.nonzero(reach == np.arange(N) )[0] + 1
+
+        return np.append(0, ends)
+
+
+    @property
+    def elements(self):
+        """Element symbols, 'EP' for massless extra points."""
+
+        symbols = np.array([periodic_table.Element[n] if n > 0 else 'EP'
+                            for n in self.atomic_numbers], dtype=object)
+
+        return symbols
+
+
+    @property
+    def box_dims(self):
+        """Box lengths or None if the system is not periodic."""
+
+        if self.box is None or not self.ifbox:
+            return None
+
+        return tuple(self.box[:3])
+
+
+    def mol_atoms(self, imol):
+        """Atom index range of molecule imol."""
+
+        return int(self.mol_start[imol]), int(self.mol_start[imol+1])
+
+
+    def mol_residues(self, imol):
+        """Residue index range of molecule imol."""
+
+        start, end = self.mol_atoms(imol)
+
+        return int(self.res_index[start]), int(self.res_index[end-1]) + 1
+
+
+    def mol_terms(self, imol, atoms):
+        """
+        Select the bonded terms of molecule imol.
+
+        :param imol: molecule index
+        :type imol: int
+        :param atoms: atom index table of the terms, e.g. self.bonds
+        :type atoms: numpy.ndarray
+        :returns: indices into the table
+        :rtype: numpy.ndarray
+        """
+
+        return np.nonzero(self.mol_index[atoms[:, 0]] == imol)[0]
+
+
+    def pairs14(self, terms=None):
+        """
+        The 1-4 pairs of the proper dihedrals as (N,2) array.  Every pair is
+        returned only once, from the first term that does not exclude it.
+
+        :param terms: restrict to these dihedral indices
+        :type terms: numpy.ndarray
+        :returns: indices into self.dihedrals
+        :rtype: numpy.ndarray
+        """
+
+        sel = ~(self.dihedral_no14 | self.dihedral_improper)
+
+        if terms is not None:
+            mask = np.zeros(len(sel), dtype=bool)
+            mask[terms] = True
+            sel &= mask
+
+        idx = np.nonzero(sel)[0]
+        ends = np.sort(self.dihedrals[idx][:, [0, 3]], axis=1)
+
+        if not len(ends):
+            return idx
+
+        first = np.unique(ends[:, 0] * self.natoms + ends[:, 1],
+                          return_index=True)[1]
+
+        return idx[np.sort(first)]
+
+
+    def molecule_types(self):
+        """
+        Group the molecules by topology.  Two molecules are of the same type
+        if they agree in atom names, types, charges, residue names and
+        connectivity.  The per-molecule type index is stored in mol_type.
+
+        :returns: molecule types in order of first appearance
+        :rtype: list of MoleculeType
+        """
+
+        if self._moltypes is not None:
+            return self._moltypes
+
+        atom_table = np.column_stack( (
+            np.unique(self.names, return_inverse=True)[1],
+            np.unique(self.types, return_inverse=True)[1],
+            np.unique(self.res_names, return_inverse=True)[1][self.res_index],
+            np.round(self.charges * 1.0e6).astype(np.int64) ) )
+        atom_codes = _row_codes(atom_table)
+
+        terms = [_terms_by_mol(self.mol_index, self.mol_start, atoms)
+                 for atoms in (self.bonds, self.angles, self.dihedrals)]
+
+        types = {}
+        self._moltypes = []
+        self.mol_type = np.empty(self.nmols, dtype=np.int64)
+
+        for imol in range(self.nmols):
+            start, end = self.mol_atoms(imol)
+
+            key = (atom_codes[start:end].tobytes(),) + tuple(
+                rel[tstart[imol]:tstart[imol+1]].tobytes()
+                for rel, tstart in terms)
+
+            try:
+                itype = types[key]
+                self._moltypes[itype].mols.append(imol)
+            except KeyError:
+                itype = len(self._moltypes)
+                types[key] = itype
+
+                rstart, rend = self.mol_residues(imol)
+                self._moltypes.append(MoleculeType(imol, end - start,
+                                          tuple(self.res_names[rstart:rend])) )
+
+            self.mol_type[imol] = itype
+
+        return self._moltypes
+
+
+    def type_atoms(self, itype):
+        """All atom indices of all molecules of molecule type itype."""
+
+        self.molecule_types()
+
+        return np.nonzero(self.mol_type[self.mol_index] == itype)[0]
+
+
+def cell_matrix(box):
+    """
+    Cell vectors as rows of a 3x3 matrix.
+
+    :param box: box lengths, lengths and angles (degrees) or a cell matrix
+    :type box: sequence
+    :returns: cell matrix
+    :rtype: numpy.ndarray
+    """
+
+    box = np.asarray(box, dtype=np.float64)
+
+    if box.size == 9:
+        return box.reshape(3, 3)
+
+    if box.size == 3:
+        return np.diag(box)
+
+    a, b, c = box[:3]
+    alpha, beta, gamma = np.radians(box[3:6])
+
+    cx = c * np.cos(beta)
+    cy = c * (np.cos(alpha) - np.cos(beta) * np.cos(gamma) ) / np.sin(gamma)
+
+    return np.array( ( (a, 0.0, 0.0),
+                       (b * np.cos(gamma), b * np.sin(gamma), 0.0),
+                       (cx, cy, np.sqrt(c * c - cx * cx - cy * cy) ) ) )
+
+
+def box_parameters(box):
+    """
+    Box lengths and angles (degrees) as used in rst7 files.
+
+    :param box: box lengths, lengths and angles or a cell matrix
+    :type box: sequence
+    :returns: a, b, c, alpha, beta, gamma
+    :rtype: numpy.ndarray
+    """
+
+    box = np.asarray(box, dtype=np.float64).ravel()
+
+    if box.size == 6:
+        return box
+
+    if box.size == 3:
+        return np.append(box, (90.0, 90.0, 90.0) )
+
+    cell = box.reshape(3, 3)
+    lengths = np.sqrt( (cell**2).sum(axis=1) )
+
+    def angle(i, j):
+        cos = cell[i].dot(cell[j]) / (lengths[i] * lengths[j])
+        return np.degrees(np.arccos(np.clip(cos, -1.0, 1.0) ) )
+
+    return np.append(lengths, (angle(1, 2), angle(0, 2), angle(0, 1) ) )
+
+
+def min_image_dist2(diff, box):
+    """
+    Squared minimum image lengths of difference vectors.  Works for any
+    triclinic cell including the truncated octahedron: after wrapping in
+    fractional coordinates the neighbouring images of a non-orthogonal cell
+    are searched too because plain rounding may miss the closest one.
+
+    :param diff: difference vectors
+    :type diff: (...,3) array-like
+    :param box: box lengths, lengths and angles or cell matrix
+    :type box: sequence
+    :returns: squared minimum image lengths
+    :rtype: (...) numpy.ndarray
+    """
+
+    cell = cell_matrix(box)
+
+    frac = np.asarray(diff, dtype=np.float64).dot(np.linalg.inv(cell) )
+    frac -= np.round(frac)
+
+    if np.allclose(cell, np.diag(np.diag(cell) ) ):
+        vec = frac.dot(cell)
+        return np.sum(vec * vec, axis=-1)
+
+    dist2 = None
+
+    for shift in itertools.product( (-1.0, 0.0, 1.0), repeat=3):
+        vec = (frac + shift).dot(cell)
+        d2 = np.sum(vec * vec, axis=-1)
+
+        dist2 = d2 if dist2 is None else np.minimum(dist2, d2)
+
+    return dist2
+
+
+def unwrap(coords, mol_start, box):
+    """
+    Make molecules whole after atom-based wrapping.  Every atom is moved to
+    the minimum image of the atom preceding it in the same molecule, and
+    each molecule is shifted as a whole such that its first atom is not
+    beyond the upper cell faces.  Works for any triclinic cell as long as
+    consecutive atoms are closer than half a cell width.
+
+    :param coords: coordinates
+    :type coords: (N,3) array-like
+    :param mol_start: start index of every molecule and total atom count
+    :type mol_start: numpy.ndarray
+    :param box: box lengths, lengths and angles or cell matrix
+    :type box: sequence
+    :returns: unwrapped coordinates
+    :rtype: (N,3) numpy.ndarray
+    """
+
+    coords = np.asarray(coords, dtype=np.float64).reshape(-1, 3)
+    cell = cell_matrix(box)
+
+    frac = coords.dot(np.linalg.inv(cell) )
+    starts = mol_start[:-1]
+
+    # integer cell shifts: minimum image step to the previous atom...
+    step = np.zeros(frac.shape)
+    step[1:] = -np.round(frac[1:] - frac[:-1])
+
+    # ...but not across molecules where the first atom is shifted instead
+    ref = frac[starts]
+    step[starts] = -np.floor(ref) * (ref > 1.0)
+
+    shift = np.cumsum(step, axis=0)
+    offset = shift[starts] - step[starts]
+    shift -= np.repeat(offset, np.diff(mol_start), axis=0)
+
+    return (frac + shift).dot(cell)
@@ -160,4 +160,9 @@ class Protein(Common):
                                         remove_first = False,
                                         conc=conc, dens=dens)
 
+        ionize = boxtype and (neutralize == 2 or conc > 0.0)
+
         utils.run_leap(self.amber_top, self.amber_crd, 'tleap', leapin)
+
+        if ionize:
+            self.add_ions(conc, dens)
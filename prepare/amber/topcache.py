@@ -0,0 +1,162 @@
+#  Copyright (C) 2017  Hannes H Loeffler
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#  For full details of the license please see the COPYING file
+#  that should have come with this distribution.
+
+r'''
+Process-wide cache of parsed AMBER topologies and AMBER mask selections.
+
+Entries are keyed on the absolute path of the parmtop file and validated
+against its size and modification time such that a rewritten file is parsed
+again.  Cached AmberParm objects are shared: callers which modify a topology
+must call forget() for that file.
+'''
+
+__revision__ = "$Id$"
+
+
+
+import os
+from collections import OrderedDict
+
+import numpy as np
+
+from parmed.amber.mask import AmberMask
+from parmed.amber.readparm import AmberParm
+
+
+
+# number of topologies kept in memory
+CACHE_SIZE = 4
+
+_cache = OrderedDict()
+
+
+class _Entry(object):
+    """Cached data of one parmtop file."""
+
+    __slots__ = ('stamp', 'parm', 'masks', 'periodic')
+
+    def __init__(self, stamp):
+        self.stamp = stamp
+        self.parm = None
+        self.masks = {}
+        self.periodic = None
+
+
+def _entry(parmtop):
+    """
+    Get the valid cache entry for a parmtop file, creating a new one if the
+    file is not cached or has changed on disk.
+    """
+
+    path = os.path.abspath(parmtop)
+    stat = os.stat(path)
+    stamp = (stat.st_size, stat.st_mtime)
+
+    entry = _cache.pop(path, None)
+
+    if not entry or entry.stamp != stamp:
+        entry = _Entry(stamp)
+
+    _cache[path] = entry
+
+    while len(_cache) > CACHE_SIZE:
+        _cache.popitem(last=False)
+
+    return entry
+
+
+def get_parm(parmtop):
+    """
+    Parsed topology of a parmtop file.  The returned object is shared.
+
+    :param parmtop: parmtop filename
+    :type parmtop: string
+    :returns: parsed topology
+    :rtype: AmberParm
+    """
+
+    entry = _entry(parmtop)
+
+    if entry.parm is None:
+        entry.parm = AmberParm(parmtop)
+
+    return entry.parm
+
+
+def mask_indexes(parmtop, mask):
+    """
+    Atom indexes selected by an AMBER mask.  The selection is memoised.
+
+    :param parmtop: parmtop filename
+    :type parmtop: string
+    :param mask: AMBER mask
+    :type mask: string
+    :returns: read-only array of 0-based atom indexes
+    :rtype: numpy.ndarray
+    """
+
+    entry = _entry(parmtop)
+
+    if mask not in entry.masks:
+        if entry.parm is None:
+            entry.parm = AmberParm(parmtop)
+
+        idx = np.fromiter(AmberMask(entry.parm, mask).Selected(),
+                          dtype=np.int64)
+        idx.flags.writeable = False
+        entry.masks[mask] = idx
+
+    return entry.masks[mask]
+
+
+def is_periodic(parmtop):
+    """
+    Check if AMBER topology file was made for a periodic system.
+
+    :param parmtop: the topology file to be checked for periodicity
+    :type parmtop: string
+    :rtype: bool
+    """
+
+    entry = _entry(parmtop)
+
+    if entry.periodic is None:
+        if entry.parm is not None:
+            entry.periodic = 'BOX_DIMENSIONS' in entry.parm.flag_list
+        else:
+            entry.periodic = False
+
+            with open(parmtop, 'r') as top:
+                for line in top:
+                    if line.startswith('%FLAG BOX_DIMENSIONS'):
+                        entry.periodic = True
+                        break
+
+    return entry.periodic
+
+
+def forget(parmtop):
+    """
+    Drop all cached data of a parmtop file.
+
+    :param parmtop: parmtop filename
+    :type parmtop: string
+    """
+
+    _cache.pop(os.path.abspath(parmtop), None)
@@ -29,7 +29,7 @@ import os
 
 import mdebase
 from FESetup import errors, logger
-from FESetup.prepare.amber import utils
+from FESetup.prepare.amber import parm7, topcache, utils
 
 
 
@@ -42,12 +42,7 @@ def is_periodic(topfile):
     :rtype: bool
     """
 
-    with open(topfile, 'r') as top:
-        for line in top:
-            if line.startswith("%FLAG BOX_DIMENSIONS"):
-                return True
-
-    return False
+    return topcache.is_periodic(topfile)
 
 
 class MDEngine(mdebase.MDEBase):
@@ -81,6 +76,9 @@ class MDEngine(mdebase.MDEBase):
         self.sander_rst = sander_rst
         self.amber_pdb = amber_pdb
 
+        # NetCDF restart of the last run, only handed on to the next run
+        self.nc_restart = ''
+
         if is_periodic(self.amber_top):
             self.min_periodic = ' ntb = 1,\n'
             self.md_periodic = ''           # must be in pre-defined namelist
@@ -196,17 +194,18 @@ class MDEngine(mdebase.MDEBase):
 
     def get_box_dims(self):
         """
-        Extract box information from rst7 file.
+        Extract box information from the ASCII or NetCDF restart file.
 
         :returns: box dimensions
         """
 
-        with open(self.sander_rst, 'r') as rst:
-            for line in rst:
-                box_dims = line
+        box_dims = parm7.read_restart(self.sander_rst)[2]
+
+        if box_dims is None:
+            return []
 
         # FIXME: rectangular box only
-        return [float(d) for d in box_dims.split()]
+        return [float(d) for d in box_dims]
 
 
     def _run_mdprog(self, prefix, namelist, mask, constp):
@@ -217,7 +216,8 @@ class MDEngine(mdebase.MDEBase):
         prefix += '%05i'
 
         prefix = prefix % self.run_no
-        self.sander_rst = prefix + mdebase.RST_EXT
+        self.sander_rst = prefix + mdebase.NCRST_EXT
+        restart = self.nc_restart or self.sander_crd
 
         with open(prefix + os.extsep + 'in', 'w') as mdin:
             mdin.writelines(namelist)
@@ -230,20 +230,27 @@ class MDEngine(mdebase.MDEBase):
         if mask:
             # Constant pressure with positional restraints shifts coordinates.
             if constp:
-                flags += ' -ref %s' % self.sander_crd
+                flags += ' -ref %s' % restart
             else:
                 flags += ' -ref %s' % self.amber_crd
 
         err = utils.run_amber(self.mdpref + ' ' + self.mdprog,
                               flags.format(prefix, self.amber_top,
-                                           self.sander_crd, self.sander_rst) )
+                                           restart, self.sander_rst) )
 
         if err:
             logger.write('sander/pmemd failed with message %s' % err[1])
             raise errors.SetupError('error in sander run %s: %s' %
                                     (prefix, err[1]) )
 
-        self.sander_crd = self.sander_rst
+        # the next run starts from the full precision NetCDF restart while
+        # sander_crd, and thus amber_crd, stays ASCII for leap, antechamber
+        # and Sire
+        coords, vels, box = parm7.read_ncrst(self.sander_rst)
+        self.sander_crd = prefix + mdebase.RST_EXT
+        parm7.write_rst7(self.sander_crd, coords, vels, box)
+
+        self.nc_restart = self.sander_rst
         self.run_no += 1
 
 
@@ -276,7 +283,7 @@ PROTOCOLS = dict(
    maxcyc = {0}, ncyc = {1},
    ntpr = {2}, ntwe = {2},
    dx0 = 1.0D-7,
-   ntxo = 1,  ! 2 is default in AMBER16 for NetCDF file
+   ntxo = 2,
    ntc = 2, noshakemask = '!:WAT,HOH,T3P,T4P,T4E',
    {3}
  /
@@ -288,7 +295,7 @@ PROTOCOLS = dict(
    maxcyc = {0}, ncyc = {1},
    ntpr = {2}, ntwe = {2},
    dx0 = 1.0D-7,
-   ntxo = 1,  ! 2 is default in AMBER16 for NetCDF file
+   ntxo = 2,
    {3}
  /
 ''',
@@ -301,7 +308,7 @@ PROTOCOLS = dict(
    ntb = 2,
    ntc = 2, ntf = 2,
    ioutfm = 1, iwrap = {4},
-   ntxo = 1,  ! 2 is default in AMBER16 for NetCDF file
+   ntxo = 2,
    ntwe = {1}, ntwx = {1}, ntpr = {2},
    {3}
  /
@@ -314,13 +321,12 @@ PROTOCOLS = dict(
    ntb = 1,
    ntc = 2, ntf = 2,
    ioutfm = 1, iwrap = {4},
-   ntxo = 1,  ! 2 is default in AMBER16 for NetCDF file
+   ntxo = 2,
    ntwe = {1}, ntwx = {1}, ntpr = {2},
    {3}
  /
 ''',
     
-# we may later want to add ntxo = 2, i.e. restart file in NetCDF format
     MD_HEAT = '''heat the system
  &cntrl
    imin = 0, nstlim = {0}, irest = 0, ntx = 1, dt = {7},
@@ -329,7 +335,7 @@ PROTOCOLS = dict(
    ntb = 1, pres0 = {6},
    ntc = 2, ntf = 2,
    ioutfm = 1, iwrap = {4},
-   ntxo = 1,  ! 2 is default in AMBER16 for NetCDF file
+   ntxo = 2,
    ntwe = {1}, ntwx = {1}, ntpr = {2},
    {3}
  /
@@ -351,7 +357,7 @@ PROTOCOLS = dict(
    ntb = 1,
    ntc = 2, ntf = 2,
    ioutfm = 1, iwrap = {4},
-   ntxo = 1,  ! 2 is default in AMBER16 for NetCDF file
+   ntxo = 2,
    ntwe = {1}, ntwx = {1}, ntpr = {2},
    {3}
  /
@@ -367,7 +373,7 @@ PROTOCOLS = dict(
    ntc = 2, ntf = 2,
    ioutfm = 1, iwrap = {4},
    ntwe = {1}, ntwx = {1}, ntpr = {2},
-   ntxo = 1,  ! 2 is default in AMBER16 for NetCDF file
+   ntxo = 2,
    {3}
  /
 '''
@@ -25,11 +25,14 @@ __revision__ = "$Id$"
 
 
 
-import os, sys, shutil, math
+import os, sys, shutil
+from itertools import islice
+
+import numpy as np
 
 import mdebase
 from FESetup import const, errors, logger
-from FESetup.prepare.amber import dlpoly, utils
+from FESetup.prepare.amber import convcache, dlpoly, parm7, utils
 
 
 FIELD_FILENAME = 'FIELD'
@@ -47,6 +50,121 @@ NO_STEPS_PER_100DEG = 2
 START_T = 5.0
 
 
+def _config_header(lines, filename):
+    """
+    Parse the CONFIG/REVCON header: title, levcfg/imcon and cell vectors.
+
+    :param lines: at least the first five lines of the file
+    :type lines: list
+    :param filename: file name for error messages
+    :type filename: string
+    :raises: SetupError
+    :returns: levcfg, imcon, cell (3,3) or None, number of header lines
+    :rtype: tuple
+    """
+
+    try:
+        levcfg, imcon = [int(v) for v in lines[1].split()[0:2] ]
+    except (IndexError, ValueError):
+        raise errors.SetupError('invalid line 2 in file %s' % filename)
+
+    if not 0 <= levcfg <= 2:
+        raise errors.SetupError('invalid levcfg %i in file %s' %
+                                (levcfg, filename) )
+
+    if imcon == 0:
+        return levcfg, imcon, None, 2
+
+    cell = []
+
+    for line_no in range(2, 5):
+        try:
+            x, y, z = lines[line_no].split()
+            cell.append( (float(x), float(y), float(z) ) )
+        except (IndexError, ValueError):
+            raise errors.SetupError('invalid cell in file %s, line %i' %
+                                    (filename, line_no + 1) )
+
+    return levcfg, imcon, np.array(cell), 5
+
+
+def _config_records_slow(lines, start, levcfg, filename):
+    """
+    Line by line parser for the atom records of a CONFIG/REVCON file used
+    to locate errors.
+
+    :raises: SetupError
+    :returns: coordinates, velocities or None
+    """
+
+    coords = []
+    vels = []
+    nlines = levcfg + 2
+
+    for rec in range(start, len(lines), nlines):
+        if rec + nlines > len(lines):
+            raise errors.SetupError('incomplete atom record in file %s, '
+                                    'line %i' % (filename, rec + 1) )
+
+        for sub, what, data in ( (1, 'coords', coords), (2, 'vels', vels) ):
+            if sub > levcfg + 1:
+                break
+
+            try:
+                x, y, z = lines[rec + sub].split()
+                data.append( (float(x), float(y), float(z) ) )
+            except ValueError:
+                raise errors.SetupError('invalid %s in file %s, line %i' %
+                                        (what, filename, rec + sub + 1) )
+
+    return np.array(coords), np.array(vels) if vels else None
+
+
+def read_config(filename):
+    """
+    Read a DL_POLY CONFIG or REVCON file.  The atom records are parsed in
+    bulk according to levcfg.  Only if this fails the file is parsed line by
+    line to report the offending line.
+
+    :param filename: name of the CONFIG/REVCON file
+    :type filename: string
+    :raises: SetupError
+    :returns: cell (3,3) or None, coordinates (N,3), velocities (N,3) or None
+    :rtype: tuple
+    """
+
+    try:
+        with open(filename, 'r') as config:
+            lines = config.read().splitlines()
+    except IOError as why:
+        raise errors.SetupError('cannot read %s: %s' % (filename, why) )
+
+    while lines and not lines[-1].strip():
+        lines.pop()
+
+    levcfg, imcon, cell, start = _config_header(lines, filename)
+
+    nlines = levcfg + 2
+    body = lines[start:]
+    natoms = len(body) // nlines
+
+    try:
+        if len(body) % nlines:
+            raise ValueError
+
+        coords = np.array(' '.join(body[1::nlines]).split(),
+                          dtype=np.float64).reshape(natoms, 3)
+        vels = None
+
+        if levcfg >= 1:
+            vels = np.array(' '.join(body[2::nlines]).split(),
+                            dtype=np.float64).reshape(natoms, 3)
+    except ValueError:
+        coords, vels = _config_records_slow(lines, start, levcfg, filename)
+
+    return cell, coords, vels
+
+
 class MDEngine(mdebase.MDEBase):
     """
     Gromacs MD engine.
@@ -78,9 +196,9 @@ class MDEngine(mdebase.MDEBase):
         self.sander_rst = sander_rst
         self.amber_pdb = amber_pdb
 
-        self.dlpoly = dlpoly.DLPolyField()
-        self.dlpoly.readParm(amber_top, amber_crd)
-        self.dlpoly.writeConfig(CONFIG_FILENAME)
+        self.dlpoly = convcache.convert(
+            dlpoly.DLPolyField, amber_top, amber_crd, (CONFIG_FILENAME, ),
+            lambda field: field.writeConfig(CONFIG_FILENAME) )
 
 
     def minimize(self, config = '%STD', nsteps = 100, ncyc = 100,
@@ -187,48 +305,20 @@ class MDEngine(mdebase.MDEBase):
 
     def get_box_dims(self):
         """
-        Extract box information from rst7 file.
+        Extract box information from CONFIG file.
 
         :returns: box dimensions
         """
 
-        config_file = CONFIG_FILENAME
-        line_no = 0
-        box_dims = []
-
-        with open(config_file, 'r') as cfg:
-            for line in cfg:
-                line_no += 1
+        with open(CONFIG_FILENAME, 'r') as cfg:
+            lines = list(islice(cfg, 5) )
 
-                if line_no == 1:
-                    continue
+        cell = _config_header(lines, CONFIG_FILENAME)[2]
 
-                if line_no == 2:
-                    try:
-                        imcon = int(line.split()[1])
-                    except ValueError:
-                        raise errors.SetupError('invalid line %i in file %s'
-                                                % (line_no, config_file) )
-                    continue
+        if cell is None:
+            return []
 
-                if line_no < 5 and imcon > 0:
-                    # FIXME: rectangular box only
-                    try:
-                        x, y, z = line.split()
-                        box_dims.append(float(x))
-
-                        x, y, z = cfg.next().split()
-                        box_dims.append(float(y))
-
-                        x, y, z = cfg.next().split()
-                        box_dims.append(float(z))
-                    except ValueError:
-                        raise errors.SetupError('invalid cell in file %s'
-                                                % config_file)
-                    break
-
-        box_dims.extend( (90.0, 90.0, 90.0) )
-        return box_dims
+        return list(parm7.box_parameters(cell) )
 
 
     def _run_mdprog(self, suffix, config, mask, restr_force):
@@ -297,86 +387,16 @@ class MDEngine(mdebase.MDEBase):
         config_file = CONFIG_FILENAME
         self.prev = config_file + os.extsep + '%05i' % (self.run_no - 1)
 
-        line_no = 0
-        natoms = 0
-        cell = []
-        coords = []
-        vels = []
-
-        with open(config_file, 'r') as crdvel:
-            for line in crdvel:
-                line_no += 1
-
-                if line_no == 1: continue
-
-                if line_no == 2:
-                    try:
-                        levcfg, imcon = line.split()[0:2]
-                        lvgcfg = int(levcfg)
-                        imcon = int(imcon)
-                    except ValueError:
-                        raise errors.SetupError('invalid line %i in file %s'
-                                                % (line_no, config_file) )
-
-                    continue
-
-                if line_no < 5 and imcon > 0:
-                    try:
-                        x, y, z = line.split()
-                        cell.extend( (float(x), float(y), float(z) ) )
-
-                        x, y, z = crdvel.next().split()
-                        cell.extend( (float(x), float(y), float(z) ) )
-
-                        x, y, z = crdvel.next().split()
-                        cell.extend( (float(x), float(y), float(z) ) )
-                    except ValueError:
-                        raise errors.SetupError('invalid cell in file %s'
-                                                % config_file)
-
-                    line_no += 3
-
-                    continue
-
-                natoms += 1
-
-                if levcfg >= 0:
-                    try:
-                        x, y, z = crdvel.next().split()
-                        coords.extend( (float(x), float(y), float(z) ) )
-                    except ValueError:
-                        raise errors.SetupError('invalid coords in file %s, '
-                                                'line %s' % (crdvel, line_no) )
-                    line_no += 1
-
-                if levcfg >= 1:
-                    try:
-                        x, y, z = crdvel.next().split()
-                        vels.extend( (float(x), float(y), float(z) ) )
-                    except ValueError:
-                        raise errors.SetupError('invalid vels in file %s, '
-                                                'line %s' % (crdvel, line_no) )
-                    line_no += 1
-
-                if levcfg >= 2:
-                    crdvel.next().split()
-                    line_no += 1
-
-        if vels:
-            for i in range(natoms * 3):
-                vels[i] = float(vels[i]) / const.AMBER_VELCONV
-        else:
-            vels = [0.0] * natoms * 3
+        cell, coords, vels = read_config(config_file)
+
+        if cell is None:
+            raise errors.SetupError('no cell in file %s' % config_file)
 
-        # FIXME: non-orthorombic box
-        la = math.sqrt(cell[0]**2 + cell[1]**2 + cell[2]**2)
-        lb = math.sqrt(cell[3]**2 + cell[4]**2 + cell[5]**2)
-        lc = math.sqrt(cell[6]**2 + cell[7]**2 + cell[8]**2)
+        if vels is not None:
+            vels /= const.AMBER_VELCONV
 
-        # FIXME: may fail
-        self.dlpoly.unwrap(coords, la, lb, lc)
-        self.sander_crd = self._write_rst7(natoms, la, lb, lc, coords, vels,
-                                           True)
+        coords = self.dlpoly.unwrap(coords, cell)
+        self.sander_crd = self._write_rst7(coords, vels, cell, True)
 
     def _self_check(self, mdprog):
         """
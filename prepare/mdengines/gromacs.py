@@ -27,17 +27,22 @@ __revision__ = "$Id$"
 
 import os
 import glob
-import re
+import struct
+
+import numpy as np
 
 import mdebase
 from FESetup import const, errors, logger
-from FESetup.prepare.amber import gromacs, utils
+from FESetup.prepare.amber import convcache, gromacs, utils
 
 
 # assume standard GROMACS file name conventions
 GROMACS5_EXE_NAMES = ['gmx_d', 'gmx', 'gmx_mpi_d', 'gmx_mpi']
 GROMACS_SUFFIXES = ['_d', '', '_mpi_d', '_mpi']
 
+TRR_MAGIC = 1993
+TRR_NSIZES = 13
+
 
 def _check_exe(bindir, exe_name):
     full_path = os.path.join(bindir, exe_name)
@@ -59,6 +64,126 @@ def _get_suffix(name, suffix):
     return ''
 
 
+def _trr_header(trr, filename):
+    """
+    Read the header of the next frame in a TRR file.
+
+    :param trr: TRR file opened in binary mode
+    :type trr: file
+    :param filename: file name for error messages
+    :type filename: string
+    :raises: SetupError
+    :returns: number of atoms, size of real, sizes of data blocks or None
+              at end of file
+    :rtype: tuple
+    """
+
+    data = trr.read(4)
+
+    if not data:
+        return None
+
+    try:
+        magic = struct.unpack('>i', data)[0]
+
+        if magic != TRR_MAGIC:
+            raise errors.SetupError('%s is not a TRR file or corrupt' %
+                                    filename)
+
+        # version string: length + 1, XDR string length, padded chars
+        nchar = struct.unpack('>2i', trr.read(8) )[1]
+        trr.seek( (nchar + 3) // 4 * 4, 1)
+
+        sizes = struct.unpack('>%ii' % TRR_NSIZES, trr.read(4 * TRR_NSIZES) )
+    except struct.error:
+        raise errors.SetupError('truncated frame header in %s' % filename)
+
+    box_size, x_size, v_size, f_size, natoms = (sizes[2], sizes[7], sizes[8],
+                                                sizes[9], sizes[10])
+
+    if box_size:
+        real = box_size // 9
+    elif natoms and (x_size or v_size or f_size):
+        real = (x_size or v_size or f_size) // (3 * natoms)
+    else:
+        real = 0
+
+    if real not in (4, 8):
+        raise errors.SetupError('cannot determine precision of %s' % filename)
+
+    # skip time and lambda
+    trr.seek(2 * real, 1)
+
+    return natoms, real, sizes[:10]
+
+
+def read_trr_last(filename):
+    """
+    Read box, coordinates and velocities from the last frame in a GROMACS
+    TRR file which has coordinates.  Only frame headers are read until that
+    frame is found.
+
+    :param filename: name of the TRR file
+    :type filename: string
+    :raises: SetupError
+    :returns: box (3,3) in nm, coordinates (N,3) in nm, velocities (N,3)
+              in nm/ps or None
+    :rtype: tuple
+    """
+
+    last = None
+
+    try:
+        trr = open(filename, 'rb')
+    except IOError as why:
+        raise errors.SetupError('cannot read %s: %s' % (filename, why) )
+
+    with trr:
+        while True:
+            header = _trr_header(trr, filename)
+
+            if not header:
+                break
+
+            natoms, real, sizes = header
+
+            if sizes[7]:
+                last = trr.tell(), natoms, real, sizes
+
+            trr.seek(sum(sizes), 1)
+
+        if not last:
+            raise errors.SetupError('%s contains no coordinates' % filename)
+
+        offset, natoms, real, sizes = last
+        dtype = np.dtype('>f%i' % real)
+        trr.seek(offset + sum(sizes[:2]) )
+
+        def read_block(size):
+            data = trr.read(size)
+
+            if len(data) != size:
+                raise errors.SetupError('truncated last frame in %s' %
+                                        filename)
+
+            return np.frombuffer(data, dtype).astype(np.float64)
+
+        box = None
+
+        if sizes[2]:
+            box = read_block(sizes[2]).reshape(3, 3)
+
+        trr.seek(sizes[3] + sizes[4] + sizes[5] + sizes[6], 1)
+
+        coords = read_block(sizes[7]).reshape(natoms, 3)
+        vels = None
+
+        if sizes[8]:
+            vels = read_block(sizes[8]).reshape(natoms, 3)
+
+    return box, coords, vels
+
+
 class MDEngine(mdebase.MDEBase):
     """
     Gromacs MD engine.
@@ -81,7 +206,6 @@ class MDEngine(mdebase.MDEBase):
 
         self.mdprog = ''
         self.grompp = ''
-        self.gmxdump = ''
 
         self._self_check(mdprog)
 
@@ -97,14 +221,15 @@ class MDEngine(mdebase.MDEBase):
         self.top = os.path.splitext(amber_top)[0] + os.extsep + 'top'
         self.gro = os.path.splitext(amber_crd)[0] + os.extsep + 'gro'
 
-        gtop = gromacs.GromacsTop()
+        def write(gtop):
+            gtop.writeTop(self.top, '', '', False)
+            gtop.writeGro(self.gro)
 
-        gtop.readParm(amber_top, amber_crd)
+        gtop = convcache.convert(gromacs.GromacsTop, amber_top, amber_crd,
+                                 (self.top, self.gro), write, ('', '', False),
+                                 ('parm', 'molidx') )
         self.molidx = gtop.molidx
 
-        gtop.writeTop(self.top, '', '', False)
-        gtop.writeGro(self.gro)
-
         self.gtop = gtop
 
 
@@ -291,105 +416,57 @@ class MDEngine(mdebase.MDEBase):
         except KeyError:
             mask = restr
 
-        mask_idx = list(self.mask_indexes(self.amber_top, mask) )
+        selected = np.zeros(self.gtop.parm.natoms, dtype=bool)
+        selected[self.mask_indexes(self.amber_top, mask)] = True
+
+        params = ' 1 %.2f %.2f %.2f\n' % (k, k, k)
 
         # FIXME: each molecule type only recorded once, so this means that
         #        the mask is assumed to be the same for each type
         for name, data in self.molidx.iteritems():
             idx_list = data[0]
             natoms = data[1]
-            molt_idx = []
 
             # FIXME: only checks first occurence of molecule in mask index
-            for i in idx_list[:natoms]:
-                if i in mask_idx:
-                    molt_idx.append(i)
+            first = idx_list[:natoms]
+            molt_idx = first[selected[first]] - first[0] + 1
 
             posres_file = (const.GROMACS_POSRES_PREFIX + name +
                            const.GROMACS_ITP_EXT)
 
-            if molt_idx:
-                mi = min(molt_idx)
-
-                with open(posres_file, 'w') as posres:
+            with open(posres_file, 'w') as posres:
+                if len(molt_idx):
                     posres.write('[ position_restraints ]\n')
-
-                    for i in molt_idx:
-                        posres.write('%i 1 %.2f %.2f %.2f\n' %
-                                     (i + 1 - mi, k, k, k) )
-            else:
-                open(posres_file, 'w').close()
+                    posres.write(''.join(['%i%s' % (i, params)
+                                          for i in molt_idx]) )
 
 
     def to_rst7(self):
         """
-        Use gmxdump to extract coordinates, velocities and box dimensions
-        from either the trajectory and convert to AMBER ASCII .rst7
+        Read coordinates, velocities and box dimensions from the last frame
+        of the trajectory and convert to AMBER ASCII .rst7
 
         :raises: SetupError
         """
 
-        params = '-f %s' % (self.prev + os.extsep + 'trr')
-        retc, out, err = utils.run_exe(' '.join((self.gmxdump, params)))
+        box, coords, vels = read_trr_last(self.prev + os.extsep + 'trr')
 
-        if retc:
-            logger.write(err)
-            raise errors.SetupError('%s has failed (see logfile) has failed' %
-                                    self.gmxdump)
-
-        lidx = out.rfind('frame ')
-        box = []
-        coords = []
-        vels = []
-
-        # FIXME: check for consistency
-        for line in out[lidx:].rstrip().split('\n'):
-            if 'natoms= ' in line:
-                natoms = line.split()[1]
-
-                continue
-
-            m = re.match('      box\[.*\]={(.*)}', line)
+        if box is None:
+            raise errors.SetupError('no box in last frame of %s' %
+                                    (self.prev + os.extsep + 'trr') )
 
-            if m:
-                t = m.group(1).split(',')
-                box.extend(t)
-
-            m = re.match('      x\[.*\]={(.*)}', line)
-
-            if m:
-                t = m.group(1).split(',')
-                coords.extend(t)
-
-            m = re.match('      v\[.*\]={(.*)}', line)
-
-            if m:
-                t = m.group(1).split(',')
-                vels.extend(t)
-
-        natoms = int(natoms)
-
-        for i in range(natoms * 3):
-            coords[i] = float(coords[i]) / const.A2NM
+        coords /= const.A2NM
 
         # Gromacs stores velocities in nm/ps, Amber is A/time unit where
         # time unit is 1/20.455 ps
-        if vels:
-            vel_conv = const.AMBER_VELCONV / 10.0
+        if vels is not None:
+            vels /= const.AMBER_VELCONV / 10.0
 
-            for i in range(natoms * 3):
-                vels[i] = float(vels[i]) / vel_conv
-        else:
-            vels = [0.0] * natoms * 3
+        cell = box / const.A2NM
 
-        xx = float(box[0]) / const.A2NM
-        yy = float(box[4]) / const.A2NM
-        zz = float(box[8]) / const.A2NM
+        coords = self.gtop.unwrap(coords, cell)
+        self.sander_crd = self._write_rst7(coords, vels, cell, False)
 
-        # FIXME: may fail
-        self.gtop.unwrap(coords, xx, yy, zz)
-        self.sander_crd = self._write_rst7(natoms, xx, yy, zz, coords, vels,
-                                           False)
 
     def _self_check(self, mdprog):
         """
@@ -442,7 +519,6 @@ class MDEngine(mdebase.MDEBase):
 
             self.mdprog = ' '.join((full_path, 'mdrun'))
             self.grompp = ' '.join((full_path, 'grompp'))
-            self.gmxdump = ' '.join((full_path, 'dump'))
 
             return
         else:
@@ -456,7 +532,6 @@ class MDEngine(mdebase.MDEBase):
             # FIXME: check if suffixed version actually exists
             #        if not use the executables that are found
             self.grompp = _check_exe(bindir, 'grompp' + suffix)
-            self.gmxdump = _check_exe(bindir, 'gmxdump' + suffix)
 
             full_path = os.path.join(bindir, mdprog)
 
@@ -464,7 +539,7 @@ class MDEngine(mdebase.MDEBase):
             if os.access(full_path, os.X_OK):
                 self.mdprog = full_path
 
-            if self.grompp and self.mdprog and self.gmxdump:
+            if self.grompp and self.mdprog:
                 return
 
         raise errors.SetupError('GMXHOME does not have any useful executables')
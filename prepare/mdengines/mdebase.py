@@ -25,18 +25,19 @@ __revision__ = "$Id$"
 
 
 
-import os, sys
+import os
 
-from parmed.amber.mask import AmberMask
-from parmed.amber.readparm import AmberParm
+import numpy as np
 
 from FESetup import const
+from FESetup.prepare.amber import parm7, topcache
 
 
 
 MIN_PREFIX = 'min'
 MD_PREFIX = 'md'
 RST_EXT = os.extsep + 'rst7'
+NCRST_EXT = os.extsep + 'ncrst'
 
 _rs = ' ntr = 1, restraint_wt = %.2f,\n restraintmask="%s",'
 
@@ -63,24 +64,40 @@ class MDEBase(object):
         self.run_no = 1
 
 
+    def pending(self):
+        """
+        Number of protocol steps queued but not run yet.  Engines run every
+        step immediately unless they override this.
+        """
+
+        return 0
+
+
+    def run_pending(self):
+        """
+        Run queued protocol steps.
+
+        :returns: True if steps have been run
+        """
+
+        return False
+
+
     def mask_indexes(self, parmtop, mask):
         """
-        Create AMBER mask index generator from parmtop file.
+        Atom indexes selected by an AMBER mask, memoised per parmtop file.
 
         :param parmtop: parmtop filename
         :type parmtop: string
         :param mask: AMBER mask
-        :type mask: integer
-        :returns: mask index generator
+        :type mask: string
+        :returns: read-only array of 0-based atom indexes
         """
-                
-        p = AmberParm(parmtop)
-        m = AmberMask(p, mask)
 
-        return m.Selected()
+        return topcache.mask_indexes(parmtop, mask)
 
 
-    def _write_rst7(self, natoms, xx, yy, zz, coords, vels, center = 'False'):
+    def _write_rst7(self, coords, vels, box, center = False):
         """
         Write AMBER .rst7 file
 
@@ -93,81 +110,32 @@ class MDEBase(object):
         ...
         6F12.7 box size
 
+        :param coords: coordinates
+        :type coords: (N,3) array-like
+        :param vels: velocities, zero if None
+        :type vels: (N,3) array-like or None
+        :param box: box lengths, lengths and angles or cell vectors
+        :type box: sequence
+        :param center: center bounding box of coordinates in box
+        :type center: bool
         :returns: file name of created rst7 file
         """
 
-        delx = dely = delz = 0.0
+        coords = np.asarray(coords, dtype=np.float64).reshape(-1, 3)
+
+        if vels is None:
+            vels = np.zeros(coords.shape)
+
+        box = parm7.box_parameters(box)
 
         # FIXME: only cuboid box
         if center:
-            minc = [ sys.float_info[0],  sys.float_info[0],  sys.float_info[0] ]
-            maxc = [-sys.float_info[0], -sys.float_info[0], -sys.float_info[0] ]
-
-            for i in range(0, len(coords), 3):
-                if coords[i]   < minc[0]:
-                    minc[0] = coords[i]
-                if coords[i+1] < minc[1]:
-                    minc[1] = coords[i+1]
-                if coords[i+2] < minc[2]:
-                    minc[2] = coords[i+2]
-
-                if coords[i]   > maxc[0]:
-                    maxc[0] = coords[i]
-                if coords[i+1] > maxc[1]:
-                    maxc[1] = coords[i+1]
-                if coords[i+2] > maxc[2]:
-                    maxc[2] = coords[i+2]
+            minc = coords.min(axis=0)
+            maxc = coords.max(axis=0)
 
             # FIXME: do we have do consider vdW radii?
-            delx = minc[0] - (xx - maxc[0] + minc[0]) / 2
-            dely = minc[1] - (yy - maxc[1] + minc[1]) / 2
-            delz = minc[2] - (zz - maxc[2] + minc[2]) / 2
-
-
-        with open(self.prev + RST_EXT, 'w') as rst7:
-            rst7.write('converted with FESetup\n')
-            rst7.write('%5i%15.7f\n' % (natoms, 0.0) )
-
-            cnt = 0
-            nl_done = False
-
-            for i in range(0, len(coords), 3):
-                cnt += 3
-                nl_done = False
-
-                x = coords[i]   - delx
-                y = coords[i+1] - dely
-                z = coords[i+2] - delz
-
-                rst7.write('%12.7f%12.7f%12.7f' % (x, y, z) )
-
-                if cnt >= 6:
-                    rst7.write('\n')
-                    cnt = 0
-                    nl_done = True
-
-            if cnt < 6 and not nl_done:
-                rst7.write('\n')
-
-            cnt = 0
-            nl_done = False
-
-            for coord in vels:
-                cnt += 1
-                nl_done = False
-
-                rst7.write('%12.7f' % coord)
-
-                if cnt >= 6:
-                    rst7.write('\n')
-                    cnt = 0
-                    nl_done = True
-
-            if cnt < 6 and not nl_done:
-                rst7.write('\n')
+            coords = coords - (minc - (box[:3] - maxc + minc) / 2.0)
 
-            # FIXME: only cuboid box
-            rst7.write('%12.7f%12.7f%12.7f%12.7f%12.7f%12.7f\n' %
-                       (xx, yy, zz, 90.0, 90.0, 90.0) )
+        parm7.write_rst7(self.prev + RST_EXT, coords, vels, box)
 
         return self.prev + RST_EXT
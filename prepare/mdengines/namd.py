@@ -25,7 +25,9 @@ __revision__ = "$Id$"
 
 
 
-import os, sys, struct
+import os, sys
+
+import numpy as np
 
 import mdebase
 from FESetup import const, errors, logger
@@ -40,45 +42,54 @@ SOLVENT_TRANS = {
 
 STEPS_PER_CYCLE = 20
 
+# marks the start of a step in the output of a single NAMD run
+STAGE_MARKER = 'FESETUP_STAGE'
+
+# pre-defined MD protocols with pressure control
+PRESSURE_JOBS = ('press', 'shrink', 'relres')
+
 
 def namd_velcoor(filename):
     """
     Return number of atoms and coordinates or velocities from NAMD binary
-    coor or vel file.
+    coor or vel file.  The data is memory-mapped, not copied.
 
     :param filename: file name of NAMD coordinates or velocities
     :type filename: string
     :raises: SetupError
     :returns: number of atoms, coordinates or velocities
-    :rtype: integer, list
+    :rtype: integer, (N,3) numpy.memmap of float64
     """
 
-    natoms_expected = (os.stat(filename).st_size - 4) / 24
-
-    endian = '<'
+    size = os.stat(filename).st_size
+    natoms_expected = (size - 4) // 24
 
     with open(filename, 'rb') as coor:
         first4 = coor.read(4)
-        natoms = struct.unpack('%si' % endian, first4)[0]
 
-        if natoms != natoms_expected:
-            endian = '>'
-            natoms = struct.unpack('%si' % endian, first4)[0]
+    for endian in '<>':
+        natoms = np.frombuffer(first4, dtype=endian + 'i4')[0]
 
-            if natoms != natoms_expected:
-                raise errors.SetupError('BUG: unknown endianess in %s' %
-                                        filename)
+        if natoms == natoms_expected and 4 + 24 * natoms == size:
+            break
+    else:
+        raise errors.SetupError('BUG: unknown endianess in %s' % filename)
 
-        n = 3 * natoms
-        coords = struct.unpack('%s%id' % (endian, n), coor.read(n * 8) )
+    data = np.memmap(filename, dtype=endian + 'f8', mode='r', offset=4,
+                     shape=(natoms, 3) )
 
-    return natoms, coords
+    return int(natoms), data
 
 
-# FIXME: write individual steps into TCL script and run only once
 class MDEngine(mdebase.MDEBase):
     """
     NAM MD engine.
+
+    In single-run mode the pre-defined protocol steps are queued and
+    compiled into one Tcl script which is run by one NAMD process when the
+    results are needed.  A new script is started only when a step requires
+    different static NAMD parameters, e.g. pressure control or restraint
+    atoms.
     """
 
     # FIXME: files are specific to AMBER but needed for conversion for
@@ -99,6 +110,11 @@ class MDEngine(mdebase.MDEBase):
         self.prev = ''
         self.prefix = ''
 
+        self.single_run = False
+        self._stages = []
+        self._statics = {}
+        self._batch_prev = ''
+
         self.mdprog = ''
         self._self_check(mdprog)
 
@@ -148,6 +164,15 @@ class MDEngine(mdebase.MDEBase):
         if mask:
             self._make_restraints(restr_filen, mask, restr_force)
 
+        if self.single_run and config[0] == '%':
+            self._queue_stage(dict(prefix=prefix, job_type='min',
+                                   nsteps=nsteps, mask=mask, k=restr_force,
+                                   restr_filen=restr_filen, pressure=False,
+                                   p=None, wrap=None, dt=None) )
+            return
+
+        self.run_pending()
+
         if config[0] == '%':
             pname = config[1:]
             logger.write('Running minimisation with protocol %s' % pname)
@@ -219,6 +244,26 @@ class MDEngine(mdebase.MDEBase):
             logger.write('Warning: nsteps has been changed to %i to ensure it '
                          'to be multiple of stepsPerCycle' % nsteps)
 
+        if self.single_run and config[0] == '%':
+            job_type = config[1:].lower()
+            pressure = job_type in PRESSURE_JOBS
+
+            if wrap:
+                wrap = 'on'
+            else:
+                wrap = 'off'
+
+            self._queue_stage(dict(prefix=prefix, job_type=job_type,
+                                   nsteps=nsteps, T=T, mask=mask,
+                                   k=restr_force, nrel=nrel,
+                                   restr_filen=restr_filen,
+                                   pressure=pressure,
+                                   p=p if pressure else None, wrap=wrap,
+                                   dt=dt) )
+            return
+
+        self.run_pending()
+
         if config[0] == '%':
             pname = config[1:]
             logger.write('Running MD with protocol %s' % pname)
@@ -246,16 +291,143 @@ class MDEngine(mdebase.MDEBase):
         self.prefix = prefix
 
 
+    def pending(self):
+        """
+        Number of queued steps not run yet.
+        """
+
+        return len(self._stages)
+
+
+    def run_pending(self):
+        """
+        Compile all queued steps into one Tcl script and run NAMD once.
+        Every step writes its final coordinates, velocities and extended
+        system to the files the step would have produced if run alone.  The
+        output name, restart, XST and DCD files are switched between steps
+        so each step keeps its own files, and the NAMD output is split into
+        one .out file per step.  Unlike a separate run, minimisation steps
+        write a DCD file too.
+
+        :returns: True if steps have been run
+        :raises: SetupError
+        """
+
+        if not self._stages:
+            return False
+
+        stages = self._stages
+        statics = self._statics
+        name = '%s-%s' % (stages[0]['prefix'], stages[-1]['prefix'])
+
+        logger.write('Running %s in a single NAMD process' %
+                     ', '.join(stage['prefix'] for stage in stages) )
+
+        # restraints are scaled relative to the first restrained step
+        k0 = statics['k']
+        restr_filen = statics['restr_filen']
+
+        nmd = [stage['nsteps'] for stage in stages]
+        freq = max(min(nmd) // 10, 1)
+
+        if stages[0]['job_type'] == 'randomv':
+            T0 = stages[0]['T']
+        else:
+            T0 = 5.0
+
+        config = [PROTOCOLS['AMBER_SINGLE_RUN'].format(
+            prev=self._batch_prev, name=name,
+            p=statics['p'] if statics['pressure'] else '',
+            restraint='T' if k0 else 'F', top=self.amber_top,
+            pdb=self.amber_pdb, solvent=self.solvent, xx=self.xx,
+            yy=self.yy, zz=self.zz, T0=T0, freq=freq,
+            wrap=statics['wrap'] or 'on', restr=restr_filen,
+            spc=STEPS_PER_CYCLE, dt=statics['dt'] or 2.0)]
+
+        for stage in stages:
+            if k0 and stage['mask']:
+                scale = float(stage['k']) / k0
+            else:
+                scale = 0.0
+
+            if stage['job_type'] == 'min':
+                template = PROTOCOLS['AMBER_SINGLE_RUN_MIN']
+            else:
+                template = PROTOCOLS['AMBER_SINGLE_RUN_MD']
+
+            config.append(template.format(scale=scale,
+                                          spc=STEPS_PER_CYCLE,
+                                          marker=STAGE_MARKER, **stage) )
+
+        self._stages = []
+        self._statics = {}
+
+        self._run_mdprog(name, config, False)
+        _split_output(name + os.extsep + 'out',
+                      [stage['prefix'] for stage in stages])
+
+        return True
+
+
+    def _queue_stage(self, stage):
+        """
+        Queue a step for single-run mode.  Queued steps are run first if
+        the new step needs different static NAMD parameters.
+
+        :param stage: step parameters
+        :type stage: dict
+        """
+
+        if not stage['mask'] or stage['k'] <= 0.0:
+            stage['mask'] = ''
+        else:
+            stage['mask'] = mdebase._restraint_table.get(stage['mask'],
+                                                         stage['mask'])
+
+        for key in ('pressure', 'p', 'wrap', 'dt', 'mask'):
+            new = stage[key]
+            old = self._statics.get(key)
+
+            if new in (None, '') or old in (None, ''):
+                continue
+
+            if new != old:
+                self.run_pending()
+                break
+
+        if not self._stages:
+            self._batch_prev = self.prev
+
+        for key in ('pressure', 'p', 'wrap', 'dt', 'mask'):
+            if self._statics.get(key) in (None, ''):
+                self._statics[key] = stage[key]
+
+        if stage['mask'] and not self._statics.get('k'):
+            self._statics['k'] = stage['k']
+            self._statics['restr_filen'] = stage['restr_filen']
+        else:
+            self._statics.setdefault('k', 0.0)
+            self._statics.setdefault('restr_filen', '')
+
+        self._stages.append(stage)
+
+        self.run_no += 1
+        self.prev = stage['prefix']
+        self.prefix = stage['prefix']
+
+
     def get_box_dims(self):
         """
-        Extract box information from rst7 file.
+        Extract box information from extended system file.
 
         :returns: box dimensions
         """
 
-        xst_file = self.prefix + os.extsep + 'xst'
+        self.run_pending()
+
+        xsc_file = self.prefix + os.extsep + 'xsc'
 
-        with open(xst_file, 'r') as rst:
+        with open(xsc_file, 'r') as rst:
             for line in rst:
                 last_line = line
 
@@ -274,6 +446,8 @@ class MDEngine(mdebase.MDEBase):
         :raises: SetupError
         """
         
+        self.run_pending()
+
         prefix = self.prev + os.extsep
 
         natoms, coords = namd_velcoor(prefix + 'coor')
@@ -292,13 +466,15 @@ class MDEngine(mdebase.MDEBase):
         # FIXME: only cuboid box
         xx, yy, zz = float(ext[1]), float(ext[5]), float(ext[9])
 
-        self.sander_crd = self._write_rst7(natoms, xx, yy, zz, coords, vels,
-                                           True)
+        self.sander_crd = self._write_rst7(coords, vels, (xx, yy, zz), True)
 
 
-    def _run_mdprog(self, prefix, config):
+    def _run_mdprog(self, prefix, config, advance=True):
         """
         Run namd.
+
+        :param advance: count run as a protocol step
+        :type advance: bool
         """
 
         filename = prefix + os.extsep
@@ -319,8 +495,9 @@ class MDEngine(mdebase.MDEBase):
             raise errors.SetupError('%s has failed (see logfile)' %
                                     self.mdprog)
 
-        self.run_no += 1
-        self.prev = prefix
+        if advance:
+            self.run_no += 1
+            self.prev = prefix
 
 
     def _make_restraints(self, ofilen, restr, k):
@@ -331,7 +508,7 @@ class MDEngine(mdebase.MDEBase):
             mask = restr
 
         # FIXME: assumes AMBER parmtop
-        indexes = list(self.mask_indexes(self.amber_top, mask) )
+        indexes = set(self.mask_indexes(self.amber_top, mask).tolist() )
         acnt = 0
 
         with open(ofilen, 'w') as opdb:
@@ -369,6 +546,39 @@ class MDEngine(mdebase.MDEBase):
         
         
 
+def _split_output(filename, prefixes):
+    """
+    Split the output of a single NAMD run into one .out file per step.  The
+    output before the first step goes to the first step.
+
+    :param filename: NAMD output file of the single run
+    :type filename: string
+    :param prefixes: step prefixes in run order
+    :type prefixes: list
+    """
+
+    with open(filename, 'r') as out:
+        lines = out.readlines()
+
+    parts = dict( (prefix, []) for prefix in prefixes)
+    current = parts[prefixes[0] ]
+
+    for line in lines:
+        fields = line.split()
+
+        if STAGE_MARKER in fields:
+            prefix = fields[-1]
+
+            if prefix in parts:
+                current = parts[prefix]
+
+        current.append(line)
+
+    for prefix in prefixes:
+        with open(prefix + os.extsep + 'out', 'w') as out:
+            out.writelines(parts[prefix])
+
+
 PROTOCOLS = dict(
     # NAMD also appears to need prior minimisation, possibly because of tight
     # pressure coupling
@@ -577,5 +787,173 @@ if {{$job_type == "randomv"}} {{
     run $nsteps
   }}
 }}
+''',
+
+    # header for all steps compiled into one script, see run_pending()
+    AMBER_SINGLE_RUN = '''
+set prev_step     "{prev}"
+set p             "{p}"
+set restraint     {restraint}
+
+minTinyStep       1.0E-3
+minBabyStep       1.0E-7
+
+amber             yes
+parmfile          "{top}"
+coordinates       "{pdb}"
+readexclusions    yes
+exclude           scaled1-4
+1-4scaling        0.833333
+scnb              2.0
+zeromomentum      on
+LJcorrection      on
+
+watermodel        {solvent}
+useSettle         on
+rigidBonds        all
+rigidIterations   300
+rigidTolerance    1.0e-8
+rigidDieOnError   off
+
+PME                on
+PMEGridSpacing     1.0
+nonbondedFreq      1
+fullElectFrequency 1
+
+switching         off
+cutoff            8.0
+pairlistsPerCycle 1
+stepspercycle     {spc}
+
+langevin          on
+langevinHydrogen  on
+langevinDamping   1
+langevinTemp      {T0}
+
+if {{$p != ""}} {{
+  margin               2.5
+  BerendsenPressure  on
+  BerendsenPressureTarget $p
+  BerendsenPressureCompressibility 4.5E-5
+  BerendsenPressureRelaxationTime 50.0
+}} else {{
+  useGroupPressure  yes
+  LangevinPiston    off
+  BerendsenPressure off
+}}
+
+outputname       "{name}"
+outputEnergies   {freq}
+outputPressure   {freq}
+outputTiming     {freq}
+binaryoutput     yes
+
+restartname      "{name}"
+restartfreq      {freq}
+binaryrestart    yes
+
+XSTfile          "{name}.xst"
+XSTfreq          {freq}
+
+wrapAll          {wrap}
+wrapNearest      on
+DCDfile          "{name}.dcd"
+DCDUnitCell      yes
+DCDfreq          {freq}
+
+if {{$restraint == "T"}} {{
+  constraints       on
+  consexp           2
+  consref           "{restr}"
+  conskfile         "{restr}"
+  conskcol          B
+}}
+
+if {{$prev_step != ""}} {{
+  binvelocities       "$prev_step.vel"
+  bincoordinates      "$prev_step.coor"
+  ExtendedSystem      "$prev_step.xsc"
+  firsttimestep       0
+}} else {{
+  cellBasisVector1    {xx}  0  0
+  cellBasisVector2    0  {yy} 0
+  cellBasisVector3    0  0  {zz}
+  temperature {T0}
+}}
+
+timestep {dt}
+
+
+proc check_multiple {{p1 p2}} {{
+  if {{[expr $p1 % $p2] != 0}} {{
+    set p1 [expr ($p1 / $p2 + 1) * $p2]
+  }}
+
+  return $p1
+}}
+''',
+
+    AMBER_SINGLE_RUN_MIN = '''
+# step {prefix}: minimisation
+print "{marker} {prefix}"
+outputname        "{prefix}"
+restartname       "{prefix}"
+XSTfile           "{prefix}.xst"
+DCDfile           "{prefix}.dcd"
+
+if {{$restraint == "T"}} {{
+  constraintScaling {scale}
+}}
+
+minimize {nsteps}
+output "{prefix}"
+''',
+
+    AMBER_SINGLE_RUN_MD = '''
+# step {prefix}: {job_type}
+print "{marker} {prefix}"
+outputname        "{prefix}"
+restartname       "{prefix}"
+XSTfile           "{prefix}.xst"
+DCDfile           "{prefix}.dcd"
+
+set job_type      "{job_type}"
+set nsteps        {nsteps}
+set startT        5.0
+set finalT        {T}
+set scale         {scale}
+
+if {{$restraint == "T"}} {{
+  constraintScaling $scale
+}}
+
+if {{$job_type == "heat"}} {{
+  set tinc [check_multiple [expr $nsteps / 10] {spc}]
+
+  for {{set step 0}} {{$step < [expr $nsteps - $tinc]}} {{incr step $tinc}} {{
+    langevinTemp [expr {{($finalT - $startT) * $step / $nsteps + $startT}} ]
+    run $tinc
+  }}
+
+  langevinTemp $finalT
+  run $tinc
+}} elseif {{$job_type == "relres"}} {{
+  langevinTemp $finalT
+  set rinc [check_multiple [expr $nsteps / {nrel:d}] {spc}]
+
+  if {{$scale > 0.0}} {{
+    for {{set step 0}} {{$step < $nsteps}} {{incr step $rinc}} {{
+      constraintScaling [ expr {{ $scale * (-double($step) / $nsteps + 1.0) }} ]
+      run $rinc
+    }}
+  }} else {{
+    run $nsteps
+  }}
+}} else {{
+  langevinTemp $finalT
+  run $nsteps
+}}
+
+output "{prefix}"
 '''
 )
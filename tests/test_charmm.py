@@ -0,0 +1,60 @@
+#  Copyright (C) 2017  Hannes H Loeffler
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#  For full details of the license please see the COPYING file
+#  that should have come with this distribution.
+
+r'''
+Tests for the CHARMM topology conversion.
+'''
+
+__revision__ = "$Id$"
+
+
+
+import os
+import unittest
+
+from FESetup.prepare.amber import charmm
+
+
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__) ), 'data')
+
+
+class CharmmTopTest(unittest.TestCase):
+
+    def setUp(self):
+        # LIG, 3 WAT, Na+, Cl-
+        self.top = charmm.CharmmTop()
+        self.top.readParm(os.path.join(DATA_DIR, 'ions.parm7'),
+                          os.path.join(DATA_DIR, 'ions.rst7') )
+
+
+    def test_ion_groups(self):
+        # single atoms have no group, all other residues have one
+        self.assertEqual([gp[0] for gp in self.top.groups], [0, 5, 8, 11])
+
+
+    def test_segids(self):
+        segids = [atom[2] for atom in self.top.atoms]
+
+        self.assertEqual(segids[5:], ['WATER'] * 9 + ['ION', 'ION'])
+
+
+
+if __name__ == '__main__':
+    unittest.main()
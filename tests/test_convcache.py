@@ -0,0 +1,160 @@
+#  Copyright (C) 2017  Hannes H Loeffler
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#  For full details of the license please see the COPYING file
+#  that should have come with this distribution.
+
+r'''
+Tests for the on-disk conversion cache.
+'''
+
+__revision__ = "$Id$"
+
+
+
+import os
+import glob
+import shutil
+import tempfile
+import unittest
+
+from FESetup.prepare.amber import convcache
+
+
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__) ), 'data')
+
+
+class Converter(object):
+    """Count the conversions and write the atom count line of the inpcrd."""
+
+    nread = 0
+
+    def readParm(self, parmtop, inpcrd):
+        Converter.nread += 1
+
+        self.parmtop = parmtop
+        self.inpcrd = inpcrd
+
+        with open(inpcrd, 'r') as crd:
+            crd.readline()
+            self.natoms = int(crd.readline().split()[0])
+
+
+def writer(output):
+    """Writer for the output file name."""
+
+    def write(conv):
+        with open(output, 'w') as out:
+            out.write('%i\n' % conv.natoms)
+
+    return write
+
+
+class ConvCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+        for filename in ('ions.parm7', 'ions.rst7'):
+            shutil.copy(os.path.join(DATA_DIR, filename), self.tmpdir)
+
+        self.parmtop = os.path.join(self.tmpdir, 'ions.parm7')
+        self.inpcrd = os.path.join(self.tmpdir, 'ions.rst7')
+        self.output = os.path.join(self.tmpdir, 'converted.txt')
+
+        convcache.cache_dir = os.path.join(self.tmpdir, 'cache')
+        Converter.nread = 0
+
+
+    def tearDown(self):
+        convcache.cache_dir = None
+        convcache._sources.pop(Converter.__module__, None)
+        shutil.rmtree(self.tmpdir)
+
+
+    def convert(self, options=() ):
+        return convcache.convert(Converter, self.parmtop, self.inpcrd,
+                                 [self.output], writer(self.output), options)
+
+
+    def test_cached(self):
+        self.convert()
+        os.remove(self.output)
+
+        conv = self.convert()
+
+        self.assertEqual(Converter.nread, 1)
+        self.assertEqual(conv.natoms, 16)
+        self.assertEqual(conv.inpcrd, self.inpcrd)
+
+        with open(self.output, 'r') as out:
+            self.assertEqual(out.read(), '16\n')
+
+
+    def test_options(self):
+        self.convert()
+        self.convert( ('other',) )
+
+        self.assertEqual(Converter.nread, 2)
+
+
+    def test_changed_input(self):
+        self.convert()
+
+        with open(self.inpcrd, 'a') as crd:
+            crd.write('\n')
+
+        self.convert()
+
+        self.assertEqual(Converter.nread, 2)
+
+
+    def test_source(self):
+        self.convert()
+
+        # pretend the converter has been edited
+        convcache._sources[Converter.__module__] = 'edited'
+        self.convert()
+
+        self.assertEqual(Converter.nread, 2)
+
+
+    def test_unreadable(self):
+        self.convert()
+
+        for entry in glob.glob(os.path.join(convcache.cache_dir, '*') ):
+            with open(entry, 'wb') as pkl:
+                pkl.write(b'garbage')
+
+        conv = self.convert()
+
+        self.assertEqual(Converter.nread, 2)
+        self.assertEqual(conv.natoms, 16)
+
+
+    def test_disabled(self):
+        convcache.cache_dir = None
+
+        self.convert()
+        self.convert()
+
+        self.assertEqual(Converter.nread, 2)
+
+
+
+if __name__ == '__main__':
+    unittest.main()
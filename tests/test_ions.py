@@ -0,0 +1,148 @@
+#  Copyright (C) 2017  Hannes H Loeffler
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#  For full details of the license please see the COPYING file
+#  that should have come with this distribution.
+
+r'''
+Tests for the native ion placement and the molecule order of the ionised
+system in the GROMACS conversion.
+'''
+
+__revision__ = "$Id$"
+
+
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from FESetup import const
+from FESetup.prepare.amber import common, gromacs, parm7
+
+
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__) ), 'data')
+FILES = ('solvated.parm7', 'solvated.rst7', 'ion_templates.parm7',
+         'ion_templates.rst7')
+
+
+class Solvated(common.Common):
+    """Solvated test system, add_ions() needs neither leap nor an MD engine."""
+
+    def __init__(self):
+        self.amber_top = const.LEAP_SOLVATED + self.TOP_EXT
+        self.amber_crd = const.LEAP_SOLVATED + self.RST_EXT
+
+
+def read_top(filename):
+    """Residue names of all atoms in the order of [ molecules ]."""
+
+    molecules = {}
+    order = []
+    section = ''
+    name = ''
+
+    with open(filename, 'r') as top:
+        for line in top:
+            line = line.split(';')[0].strip()
+
+            if not line or line.startswith('#'):
+                continue
+
+            if line.startswith('['):
+                section = line[1:-1].strip()
+                continue
+
+            fields = line.split()
+
+            if section == 'moleculetype':
+                name = fields[0]
+                molecules[name] = []
+            elif section == 'atoms':
+                molecules[name].append(fields[3])
+            elif section == 'molecules':
+                order.extend([fields[0]] * int(fields[1]) )
+
+    resnames = []
+
+    for name in order:
+        resnames.extend(molecules[name])
+
+    return resnames
+
+
+def read_gro(filename):
+    """Residue names of all atoms in a gro file."""
+
+    with open(filename, 'r') as gro:
+        lines = gro.readlines()
+
+    natoms = int(lines[1])
+
+    return [line[5:10].strip() for line in lines[2:natoms+2]]
+
+
+
+class AddIonsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmpdir = tempfile.mkdtemp()
+
+        for filename in FILES:
+            shutil.copy(os.path.join(DATA_DIR, filename), self.tmpdir)
+
+        os.chdir(self.tmpdir)
+
+        self.system = Solvated()
+        self.system.add_ions(0.5)
+
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmpdir)
+
+
+    def test_ions_before_water(self):
+        parm = parm7.Parm7(self.system.amber_top, self.system.amber_crd)
+        resnames = parm.res_names.tolist()
+
+        # the system has a charge of +1, two Na+ and three Cl- are added at
+        # 0.5 mol/l
+        self.assertEqual(resnames[:7], ['LIG', 'Na+', 'Na+', 'Cl-', 'Na+',
+                                        'Cl-', 'Cl-'])
+        self.assertEqual(set(resnames[7:]), set(['WAT']) )
+        self.assertAlmostEqual(parm.charges.sum(), 0.0, places=4)
+        self.assertEqual(len(parm.coords), parm.natoms)
+
+
+    def test_gromacs_order(self):
+        gtop = gromacs.GromacsTop()
+        gtop.readParm(self.system.amber_top, self.system.amber_crd)
+        gtop.writeTop('ionized.top', '', '', False)
+        gtop.writeGro('ionized.gro')
+
+        gro = read_gro('ionized.gro')
+
+        self.assertEqual(read_top('ionized.top'), gro)
+        self.assertEqual(gro[5:8], ['Na+', 'Na+', 'Cl-'])
+
+
+
+if __name__ == '__main__':
+    unittest.main()
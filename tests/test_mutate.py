@@ -0,0 +1,174 @@
+#  Copyright (C) 2017  Hannes H Loeffler
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#  For full details of the license please see the COPYING file
+#  that should have come with this distribution.
+
+r'''
+Tests for the precomputed MCS matches and the saved morph topology state.
+'''
+
+__revision__ = "$Id$"
+
+
+
+import os
+import shutil
+import tempfile
+import unittest
+import cPickle as pickle
+
+from FESetup import errors
+from FESetup.mutate import morph, util
+
+
+
+# element sequence and bond list as from cheapmap.atom_signature()
+SIGNATURES = {'ethanol': ( (6, 6, 8), ( (0, 1), (1, 2) ) ),
+              'methylamine': ( (6, 7), ( (0, 1), ) )}
+MATCHES = {('ethanol', 'methylamine'): [(1, 0), (2, 1)]}
+
+
+class McsMatchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir, 'mcs_matches.pickle')
+
+        # same layout as cheapmap.write_matches()
+        with open(self.filename, 'wb') as pfile:
+            pickle.dump(SIGNATURES, pfile, pickle.HIGHEST_PROTOCOL)
+            pickle.dump(MATCHES, pfile, pickle.HIGHEST_PROTOCOL)
+
+        self.matches = util.load_mcs_matches(self.filename)
+
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+
+    def test_forward(self):
+        sig1, sig2, pairs = util.lookup_mcs_match(self.matches, 'ethanol',
+                                                  'methylamine')
+
+        self.assertEqual(sig1, SIGNATURES['ethanol'])
+        self.assertEqual(sig2, SIGNATURES['methylamine'])
+        self.assertEqual(pairs, [(1, 0), (2, 1)])
+
+
+    def test_reverse(self):
+        sig1, sig2, pairs = util.lookup_mcs_match(self.matches,
+                                                  'methylamine', 'ethanol')
+
+        self.assertEqual(sig1, SIGNATURES['methylamine'])
+        self.assertEqual(sig2, SIGNATURES['ethanol'])
+        self.assertEqual(pairs, [(0, 1), (1, 2)])
+
+
+    def test_unknown(self):
+        self.assertTrue(util.lookup_mcs_match(self.matches, 'ethanol',
+                                              'benzene') is None)
+        self.assertTrue(util.lookup_mcs_match(None, 'ethanol',
+                                              'methylamine') is None)
+
+
+    def test_unreadable(self):
+        with open(self.filename, 'wb') as pfile:
+            pfile.write(b'')
+
+        self.assertRaises(errors.SetupError, util.load_mcs_matches,
+                          self.filename)
+
+
+
+class SireObject(object):
+    """Stand-in for a Sire object, these cannot be pickled."""
+
+    def __reduce__(self):
+        raise pickle.PicklingError('Sire objects cannot be pickled')
+
+SireObject.__module__ = 'Sire.Mol'
+
+
+class PertTopology(object):
+    """Minimal free energy topology as created by a Morph."""
+
+    def __init__(self, **attrs):
+        self.__dict__.update(attrs)
+
+
+    def create_coords(self):
+        pass
+
+
+class MorphState(object):
+    """The state a Morph shares with its topologies."""
+
+    name = 'ethanol~methylamine'
+
+    def __init__(self):
+        for attr in morph.TOPOL_SHARED:
+            setattr(self, attr, attr)
+
+        self.lig_morph = SireObject()
+
+
+
+class TopologyStateTest(unittest.TestCase):
+
+    def setUp(self):
+        shared = dict( (attr, SireObject() ) for attr in morph.TOPOL_SHARED)
+
+        inner = PertTopology(FE_sub_type='softcore', **shared)
+        self.topol = PertTopology(FE_sub_type='dummy', files=['a', 'b'],
+                                  lig_morph=SireObject(), topol=inner,
+                                  **shared)
+
+
+    def restore(self, state):
+        packed = pickle.loads(pickle.dumps(morph._pack_topol(self.topol),
+                                           pickle.HIGHEST_PROTOCOL) )
+
+        return morph._unpack_topol(packed, state)
+
+
+    def test_round_trip(self):
+        state = MorphState()
+        topol = self.restore(state)
+
+        self.assertTrue(isinstance(topol, PertTopology) )
+        self.assertEqual(topol.FE_sub_type, 'dummy')
+        self.assertEqual(topol.files, ['a', 'b'])
+        self.assertTrue(topol.lig_morph is state.lig_morph)
+
+        for attr in morph.TOPOL_SHARED:
+            self.assertEqual(getattr(topol, attr), attr)
+            self.assertEqual(getattr(topol.topol, attr), attr)
+
+        self.assertTrue(isinstance(topol.topol, PertTopology) )
+        self.assertEqual(topol.topol.FE_sub_type, 'softcore')
+
+
+    def test_missing(self):
+        state = MorphState()
+        del state.lig_morph
+
+        self.assertRaises(errors.SetupError, self.restore, state)
+
+
+
+if __name__ == '__main__':
+    unittest.main()
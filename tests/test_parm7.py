@@ -0,0 +1,276 @@
+#  Copyright (C) 2017  Hannes H Loeffler
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#  For full details of the license please see the COPYING file
+#  that should have come with this distribution.
+
+r'''
+Tests for the parm7/rst7 readers and writers, molecule types and the periodic
+helpers used in ion placement and unwrapping.
+'''
+
+__revision__ = "$Id$"
+
+
+
+import os
+import shutil
+import tempfile
+import itertools
+import unittest
+
+import numpy as np
+
+from FESetup import errors
+from FESetup.prepare.amber import parm7
+
+
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__) ), 'data')
+
+# leap's truncated octahedron from solvateOct
+OCT_ANGLE = 109.4712190
+OCT_BOX = (40.0, 40.0, 40.0, OCT_ANGLE, OCT_ANGLE, OCT_ANGLE)
+
+
+class MinImageTest(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(1)
+        self.near = rng.uniform(-3.0, 3.0, (50, 3) )
+
+
+    def images(self, box):
+        """Periodic images of the near vectors up to two cells away."""
+
+        cell = parm7.cell_matrix(box)
+        shifts = np.array(list(itertools.product(range(-2, 3), repeat=3) ) )
+
+        return self.near[:, np.newaxis, :] + shifts.dot(cell)
+
+
+    def test_rectangular(self):
+        box = (30.0, 35.0, 40.0, 90.0, 90.0, 90.0)
+        dist2 = parm7.min_image_dist2(self.images(box), box)
+
+        expected = np.sum(self.near**2, axis=1)[:, np.newaxis]
+        np.testing.assert_allclose(dist2, np.broadcast_to(expected,
+                                                          dist2.shape) )
+
+
+    def test_octahedron(self):
+        dist2 = parm7.min_image_dist2(self.images(OCT_BOX), OCT_BOX)
+
+        expected = np.sum(self.near**2, axis=1)[:, np.newaxis]
+        np.testing.assert_allclose(dist2, np.broadcast_to(expected,
+                                                          dist2.shape) )
+
+
+    def test_octahedron_rounding(self):
+        # compare arbitrary vectors against a brute force image search, plain
+        # rounding of fractional coordinates is not enough in this cell
+        cell = parm7.cell_matrix(OCT_BOX)
+        rng = np.random.RandomState(2)
+        diff = rng.uniform(-1.0, 1.0, (500, 3) ).dot(cell)
+
+        shifts = np.array(list(itertools.product(range(-2, 3), repeat=3) ) )
+        vec = diff[:, np.newaxis, :] + shifts.dot(cell)
+        brute = np.min(np.sum(vec * vec, axis=2), axis=1)
+
+        frac = diff.dot(np.linalg.inv(cell) )
+        naive = (frac - np.round(frac) ).dot(cell)
+        naive = np.sum(naive * naive, axis=1)
+
+        self.assertTrue(np.any(naive > brute + 1.0) )
+        np.testing.assert_allclose(parm7.min_image_dist2(diff, OCT_BOX),
+                                   brute)
+
+
+    def test_volume(self):
+        cell = parm7.cell_matrix(OCT_BOX)
+
+        # truncated octahedron: V = 4 sqrt(3) / 9 * a^3
+        self.assertAlmostEqual(abs(np.linalg.det(cell) ),
+                               4.0 * np.sqrt(3.0) / 9.0 * 40.0**3, places=2)
+
+
+
+class SectionTest(unittest.TestCase):
+
+    def test_fixed_width(self):
+        # integers may fill the whole field without separating blanks
+        data = parm7._parse_section(['12345678-1234567       1'], ('i', 8),
+                                    'test', 'TEST')
+
+        self.assertEqual(data.tolist(), [12345678, -1234567, 1])
+
+
+    def test_stripped_strings(self):
+        # trailing blanks of the last name may have been stripped
+        data = parm7._parse_section(['C1  Na+ Cl-'], ('a', 4), 'test',
+                                    'TEST')
+
+        self.assertEqual(data.tolist(), ['C1', 'Na+', 'Cl-'])
+
+
+    def test_malformed(self):
+        self.assertRaises(errors.SetupError, parm7._parse_section,
+                          ['  1.0000x0'], ('e', 10), 'test', 'TEST')
+
+
+    def test_sections(self):
+        sec = parm7.read_sections(os.path.join(DATA_DIR, 'ions.parm7') )
+
+        self.assertEqual(sec['POINTERS'][parm7.NATOM], 16)
+        self.assertEqual(sec['RESIDUE_LABEL'].tolist(),
+                         ['LIG', 'WAT', 'WAT', 'WAT', 'Na+', 'Cl-'])
+        self.assertEqual(sec['ATOMS_PER_MOLECULE'].tolist(),
+                         [5, 3, 3, 3, 1, 1])
+        self.assertEqual(len(sec['TITLE']), 0)
+        self.assertAlmostEqual(sec['CHARGE'][-1], -18.2223)
+
+
+    def test_not_parm7(self):
+        self.assertRaises(errors.SetupError, parm7.read_sections,
+                          os.path.join(DATA_DIR, 'ions.rst7') )
+
+
+
+class Rst7Test(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.rst7 = os.path.join(self.tmpdir, 'test.rst7')
+
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+
+    def test_round_trip(self):
+        # an odd number of atoms leaves a partial line
+        rng = np.random.RandomState(3)
+        coords = rng.uniform(-50.0, 50.0, (5, 3) )
+        vels = rng.uniform(-1.0, 1.0, (5, 3) )
+        box = (30.0, 35.0, 40.0, 90.0, 90.0, 90.0)
+
+        parm7.write_rst7(self.rst7, coords, vels, box)
+        crds, vls, bx = parm7.read_rst7(self.rst7, 5)
+
+        np.testing.assert_allclose(crds, coords, atol=1.0e-7)
+        np.testing.assert_allclose(vls, vels, atol=1.0e-7)
+        np.testing.assert_allclose(bx, box)
+
+
+    def test_coordinates_only(self):
+        coords = np.arange(6.0).reshape(2, 3)
+
+        parm7.write_rst7(self.rst7, coords)
+        crds, vels, box = parm7.read_rst7(self.rst7)
+
+        np.testing.assert_allclose(crds, coords)
+        self.assertTrue(vels is None)
+        self.assertTrue(box is None)
+
+
+    def test_fixture(self):
+        # the fixture was written by write_rst7() and must be reproduced
+        filename = os.path.join(DATA_DIR, 'ions.rst7')
+        coords, vels, box = parm7.read_restart(filename, 16)
+
+        parm7.write_rst7(self.rst7, coords, vels, box)
+
+        with open(filename, 'r') as orig, open(self.rst7, 'r') as new:
+            self.assertEqual(orig.read(), new.read() )
+
+
+    def test_wrong_natoms(self):
+        self.assertRaises(errors.SetupError, parm7.read_rst7,
+                          os.path.join(DATA_DIR, 'ions.rst7'), 15)
+
+
+
+class MoleculeTypesTest(unittest.TestCase):
+
+    def setUp(self):
+        # LIG, 3 WAT, Na+, Cl-
+        self.parm = parm7.Parm7(os.path.join(DATA_DIR, 'ions.parm7'),
+                                os.path.join(DATA_DIR, 'ions.rst7') )
+
+
+    def test_types(self):
+        moltypes = self.parm.molecule_types()
+
+        self.assertEqual([mt.res_names for mt in moltypes],
+                         [('LIG',), ('WAT',), ('Na+',), ('Cl-',)])
+        self.assertEqual([mt.mols for mt in moltypes], [[0], [1, 2, 3], [4],
+                                                         [5]])
+        self.assertEqual([mt.natoms for mt in moltypes], [5, 3, 1, 1])
+        self.assertEqual(self.parm.mol_type.tolist(), [0, 1, 1, 1, 2, 3])
+
+
+    def test_type_atoms(self):
+        self.assertEqual(self.parm.type_atoms(1).tolist(), list(range(5, 14) ) )
+        self.assertEqual(self.parm.type_atoms(3).tolist(), [15])
+
+
+
+class UnwrapTest(unittest.TestCase):
+
+    def bond_vectors(self, coords, mol_start):
+        starts = set(mol_start[:-1].tolist() )
+        idx = [i for i in range(1, len(coords) ) if i not in starts]
+
+        return coords[idx] - coords[[i - 1 for i in idx]]
+
+
+    def test_rectangular(self):
+        box = (10.0, 10.0, 10.0, 90.0, 90.0, 90.0)
+        mol_start = np.array([0, 3, 4])
+
+        # a chain across the x face and a single atom outside the cell
+        coords = np.array([[9.5, 5.0, 5.0], [0.5, 5.0, 5.0], [1.5, 5.0, 5.0],
+                           [12.0, 5.0, 5.0]])
+        unwrapped = parm7.unwrap(coords, mol_start, box)
+
+        np.testing.assert_allclose(unwrapped,
+                                   [[9.5, 5.0, 5.0], [10.5, 5.0, 5.0],
+                                    [11.5, 5.0, 5.0], [2.0, 5.0, 5.0]])
+
+
+    def test_octahedron(self):
+        rng = np.random.RandomState(4)
+        cell = parm7.cell_matrix(OCT_BOX)
+
+        # random walks with short steps, wrapped atom by atom
+        mol_start = np.array([0, 10, 20, 30])
+        steps = rng.uniform(-1.0, 1.0, (30, 3) )
+        steps[mol_start[:-1]] = rng.uniform(0.0, 1.0, (3, 3) ).dot(cell)
+        coords = np.cumsum(steps, axis=0)
+
+        frac = coords.dot(np.linalg.inv(cell) )
+        wrapped = (frac - np.floor(frac) ).dot(cell)
+
+        unwrapped = parm7.unwrap(wrapped, mol_start, OCT_BOX)
+
+        np.testing.assert_allclose(self.bond_vectors(unwrapped, mol_start),
+                                   self.bond_vectors(coords, mol_start),
+                                   atol=1.0e-8)
+
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,114 @@
+#  Copyright (C) 2017  Hannes H Loeffler
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#  For full details of the license please see the COPYING file
+#  that should have come with this distribution.
+
+r'''
+Tests for the process-wide topology and mask cache.
+'''
+
+__revision__ = "$Id$"
+
+
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from FESetup.prepare.amber import topcache
+
+
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__) ), 'data')
+
+
+class TopCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.parmtop = os.path.join(self.tmpdir, 'test.parm7')
+
+        # LIG, 3 WAT, Na+, Cl-
+        shutil.copy(os.path.join(DATA_DIR, 'ions.parm7'), self.parmtop)
+
+
+    def tearDown(self):
+        topcache.forget(self.parmtop)
+        shutil.rmtree(self.tmpdir)
+
+
+    def test_shared(self):
+        parm = topcache.get_parm(self.parmtop)
+
+        self.assertTrue(topcache.get_parm(self.parmtop) is parm)
+        self.assertEqual(len(parm.atoms), 16)
+
+        topcache.forget(self.parmtop)
+        self.assertFalse(topcache.get_parm(self.parmtop) is parm)
+
+
+    def test_rewritten(self):
+        parm = topcache.get_parm(self.parmtop)
+        shutil.copy(os.path.join(DATA_DIR, 'ion_templates.parm7'),
+                    self.parmtop)
+
+        new = topcache.get_parm(self.parmtop)
+
+        self.assertFalse(new is parm)
+        self.assertEqual(len(new.atoms), 2)
+
+
+    def test_mask(self):
+        idx = topcache.mask_indexes(self.parmtop, ':WAT')
+
+        self.assertEqual(idx.tolist(), list(range(5, 14) ) )
+        self.assertFalse(idx.flags.writeable)
+        self.assertTrue(topcache.mask_indexes(self.parmtop, ':WAT') is idx)
+        self.assertEqual(topcache.mask_indexes(self.parmtop,
+                                               ':Na+,Cl-').tolist(), [14, 15])
+
+
+    def test_periodic(self):
+        # from the file text and from the parsed topology
+        self.assertTrue(topcache.is_periodic(self.parmtop) )
+
+        topcache.forget(self.parmtop)
+        topcache.get_parm(self.parmtop)
+
+        self.assertTrue(topcache.is_periodic(self.parmtop) )
+
+
+    def test_size(self):
+        names = []
+
+        for i in range(topcache.CACHE_SIZE + 1):
+            name = os.path.join(self.tmpdir, '%i.parm7' % i)
+            shutil.copy(self.parmtop, name)
+            topcache.get_parm(name)
+            names.append(os.path.abspath(name) )
+
+        self.assertFalse(names[0] in topcache._cache)
+        self.assertTrue(names[-1] in topcache._cache)
+
+        for name in names:
+            topcache.forget(name)
+
+
+
+if __name__ == '__main__':
+    unittest.main()
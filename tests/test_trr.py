@@ -0,0 +1,94 @@
+#  Copyright (C) 2017  Hannes H Loeffler
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#  For full details of the license please see the COPYING file
+#  that should have come with this distribution.
+
+r'''
+Tests for the native GROMACS TRR reader.
+'''
+
+__revision__ = "$Id$"
+
+
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from FESetup import errors
+from FESetup.prepare.mdengines import gromacs
+
+
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__) ), 'data')
+
+# both fixtures have 4 atoms and a cubic 1.86 nm box, frames at step 0 and
+# 500 with coordinates and velocities, md_double.trr is in double precision
+# and has a third frame with velocities only
+COORDS = np.arange(12.0).reshape(4, 3) * 0.1 + 0.5
+VELS = np.arange(12.0).reshape(4, 3) * 0.2
+BOX = np.diag([1.86, 1.86, 1.86])
+
+
+class TrrTest(unittest.TestCase):
+
+    def test_single(self):
+        box, coords, vels = gromacs.read_trr_last(os.path.join(DATA_DIR,
+                                                               'md.trr') )
+
+        np.testing.assert_allclose(box, BOX, rtol=1.0e-6)
+        np.testing.assert_allclose(coords, COORDS, rtol=1.0e-6)
+        np.testing.assert_allclose(vels, VELS, rtol=1.0e-6)
+
+
+    def test_double(self):
+        # the last frame without coordinates is skipped
+        box, coords, vels = gromacs.read_trr_last(
+            os.path.join(DATA_DIR, 'md_double.trr') )
+
+        np.testing.assert_allclose(box, BOX)
+        np.testing.assert_allclose(coords, COORDS)
+        np.testing.assert_allclose(vels, VELS)
+
+
+    def test_truncated(self):
+        tmpdir = tempfile.mkdtemp()
+        trr = os.path.join(tmpdir, 'truncated.trr')
+
+        try:
+            with open(os.path.join(DATA_DIR, 'md.trr'), 'rb') as inp:
+                data = inp.read()
+
+            with open(trr, 'wb') as out:
+                out.write(data[:-8])
+
+            self.assertRaises(errors.SetupError, gromacs.read_trr_last, trr)
+        finally:
+            shutil.rmtree(tmpdir)
+
+
+    def test_not_trr(self):
+        self.assertRaises(errors.SetupError, gromacs.read_trr_last,
+                          os.path.join(DATA_DIR, 'ions.rst7') )
+
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -55,6 +55,7 @@ import FESetup.prepare as prep
 from FESetup import const, errors, create_logger, logger, DirManager
 from FESetup.ui.iniparser import IniParser
 from FESetup.modelconf import ModelConfig
+from FESetup.prepare.amber import convcache, leaplib
 
 # FIXME: That's here solely to suppress a warning over a fmcs/Sire double
 # data type registration collision.  Impact limited as much as possible but
@@ -123,6 +124,34 @@ def prelude(opts):
     ff_opts.append(opts[SECT_DEF]['parmchk_version'])
     ff_opts.append(opts[SECT_DEF]['gaff'])
 
+    type_dirs = {}
+    afe_types = []
+
+    # every AFE type needs its own morph directory
+    for afe_type in opts[SECT_DEF]['AFE.type']:
+        if afe_type in afe_types:
+            continue
+
+        type_dir = mutate.type_workdir(afe_type)
+
+        if type_dir in type_dirs:
+            raise dGprepError('AFE.type: %s and %s would both be written to '
+                              'directory %s' % (type_dirs[type_dir], afe_type,
+                                                type_dir) )
+
+        type_dirs[type_dir] = afe_type
+        afe_types.append(afe_type)
+
+    opts[SECT_DEF]['AFE.type'] = afe_types
+
+    if opts[SECT_DEF]['mdengine.cache']:
+        convcache.cache_dir = os.path.join(os.getcwd(),
+                                           const.CONVERSION_CACHE_DIR)
+
+    if opts[SECT_DEF]['leap.library']:
+        leaplib.library_dir = os.path.join(os.getcwd(),
+                                           const.LEAP_LIBRARY_DIR)
+
     return prep.ForceField(*ff_opts)
 
 
@@ -321,7 +350,7 @@ def make_ligand(name, ff, opts):
                                        .split(',')]
 
                 if lig['morph.absolute'] and \
-                       opts[SECT_DEF]['AFE.type'] == 'Sire':
+                       'Sire' in opts[SECT_DEF]['AFE.type']:
                     logger.write('Creating input files for absolute '
                                  'transformations with Sire')
                     ligand.create_absolute_Sire()
@@ -408,7 +437,7 @@ def make_ligand(name, ff, opts):
 
             nconf = lig['conf_search.numconf']
 
-            if lig['morph.absolute'] and opts[SECT_DEF]['AFE.type'] == 'Sire':
+            if lig['morph.absolute'] and 'Sire' in opts[SECT_DEF]['AFE.type']:
                 ligand.create_absolute_Sire()
 
             if nconf > 0:
@@ -427,22 +456,17 @@ def make_ligand(name, ff, opts):
             ligand.create_top(boxtype = lig['box.type'],
                               boxlength = lig['box.length'],
                               neutralize = lig['neutralize'],
-                              addcmd = load_cmds, remove_first = False)
-
-            if lig['ions.conc'] > 0.0:
-                ligand.create_top(boxtype = lig['box.type'],
-                                  boxlength = lig['box.length'],
-                                  neutralize = 2,
-                                  addcmd = load_cmds, remove_first = False,
-                                  conc = lig['ions.conc'],
-                                  dens = lig['ions.dens'])
+                              addcmd = load_cmds, remove_first = False,
+                              conc = lig['ions.conc'],
+                              dens = lig['ions.dens'])
 
             restr_force = lig['min.restr_force']
             nsteps = lig['min.nsteps']
 
             ligand.setup_MDEngine(opts[SECT_DEF]['mdengine'][1],
                                   opts[SECT_DEF]['mdengine.prefix'],
-                                  opts[SECT_DEF]['mdengine.postfix'])
+                                  opts[SECT_DEF]['mdengine.postfix'],
+                                  opts[SECT_DEF]['mdengine.single_run'])
 
             if nsteps > 0:
                 do_min(ligand, lig)
@@ -591,23 +615,17 @@ def make_protein(name, ff, opts):
                                boxlength = prot['box.length'],
                                neutralize = prot['neutralize'],
                                align = prot['align_axes'],
-                               addcmd = load_cmds, remove_first = True)
-
-            if prot['ions.conc'] > 0.0:
-                protein.create_top(boxtype = prot['box.type'],
-                                   boxlength = prot['box.length'],
-                                   neutralize = 2,
-                                   align = prot['align_axes'],
-                                   addcmd = load_cmds, remove_first = False,
-                                   conc = prot['ions.conc'],
-                                   dens = prot['ions.dens'])
+                               addcmd = load_cmds, remove_first = True,
+                               conc = prot['ions.conc'],
+                               dens = prot['ions.dens'])
 
             restr_force = prot['min.restr_force']
             nsteps = prot['min.nsteps']
 
             protein.setup_MDEngine(opts[SECT_DEF]['mdengine'][1],
                                    opts[SECT_DEF]['mdengine.prefix'],
-                                   opts[SECT_DEF]['mdengine.postfix'])
+                                   opts[SECT_DEF]['mdengine.postfix'],
+                                   opts[SECT_DEF]['mdengine.single_run'])
 
             if nsteps > 0:
                 do_min(protein, prot)
@@ -744,23 +762,17 @@ def make_complex(prot, lig, ff, opts, load_cmds):
                                boxlength=com['box.length'],
                                neutralize=com['neutralize'],
                                align=com['align_axes'],
-                               addcmd=load_cmds, remove_first = True)
-
-            if com['ions.conc'] > 0.0:
-                complex.create_top(boxtype=com['box.type'],
-                                   boxlength=com['box.length'],
-                                   neutralize=2,
-                                   align=com['align_axes'],
-                                   addcmd=load_cmds, remove_first=False,
-                                   conc=com['ions.conc'],
-                                   dens=com['ions.dens'])
+                               addcmd=load_cmds, remove_first = True,
+                               conc=com['ions.conc'],
+                               dens=com['ions.dens'])
 
             restr_force = com['min.restr_force']
             nsteps = com['min.nsteps']
 
             complex.setup_MDEngine(opts[SECT_DEF]['mdengine'][1],
                                    opts[SECT_DEF]['mdengine.prefix'],
-                                   opts[SECT_DEF]['mdengine.postfix'])
+                                   opts[SECT_DEF]['mdengine.postfix'],
+                                   opts[SECT_DEF]['mdengine.single_run'])
 
             if nsteps > 0:
                 do_min(complex, com)
@@ -852,14 +864,20 @@ defaults[SECT_DEF] = {
     'mdengine': (['amber', 'sander'], ('list', LIST_SEP) ),
     'mdengine.prefix': ('', None),
     'mdengine.postfix': ('', None),
+    'mdengine.single_run': (False, ('bool', ) ),
+    'mdengine.cache': (True, ('bool', ) ),
+    'leap.library': (True, ('bool', ) ),
     'parmchk_version': (2, (int, ) ),
     'FE_type': ('', None),
-    'AFE.type': ('Sire', None),
+    'AFE.type': (['Sire'], ('list', LIST_SEP) ),
     'AFE.separate_vdw_elec': (True, ('bool', ) ),
+    'AFE.splice': (True, ('bool', ) ),
+    'AFE.reuse_state': (False, ('bool', ) ),
     'softcore_type': ('ignored', None),
     'remake': (False, ('bool', ) ),
     'mcs.timeout': (60, (int, ) ),      # int because of FMCS/C++
     'mcs.match_by': ('', None),
+    'mcs.matches': ('', None),          # cheapmap -s output
     'overwrite': (False, ('bool', ) ),
     'user_params': (False, ('bool', ) ),
     'MC_prep': (False, ('bool', ) ),
@@ -980,7 +998,7 @@ if __name__ == '__main__':
 
     # backward compatibility
     if options[SECT_DEF]['FE_type']:
-        options[SECT_DEF]['AFE.type'] = options[SECT_DEF]['FE_type']
+        options[SECT_DEF]['AFE.type'] = [options[SECT_DEF]['FE_type'] ]
 
     if options[SECT_DEF]['gaff'] == 'gaff1':
         options[SECT_DEF]['gaff'] = 'gaff'
@@ -1070,13 +1088,18 @@ if __name__ == '__main__':
     ### ligand morphs
 
     if morph_pairs:
-        print('Morphs will be generated for %s' % options[SECT_DEF]['AFE.type'])
-        logger.write('Morphs will be generated for %s\n' %
-                     options[SECT_DEF]['AFE.type'])
+        afe_types = ', '.join(options[SECT_DEF]['AFE.type'])
+        print('Morphs will be generated for %s' % afe_types)
+        logger.write('Morphs will be generated for %s\n' % afe_types)
 
     morphs = []
     morph_failed = []
 
+    mcs_matches = None
+
+    if morph_pairs and options[SECT_DEF]['mcs.matches']:
+        mcs_matches = mutate.load_mcs_matches(options[SECT_DEF]['mcs.matches'])
+
     for pair in morph_pairs:
         try:
             l1 = ligands[pair[0] ]
@@ -1102,31 +1125,59 @@ if __name__ == '__main__':
         wd1 = os.path.join(os.getcwd(), const.LIGAND_WORKDIR, pair[0])
         wd2 = os.path.join(os.getcwd(), const.LIGAND_WORKDIR, pair[1])
 
-        with mutate.Morph(ligand1, ligand2, wd1, wd2, ff,
-                          options[SECT_DEF]['AFE.type'],
-                          options[SECT_DEF]['AFE.separate_vdw_elec'],
-                          options[SECT_DEF]['mcs.timeout'],
-                          options[SECT_DEF]['mcs.match_by'],
-                          options[SECT_DEF]['gaff']) as morph:
-
-            print ('Morphing %s to %s...' % pair)
-
-            if (pair[1], pair[0]) in morph_pairs:
-                rev = ligand2
+        if (pair[1], pair[0]) in morph_pairs:
+            rev = ligand2
+        else:
+            rev = None
+
+        morph = None
+
+        # the atom mapping is computed once and shared by all AFE types
+        for afe_type in options[SECT_DEF]['AFE.type']:
+            if not morph:
+                morph = mutate.Morph(ligand1, ligand2, wd1, wd2, ff, afe_type,
+                                     options[SECT_DEF]['AFE.separate_vdw_elec'],
+                                     options[SECT_DEF]['mcs.timeout'],
+                                     options[SECT_DEF]['mcs.match_by'],
+                                     options[SECT_DEF]['gaff'],
+                                     mcs_matches,
+                                     options[SECT_DEF]['AFE.splice'])
             else:
-                rev = None
+                try:
+                    morph = morph.derive(afe_type)
+                except errors.SetupError as why:
+                    morph_failed.append(morph.name)
+                    print ('ERROR: %s (%s) failed: %s' %
+                           (morph.name, afe_type, why))
+                    continue
+
+            with morph:
+                print ('Morphing %s to %s (%s)...' % (pair + (afe_type, ) ) )
 
-            try:
-                morph.setup(cmd1, cmd2, basedir, isotope_map)
+                try:
+                    restored = False
 
-                if options[SECT_LIG]['box.type']:
-                    morph.create_coords(ligand1, 'solvated', wd1,
-                                        cmd1, cmd2, rev, wd2)
-            except errors.SetupError as why:
-                morph_failed.append(morph.name)
-                print ('ERROR: %s failed: %s' % (morph.name, why))
+                    # state saved by an earlier run, skips MCSS and topology
+                    # setup
+                    if options[SECT_DEF]['AFE.reuse_state']:
+                        try:
+                            morph.load_state()
+                            restored = True
+                        except errors.SetupError as why:
+                            logger.write('Cannot reuse morph state: %s' % why)
+
+                    if not restored:
+                        morph.setup(cmd1, cmd2, basedir, isotope_map,
+                                    options[SECT_DEF]['AFE.reuse_state'])
+
+                    if options[SECT_LIG]['box.type']:
+                        morph.create_coords(ligand1, 'solvated', wd1,
+                                            cmd1, cmd2, rev, wd2)
+                except errors.SetupError as why:
+                    morph_failed.append(morph.name)
+                    print ('ERROR: %s failed: %s' % (morph.name, why))
 
-            morphs.append(morph)
+                morphs.append(morph)
 
 
     ### complexes